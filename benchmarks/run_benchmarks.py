@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""
+Query endpoint benchmarks
+
+Mirrors a synthetic origin repo the same way the app mirrors GitHub,
+then measures throughput and latency percentiles of every query route
+through the Flask test client, serially and with concurrent clients.
+
+    benchmarks/run_benchmarks.py --output results.json
+    benchmarks/run_benchmarks.py --output new.json --compare results.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_repo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "eb-flask"))
+
+import application
+import db
+import git
+import long_git_operations
+import query_cache
+import repos
+import snapshots
+
+
+# Number of items in each bulk request body
+BULK_SIZE = 100
+
+# Routes registered by generate_rules() that modify the mirror
+# or the logs, and are therefore not benchmarked
+SKIPPED_RULES = {
+    "/git-clone": "starts a clone",
+    "/pr-fetch": "queues a fetch",
+    "/restore-head": "rewrites the repo config",
+    "/maintenance": "repacks the repo",
+    "/clear-logs": "deletes logs",
+}
+
+
+class Samples:
+    """
+    Draws request arguments from the commits and PRs of the mirror.
+    """
+
+    def __init__(self, git_objdir, rng):
+        self.rng = rng
+        self.master_commits = rev_list(git_objdir, ["--first-parent", "master"])
+        self.all_commits = rev_list(git_objdir, ["--all"])
+        self.master_timestamps = rev_list(git_objdir, ["--first-parent", "--format=%ct", "--no-commit-header", "master"])
+
+        refs = subprocess.check_output([git.GIT_BINARY_PATH, "--git-dir", git_objdir, "for-each-ref", "--format=%(refname)", git.PR_REF_PREFIX]).decode("utf-8").split()
+        self.pr_numbers = [int(refname.split("/")[-2]) for refname in refs]
+
+    def master_commit(self):
+        return self.rng.choice(self.master_commits)
+
+    def commit(self):
+        return self.rng.choice(self.all_commits)
+
+    def short_commit(self):
+        return self.commit()[:10]
+
+    def pr_number(self):
+        # Occasionally ask for a PR that does not exist
+        return self.rng.choice(self.pr_numbers + [max(self.pr_numbers) + 1])
+
+    def master_time_range(self, commit_count=BULK_SIZE):
+        """
+        Returns (since, until) timestamps spanning up to
+        commit_count commits of master's first-parent chain.
+        """
+
+        end = self.rng.randrange(len(self.master_timestamps))
+        start = min(len(self.master_timestamps) - 1, end + commit_count)
+        return self.master_timestamps[start], self.master_timestamps[end]
+
+    def path(self):
+        return "file-{}.txt".format(self.rng.randrange(synthetic_repo.FILE_COUNT))
+
+    def commits(self, count=BULK_SIZE):
+        return [self.commit() for _ in range(count)]
+
+
+def rev_list(git_objdir, rev_args):
+    return subprocess.check_output([git.GIT_BINARY_PATH, "--git-dir", git_objdir, "rev-list"] + rev_args).decode("utf-8").split()
+
+
+# Rule -> function of Samples returning (url, request body or None)
+ROUTE_CASES = {
+    "/": lambda s: ("/", None),
+    "/commit-distance/<base>/<branch>": lambda s: ("/commit-distance/{}/{}".format(s.master_commit(), s.commit()), None),
+    "/pr-head-commit/<pr>": lambda s: ("/pr-head-commit/{}".format(s.pr_number()), None),
+    "/master-merge-base/<commit>": lambda s: ("/master-merge-base/{}".format(s.commit()), None),
+    "/head-of-pull-requests/<commit>": lambda s: ("/head-of-pull-requests/{}".format(s.short_commit()), None),
+    "/is-ancestor/<ancestor>/<descendant>": lambda s: ("/is-ancestor/{}/{}".format(s.commit(), s.commit()), None),
+    "/rev-parse/<ref>": lambda s: ("/rev-parse/{}".format(s.short_commit()), None),
+    "/changed-paths/<commit>": lambda s: ("/changed-paths/{}".format(s.commit()), None),
+    "/pr-changed-paths/<pr>": lambda s: ("/pr-changed-paths/{}".format(s.pr_number()), None),
+    "/action-logs/<cmd>": lambda s: ("/action-logs/fetch", None),
+    "/github-event-logs": lambda s: ("/github-event-logs", None),
+    "/last-fetch-time": lambda s: ("/last-fetch-time", None),
+    "/last-fetch-changes": lambda s: ("/last-fetch-changes", None),
+    "/fetch-queue": lambda s: ("/fetch-queue", None),
+    "/cache-stats": lambda s: ("/cache-stats", None),
+    "/metrics": lambda s: ("/metrics", None),
+    "/repos": lambda s: ("/repos", None),
+    "/health": lambda s: ("/health", None),
+    "/rev-parse-query": lambda s: ("/rev-parse-query?ref={}".format(s.short_commit()), None),
+    "/api/is-ancestor": lambda s: ("/api/is-ancestor?ancestor={}&descendant={}".format(s.commit(), s.commit()), None),
+    "/is-ancestor-html": lambda s: ("/is-ancestor-html?ancestor={}&descendant={}".format(s.commit(), s.commit()), None),
+    "/master-commit-metadata": lambda s: ("/master-commit-metadata?since={}&until={}".format(*s.master_time_range()), None),
+    "/commit-range": lambda s: ("/commit-range/{}/master?fields=subject".format(s.master_commit()), None),
+    "/pr-commits": lambda s: ("/pr-commits/{}?fields=subject".format(s.pr_number()), None),
+    "/path-commits": lambda s: ("/path-commits?path={}".format(s.path()), None),
+    "/path-commits?ref=master": lambda s: ("/path-commits?path={}&ref=master".format(s.path()), None),
+
+    # POST routes
+    "/commit-metadata": lambda s: ("/commit-metadata", s.commits()),
+    "/commit-metadata?stream=1": lambda s: ("/commit-metadata?stream=1", s.commits()),
+    "/changed-paths": lambda s: ("/changed-paths", s.commits()),
+    "/bulk-rev-parse": lambda s: ("/bulk-rev-parse", [c[:10] for c in s.commits()]),
+    "/bulk-is-ancestor": lambda s: ("/bulk-is-ancestor", [[s.commit(), s.commit()] for _ in range(BULK_SIZE)]),
+    "/bulk-master-merge-base": lambda s: ("/bulk-master-merge-base", s.commits()),
+    "/bulk-pull-request-heads": lambda s: ("/bulk-pull-request-heads", [s.pr_number() for _ in range(BULK_SIZE)]),
+    "/bulk-pull-request-heads-simple": lambda s: ("/bulk-pull-request-heads-simple", [s.pr_number() for _ in range(BULK_SIZE)]),
+}
+
+# Route cases besides those registered by generate_rules()
+EXTRA_CASES = [
+    "/rev-parse-query",
+    "/api/is-ancestor",
+    "/is-ancestor-html",
+    "/master-commit-metadata",
+    "/commit-range",
+    "/pr-commits",
+    "/path-commits",
+    "/path-commits?ref=master",
+    "/commit-metadata",
+    "/commit-metadata?stream=1",
+    "/changed-paths",
+    "/bulk-rev-parse",
+    "/bulk-is-ancestor",
+    "/bulk-master-merge-base",
+    "/bulk-pull-request-heads",
+    "/bulk-pull-request-heads-simple",
+]
+
+
+class RuleCollector:
+    def __init__(self):
+        self.rules = []
+
+    def add_url_rule(self, rule, endpoint, view_func):
+        self.rules.append(rule)
+
+
+def get_case_names():
+    """
+    Every rule from generate_rules() must either have a case or be skipped.
+    """
+
+    collector = RuleCollector()
+    application.generate_rules(collector)
+
+    case_names = []
+    for rule in collector.rules:
+        if rule in SKIPPED_RULES:
+            continue
+
+        if rule not in ROUTE_CASES:
+            raise KeyError("No benchmark case for route " + rule)
+
+        case_names.append(rule)
+
+    return case_names + EXTRA_CASES
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def run_case(case_name, samples, request_count, concurrency):
+    """
+    Caches are cleared first, so repeated arguments are
+    only answered from the cache within a run.
+    """
+
+    requests = [ROUTE_CASES[case_name](samples) for _ in range(request_count)]
+
+    query_cache.caches.current().clear()
+
+    def run_requests(worker_requests):
+        client = application.application.test_client()
+
+        latencies = []
+        errors = 0
+        for url, body in worker_requests:
+            start_time = time.perf_counter()
+            if body is None:
+                response = client.get(url)
+            else:
+                response = client.post(url, data=json.dumps(body))
+
+            response.get_data()
+            latencies.append(time.perf_counter() - start_time)
+
+            if response.status_code >= 400:
+                errors += 1
+
+        return latencies, errors
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        worker_results = list(executor.map(run_requests, [requests[i::concurrency] for i in range(concurrency)]))
+    elapsed_seconds = time.perf_counter() - start_time
+
+    latencies = sorted(x for worker_latencies, _ in worker_results for x in worker_latencies)
+
+    return {
+        "route": case_name,
+        "concurrency": concurrency,
+        "requests": request_count,
+        "errors": sum(errors for _, errors in worker_results),
+        "throughput_per_second": request_count / elapsed_seconds,
+        "latency_ms": {
+            "p50": 1000 * percentile(latencies, 0.5),
+            "p99": 1000 * percentile(latencies, 0.99),
+            "mean": 1000 * sum(latencies) / len(latencies),
+            "max": 1000 * latencies[-1],
+        },
+    }
+
+
+def set_up_mirror(work_dir, args, build_indexes):
+
+    origin_path = os.path.join(work_dir, "origin.git")
+    synthetic_repo.create_origin(origin_path, args.commits, args.fan_out, args.side_length, args.prs, args.pr_length, args.seed)
+
+    # The benchmarked routes act on the default repo
+    repo = repos.default_repo
+    repo.clone_path = os.path.join(work_dir, "mirror", "repo.git")
+    db.DEFAULT_PATH = os.path.join(work_dir, "database.sqlite3")
+
+    for cmd_result in [git.bare_clone(repo.clone_path, origin_path), git.fetch_pr_refs(repo.clone_path)]:
+        if cmd_result.return_code:
+            raise RuntimeError(cmd_result.stderr)
+
+    git.reset_object_readers(repo.clone_path)
+    long_git_operations.publish_snapshot()
+    if build_indexes:
+        long_git_operations.update_indexes()
+
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "git": subprocess.check_output([git.GIT_BINARY_PATH, "--version"]).decode("utf-8").strip(),
+    }
+
+
+def compare_results(previous, current, threshold):
+    """
+    Prints the change in p50 and p99 latency and throughput of each case,
+    and returns the number of cases whose p99 latency regressed by
+    more than the threshold fraction.
+    """
+
+    previous_by_key = {(r["route"], r["concurrency"]): r for r in previous["results"]}
+
+    regression_count = 0
+    for result in current["results"]:
+        old = previous_by_key.get((result["route"], result["concurrency"]))
+        if not old:
+            continue
+
+        p50_ratio = result["latency_ms"]["p50"] / old["latency_ms"]["p50"]
+        p99_ratio = result["latency_ms"]["p99"] / old["latency_ms"]["p99"]
+        throughput_ratio = result["throughput_per_second"] / old["throughput_per_second"]
+
+        regressed = p99_ratio > 1 + threshold
+        regression_count += regressed
+
+        print("{:<45} x{:<3} p50 {:6.2f}x  p99 {:6.2f}x  throughput {:6.2f}x{}".format(
+            result["route"], result["concurrency"], p50_ratio, p99_ratio, throughput_ratio,
+            "  REGRESSED" if regressed else ""))
+
+    return regression_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    synthetic_repo.add_arguments(parser)
+    parser.add_argument("--requests", type=int, default=200, help="requests per route and concurrency level")
+    parser.add_argument("--concurrency", default="1,8", help="comma-separated numbers of concurrent clients")
+    parser.add_argument("--skip-indexes", action="store_true", help="answer queries from git instead of the in-memory indexes")
+    parser.add_argument("--routes", help="comma-separated subset of routes to run")
+    parser.add_argument("--work-dir", help="directory for the repos; a temporary one by default")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=0.2,
+                        help="fractional p99 latency increase over the earlier run that fails the comparison")
+    args = parser.parse_args()
+
+    concurrency_levels = [int(x) for x in args.concurrency.split(",")]
+    case_names = args.routes.split(",") if args.routes else get_case_names()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+
+        setup_start_time = time.perf_counter()
+        set_up_mirror(work_dir, args, not args.skip_indexes)
+        print("Set up mirror in {:.1f} seconds".format(time.perf_counter() - setup_start_time))
+
+        samples = Samples(snapshots.get_read_path(), random.Random(args.seed))
+
+        results = []
+        for case_name in case_names:
+            for concurrency in concurrency_levels:
+                result = run_case(case_name, samples, args.requests, concurrency)
+                results.append(result)
+
+                print("{:<45} x{:<3} {:9.1f} req/s  p50 {:8.2f} ms  p99 {:8.2f} ms{}".format(
+                    case_name, concurrency, result["throughput_per_second"],
+                    result["latency_ms"]["p50"], result["latency_ms"]["p99"],
+                    "  ({} errors)".format(result["errors"]) if result["errors"] else ""))
+
+    parameters = {k: v for k, v in vars(args).items() if k not in ["work_dir", "output", "compare", "regression_threshold"]}
+    output = {
+        "parameters": parameters,
+        "environment": get_environment(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(output, fh, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+
+        # Results are matched up by route, so running a subset of routes is fine
+        if dict(previous["parameters"], routes=None) != dict(parameters, routes=None):
+            print("Warning: the earlier run used different parameters")
+
+        if compare_results(previous, output, args.regression_threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
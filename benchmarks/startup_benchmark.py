@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+Startup time benchmark
+
+Mirrors a synthetic origin repo, then repeatedly starts a fresh Python
+process that imports the WSGI entry point and serves one query through
+the Flask test client, as a newly started worker process would.  Each
+run reports how long the import, the first request and the warm-up
+reported by /health took, and which lazily imported modules got loaded.
+
+    benchmarks/startup_benchmark.py --output startup.json
+    benchmarks/startup_benchmark.py --output new.json --compare startup.json
+
+The OS page cache is only cold for the first run.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_repo
+
+EB_FLASK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "eb-flask")
+
+sys.path.insert(0, EB_FLASK_DIR)
+
+import git
+
+
+# Modules that should only be imported once they are needed
+LAZY_MODULES = [
+    "ht",
+    "arrow",
+    "multiprocessing.pool",
+    "asyncio",
+    "metadata_store",
+    "changed_paths",
+    "warmup",
+]
+
+# Seconds to wait for /health to report ready
+READY_TIMEOUT_SECONDS = 120
+
+# Runs in the fresh process; arguments are passed on the command line
+CHILD_SCRIPT = """
+import json, sys, threading, time
+
+start_time = time.perf_counter()
+
+# Background threads keep printing progress, so it goes to stderr,
+# leaving stdout to the result
+result_file, sys.stdout = sys.stdout, sys.stderr
+
+eb_flask_dir, clone_path, db_path, url, lazy_modules = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5].split(",")
+sys.path.insert(0, eb_flask_dir)
+
+import repos
+repos.default_repo.clone_path = clone_path
+
+import db
+db.DEFAULT_PATH = db_path
+
+import application
+
+import_time = time.perf_counter()
+loaded_lazy_modules = [m for m in lazy_modules if m in sys.modules]
+thread_count = threading.active_count()
+
+client = application.application.test_client()
+status_code = client.get(url).status_code
+first_request_time = time.perf_counter()
+
+ready_time = None
+while time.perf_counter() - start_time < {ready_timeout}:
+    if client.get("/health").status_code == 200:
+        ready_time = time.perf_counter()
+        break
+
+    time.sleep(0.01)
+
+result = {{
+    "import_seconds": import_time - start_time,
+    "first_request_seconds": first_request_time - import_time,
+    "first_request_status": status_code,
+    "ready_seconds": ready_time - start_time if ready_time else None,
+    "threads_after_import": thread_count,
+    "lazy_modules_loaded_at_import": loaded_lazy_modules,
+}}
+print(json.dumps(result), file=result_file)
+""".format(ready_timeout=READY_TIMEOUT_SECONDS)
+
+
+def set_up_mirror(work_dir, args):
+
+    origin_path = os.path.join(work_dir, "origin.git")
+    synthetic_repo.create_origin(origin_path, args.commits, args.fan_out, args.side_length, args.prs, args.pr_length, args.seed)
+
+    clone_path = os.path.join(work_dir, "mirror", "repo.git")
+    for cmd_result in [git.bare_clone(clone_path, origin_path), git.fetch_pr_refs(clone_path)]:
+        if cmd_result.return_code:
+            raise RuntimeError(cmd_result.stderr)
+
+    return clone_path
+
+
+def get_first_request_url(clone_path):
+
+    master_sha1s = subprocess.check_output([git.GIT_BINARY_PATH, "--git-dir", clone_path, "rev-list", "--max-count=2", "master"]).decode("utf-8").split()
+    return "/is-ancestor/{}/{}".format(master_sha1s[1], master_sha1s[0])
+
+
+def run_once(clone_path, db_path, url):
+
+    start_time = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", CHILD_SCRIPT, EB_FLASK_DIR, clone_path, db_path, url, ",".join(LAZY_MODULES)])
+    process_seconds = time.perf_counter() - start_time
+
+    result = json.loads(output.decode("utf-8"))
+    result["process_seconds"] = process_seconds
+    return result
+
+
+def summarize(runs, key):
+
+    values = [run[key] for run in runs if run[key] is not None]
+    if not values:
+        return None
+
+    return {
+        "median_ms": 1000 * statistics.median(values),
+        "max_ms": 1000 * max(values),
+    }
+
+
+def compare_results(previous, current, threshold):
+    """
+    Prints the change in median of each measurement, and returns the number
+    of measurements that regressed by more than the threshold fraction.
+    """
+
+    regression_count = 0
+    for key, summary in current["summary"].items():
+        old = previous["summary"].get(key)
+        if not old or not summary:
+            continue
+
+        ratio = summary["median_ms"] / old["median_ms"]
+        regressed = ratio > 1 + threshold
+        regression_count += regressed
+
+        print("{:<25} median {:6.2f}x{}".format(key, ratio, "  REGRESSED" if regressed else ""))
+
+    return regression_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    synthetic_repo.add_arguments(parser)
+    parser.add_argument("--runs", type=int, default=10, help="number of processes to start")
+    parser.add_argument("--work-dir", help="directory for the repos; a temporary one by default")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=0.2,
+                        help="fractional median increase over the earlier run that fails the comparison")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+
+        clone_path = set_up_mirror(work_dir, args)
+        url = get_first_request_url(clone_path)
+
+        runs = []
+        for i in range(args.runs):
+            # Each process starts with an empty metadata store, as after a redeploy
+            run = run_once(clone_path, os.path.join(work_dir, "database-{}.sqlite3".format(i)), url)
+            runs.append(run)
+
+            print("run {:<3} import {:8.1f} ms  first request {:8.1f} ms  ready {:>8} ms  process {:8.1f} ms{}".format(
+                i, 1000 * run["import_seconds"], 1000 * run["first_request_seconds"],
+                "{:.1f}".format(1000 * run["ready_seconds"]) if run["ready_seconds"] is not None else "-",
+                1000 * run["process_seconds"],
+                "  (loaded {})".format(", ".join(run["lazy_modules_loaded_at_import"])) if run["lazy_modules_loaded_at_import"] else ""))
+
+    summary = {key: summarize(runs, key) for key in ["import_seconds", "first_request_seconds", "ready_seconds", "process_seconds"]}
+    parameters = {k: v for k, v in vars(args).items() if k not in ["work_dir", "output", "compare", "regression_threshold"]}
+    output = {
+        "parameters": parameters,
+        "environment": {
+            "python": sys.version.split()[0],
+            "git": subprocess.check_output([git.GIT_BINARY_PATH, "--version"]).decode("utf-8").strip(),
+        },
+        "summary": summary,
+        "runs": runs,
+    }
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(output, fh, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+
+        if compare_results(previous, output, args.regression_threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
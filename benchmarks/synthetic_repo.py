@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic repositories for benchmarking
+
+Builds a bare repo that stands in for the GitHub "origin" remote, with
+a master branch, side branches merged into master, a viable/strict
+branch, and GitHub-style refs/pull/<n>/head refs.
+
+The history is written in a single "git fast-import" run, and is
+identical across runs with the same parameters and seed.
+"""
+
+import argparse
+import random
+import subprocess
+
+
+GIT_BINARY_PATH = "git"
+
+# Commit timestamps start here and advance one minute per commit,
+# so that commit sha1s are reproducible.
+START_TIMESTAMP = 1500000000
+
+# Number of distinct files touched by the generated commits
+FILE_COUNT = 50
+
+
+class FastImportStream:
+
+    def __init__(self):
+        self.chunks = []
+        self.mark_count = 0
+
+    def commit(self, ref, parent_marks, message):
+        """
+        Returns the mark of the new commit.
+        """
+
+        self.mark_count += 1
+        mark = self.mark_count
+        timestamp = START_TIMESTAMP + 60 * mark
+
+        message_bytes = message.encode("utf-8")
+        content_bytes = "{}\n".format(message).encode("utf-8")
+
+        self.chunks.append("commit {}\nmark :{}\n".format(ref, mark).encode("utf-8"))
+        self.chunks.append("author Benchmark <benchmark@example.com> {} +0000\n".format(timestamp).encode("utf-8"))
+        self.chunks.append("committer Benchmark <benchmark@example.com> {} +0000\n".format(timestamp).encode("utf-8"))
+        self.chunks.append("data {}\n".format(len(message_bytes)).encode("utf-8") + message_bytes + b"\n")
+
+        if parent_marks:
+            self.chunks.append("from :{}\n".format(parent_marks[0]).encode("utf-8"))
+            for parent_mark in parent_marks[1:]:
+                self.chunks.append("merge :{}\n".format(parent_mark).encode("utf-8"))
+
+        self.chunks.append("M 644 inline file-{}.txt\n".format(mark % FILE_COUNT).encode("utf-8"))
+        self.chunks.append("data {}\n".format(len(content_bytes)).encode("utf-8") + content_bytes + b"\n")
+
+        return mark
+
+    def reset(self, ref, mark):
+        self.chunks.append("reset {}\nfrom :{}\n\n".format(ref, mark).encode("utf-8"))
+
+    def get_bytes(self):
+        return b"".join(self.chunks)
+
+
+def build_history(commits, fan_out, side_length, prs, pr_length, seed):
+    """
+    Returns the fast-import stream for a master branch of the given
+    first-parent length.  Per 100 master commits, fan_out side
+    branches of side_length commits are forked from recent master
+    commits and merged back.
+    """
+
+    rng = random.Random(seed)
+    stream = FastImportStream()
+
+    master_marks = []
+    side_branch_count = 0
+    while len(master_marks) < commits:
+        parent_marks = master_marks[-1:]
+
+        if master_marks and rng.random() < fan_out / 100.0:
+            side_branch_count += 1
+            side_ref = "refs/heads/side/{}".format(side_branch_count)
+
+            side_marks = [rng.choice(master_marks[-50:])]
+            for i in range(side_length):
+                side_marks.append(stream.commit(side_ref, side_marks[-1:], "Side branch {} commit {}".format(side_branch_count, i)))
+
+            parent_marks = parent_marks + side_marks[-1:]
+            message = "Merge side branch {}".format(side_branch_count)
+        else:
+            message = "Master commit {}".format(len(master_marks))
+
+        master_marks.append(stream.commit("refs/heads/master", parent_marks, message))
+
+    stream.reset("refs/heads/viable/strict", master_marks[-min(10, len(master_marks))])
+
+    for pr_number in range(1, prs + 1):
+        pr_ref = "refs/pull/{}/head".format(pr_number)
+
+        pr_marks = [rng.choice(master_marks[-200:])]
+        for i in range(pr_length):
+            pr_marks.append(stream.commit(pr_ref, pr_marks[-1:], "PR {} commit {}".format(pr_number, i)))
+
+        if not pr_length:
+            stream.reset(pr_ref, pr_marks[-1])
+
+    return stream.get_bytes()
+
+
+def create_origin(path, commits=2000, fan_out=10, side_length=5, prs=500, pr_length=3, seed=0):
+
+    subprocess.run([GIT_BINARY_PATH, "init", "--quiet", "--bare", path], check=True)
+    subprocess.run([GIT_BINARY_PATH, "--git-dir", path, "symbolic-ref", "HEAD", "refs/heads/master"], check=True)
+
+    stream_bytes = build_history(commits, fan_out, side_length, prs, pr_length, seed)
+    subprocess.run([GIT_BINARY_PATH, "--git-dir", path, "fast-import", "--quiet"], input=stream_bytes, check=True)
+
+
+def add_arguments(parser):
+    parser.add_argument("--commits", type=int, default=2000, help="first-parent length of master")
+    parser.add_argument("--fan-out", type=int, default=10, help="side branches merged per 100 master commits")
+    parser.add_argument("--side-length", type=int, default=5, help="commits per side branch")
+    parser.add_argument("--prs", type=int, default=500, help="number of refs/pull/<n>/head refs")
+    parser.add_argument("--pr-length", type=int, default=3, help="commits per pull request")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", help="where to create the bare repo")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    create_origin(args.path, args.commits, args.fan_out, args.side_length, args.prs, args.pr_length, args.seed)
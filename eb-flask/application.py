@@ -1,29 +1,142 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, abort, send_from_directory
+from flask import Flask, Response, g, request, abort, send_from_directory, stream_with_context
 import json
 import hmac
 import os
+import subprocess
+import time
 
 import long_git_operations
 import short_git_operations
-import db
-import ht
+import event_queue
 import git
+import json_stream
+import metrics
+import query_cache
+import repos
+
+
+# Every route except those in UNSCOPED_ENDPOINTS is also served under
+# this prefix, acting on the named repo instead of the default one.
+REPO_SCOPE_PREFIX = "/repos/<owner>/<repo_name>"
+
+UNSCOPED_ENDPOINTS = {
+    "static",
+    "favicon",
+    "webhook_handler",
+    "diag9",
+    "diag10",
+}
 
 
 def cmd_logs_clear_operation():
+    import db
     db.clear_command_logs()
     return "Cleared."
 
 
+def get_cache_stats():
+    return short_git_operations.format_result(query_cache.get_stats())
+
+
+def list_repos():
+
+    repo_list = []
+    for repo in repos.all_repos():
+        repo_list.append({
+            "full_name": repo.full_name,
+            "clone_url": repo.clone_url,
+            "cloned": os.path.exists(repo.clone_path),
+            "clone_filter": git.get_clone_filter(repo.clone_path) if os.path.exists(repo.clone_path) else None,
+            "default": repo is repos.default_repo,
+        })
+
+    return short_git_operations.format_result(repo_list)
+
+
+def get_metrics():
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
+def wants_stream():
+    """
+    Streaming is selected with "?stream=1" or by preferring
+    newline-delimited JSON in the Accept header.
+    """
+
+    if request.args.get("stream") in ["1", "true"]:
+        return True
+
+    return request.accept_mimetypes.best_match(["application/json", json_stream.NDJSON_MIMETYPE]) == json_stream.NDJSON_MIMETYPE
+
+
+def iter_request_items():
+    """
+    Yields the items of a JSON array request body, or of a
+    newline-delimited JSON request body, as they are read.
+    """
+
+    if request.mimetype == json_stream.NDJSON_MIMETYPE:
+        return json_stream.iter_ndjson(request.stream)
+
+    return json_stream.iter_json_array(request.stream)
+
+
+def stream_records(records):
+    return Response(stream_with_context(json_stream.iter_ndjson_lines(records)), mimetype=json_stream.NDJSON_MIMETYPE)
+
+
+def stream_request_records(records_func):
+    """
+    Streams the records that records_func produces from the request
+    items.  The response has already started when an invalid item is
+    read, so parse errors are written as a final error record.
+    """
+
+    items = json_stream.CheckedItems(iter_request_items())
+
+    def iter_records():
+        yield from records_func(items)
+        if items.error:
+            yield short_git_operations.format_error("Invalid request body: {}".format(items.error))
+
+    return stream_records(iter_records())
+
+
+# HTML rendering, and the date formatting library that it uses, are
+# only imported by the diagnostics pages, so that processes which only
+# answer queries start faster.  Likewise for the database and the
+# warm-up state, which most requests do not touch.
+
+def get_health():
+    import warmup
+    return warmup.get_health()
+
+
+def render_index():
+    import ht
+    return ht.header_text + "<h2>Operational status</h2>" + long_git_operations.render_status() + ht.get_instructions() + ht.footer_text
+
+
+def dump_command_logs(cmd):
+    import ht
+    return ht.dump_command_logs(cmd)
+
+
+def dump_github_event_logs():
+    import ht
+    return ht.dump_github_event_logs()
+
+
 def generate_rules(app):
-    app.add_url_rule('/', 'index', (lambda: ht.header_text + "<h2>Operational status</h2>" + long_git_operations.render_status() + ht.get_instructions() + ht.footer_text))
+    app.add_url_rule('/', 'index', render_index)
 
     # Actions
     app.add_url_rule('/git-clone', 'action1', long_git_operations.do_git_clone)
     app.add_url_rule('/pr-fetch', 'action2', long_git_operations.do_pr_fetch)
     app.add_url_rule('/restore-head', 'action3', git.restore_head_ref)
+    app.add_url_rule('/maintenance', 'action4', long_git_operations.do_maintenance)
 
     # Queries
     app.add_url_rule('/commit-distance/<base>/<branch>', 'query1', short_git_operations.git_commit_distance)
@@ -32,12 +145,47 @@ def generate_rules(app):
     app.add_url_rule('/head-of-pull-requests/<commit>', 'query4', short_git_operations.git_pointing_prs)
     app.add_url_rule('/is-ancestor/<ancestor>/<descendant>', 'query5', short_git_operations.query_ancestry_hexadecimal_only)
     app.add_url_rule('/rev-parse/<ref>', 'query6', short_git_operations.single_rev_parse)
+    app.add_url_rule('/changed-paths/<commit>', 'query7', short_git_operations.git_changed_paths)
+    app.add_url_rule('/pr-changed-paths/<pr>', 'query8', short_git_operations.pull_request_changed_paths)
 
     # Diagnostics
-    app.add_url_rule('/action-logs/<cmd>', 'diag1', ht.dump_command_logs)
-    app.add_url_rule('/github-event-logs', 'diag2', ht.dump_github_event_logs)
+    app.add_url_rule('/action-logs/<cmd>', 'diag1', dump_command_logs)
+    app.add_url_rule('/github-event-logs', 'diag2', dump_github_event_logs)
     app.add_url_rule('/clear-logs', 'diag3', cmd_logs_clear_operation)
     app.add_url_rule('/last-fetch-time', 'diag4', long_git_operations.get_last_fetch_time)
+    app.add_url_rule('/last-fetch-changes', 'diag5', long_git_operations.get_last_fetch_changes)
+    app.add_url_rule('/fetch-queue', 'diag6', long_git_operations.get_fetch_queue_stats)
+    app.add_url_rule('/cache-stats', 'diag7', get_cache_stats)
+    app.add_url_rule('/metrics', 'diag8', get_metrics)
+    app.add_url_rule('/repos', 'diag9', list_repos)
+    app.add_url_rule('/health', 'diag10', get_health)
+
+
+def add_repo_scoped_rules(app):
+    """
+    Must be called once every route has been defined.
+    """
+
+    for rule in list(app.url_map.iter_rules()):
+        if rule.endpoint not in UNSCOPED_ENDPOINTS:
+            app.add_url_rule(REPO_SCOPE_PREFIX + rule.rule, rule.endpoint, methods=rule.methods)
+
+
+def get_scoped_repo(view_args):
+    """
+    Removes the repo from the URL parameters of a repo-scoped route.
+    Returns None for unscoped routes.
+    """
+
+    if not view_args or "owner" not in view_args:
+        return None
+
+    full_name = view_args.pop("owner") + "/" + view_args.pop("repo_name")
+    repo = repos.get(full_name)
+    if repo is None:
+        abort(404, "Repository {} is not mirrored".format(full_name))
+
+    return repo
 
 
 # EB looks for an 'application' callable by default.
@@ -46,11 +194,58 @@ application = Flask(__name__)
 generate_rules(application)
 
 
-def event_should_trigger_fetch(event_type, payload, event_record_id):
+@application.before_request
+def start_background_work():
+    long_git_operations.start_background_work()
+
+
+@application.before_request
+def start_request_timer():
+    g.request_start_time = time.monotonic()
+
+
+@application.before_request
+def select_repo():
+
+    repo = get_scoped_repo(request.view_args)
+    if repo is not None:
+        g.repo_token = repos.current_repo.set(repo)
+
+
+@application.teardown_request
+def restore_repo(exception):
+
+    repo_token = g.pop("repo_token", None)
+    if repo_token is not None:
+        repos.current_repo.reset(repo_token)
+
+
+@application.after_request
+def record_request_metrics(response):
+
+    # Labelled by the route pattern, not the path, to bound the number of series
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+
+    metrics.REQUESTS.inc(route, request.method, response.status_code)
+    metrics.REQUEST_SECONDS.observe(time.monotonic() - g.request_start_time, route, request.method)
+    return response
+
+
+@application.errorhandler(json_stream.InvalidJsonError)
+def handle_invalid_request_body(e):
+    return short_git_operations.format_error("Invalid request body: {}".format(e)), 400
+
+
+def get_event_fetch_refspecs(event_type, payload):
+    """
+    Returns the refspecs that need to be fetched in response
+    to the event, or None if the event should not trigger a fetch.
+    """
+
     if event_type == "push":
         pushed_ref = payload["ref"]
         print("pushed ref:", pushed_ref)
-        return True
+        return git.refspecs_for_pushed_ref(pushed_ref)
 
     elif event_type == "pull_request":
 
@@ -59,9 +254,87 @@ def event_should_trigger_fetch(event_type, payload, event_record_id):
         print("Pull request event details :: action:", pr_action, "; number:", pr_number)
 
         if pr_action in ["opened", "edited", "reopened", "synchronize"]:
-            return True
+            return git.refspecs_for_pull_request(pr_number)
+
+    return None
+
+
+def process_github_events(events):
+    """
+    Queues a single fetch per repo covering every ref of that repo
+    that a batch of events affects, then logs the events.  A failure
+    to log them does not lose the fetches.
+    """
+    import db
+
+    refspecs_by_repo_name = {}
+    for event_type, payload_bytes in events:
+        try:
+            payload = json.loads(payload_bytes)
+            repo_full_name = payload["repository"]["full_name"]
+            refspecs = get_event_fetch_refspecs(event_type, payload)
+        except (ValueError, KeyError, TypeError) as e:
+            print("Could not process %s event: %s" % (event_type, e))
+            continue
+
+        repo = repos.get(repo_full_name)
+        if repo is None:
+            print("Ignoring %s event for unmirrored repo %s" % (event_type, repo_full_name))
+            continue
+
+        if refspecs:
+            refspecs_by_repo_name.setdefault(repo.full_name, set()).update(refspecs)
+
+    for repo_full_name, batch_refspecs in sorted(refspecs_by_repo_name.items()):
+        print("Refspecs to fetch for %s:" % repo_full_name, sorted(batch_refspecs))
+
+        # Requests that arrive while a fetch is pending or ongoing
+        # are merged into the next fetch of the same repo.
+        with repos.use(repos.get(repo_full_name)):
+            response_dict = long_git_operations.do_pr_fetch(sorted(batch_refspecs))
+
+        print("Queued re-fetch with response:", response_dict)
+
+    try:
+        db.insert_events([event_type for event_type, _ in events])
+    except Exception as e:
+        print("Could not log %d events: %s" % (len(events), e))
+
+
+github_event_queue = event_queue.EventQueue(process_github_events)
+
+
+def collect_indexed_commits():
+    import commit_graph
+    return [((repo_full_name,), len(index)) for repo_full_name, index in commit_graph.indexes.items()]
 
-    return False
+
+def register_metric_collectors():
+
+    def cache_stat(key):
+        def collect():
+            samples = []
+            for repo_full_name, repo_caches in query_cache.caches.items():
+                samples.append(((repo_full_name, "immutable"), repo_caches.immutable.get_stats()[key]))
+                samples.append(((repo_full_name, "ref_dependent"), repo_caches.ref_dependent.get_stats()[key]))
+
+            return samples
+
+        return collect
+
+    metrics.register_collector("gadgit_query_cache_hits_total", "counter", "Query cache hits", ["repo", "cache"], cache_stat("hits"))
+    metrics.register_collector("gadgit_query_cache_misses_total", "counter", "Query cache misses", ["repo", "cache"], cache_stat("misses"))
+    metrics.register_collector("gadgit_query_cache_entries", "gauge", "Entries in the query cache", ["repo", "cache"], cache_stat("entries"))
+
+    metrics.register_collector("gadgit_indexed_commits", "gauge", "Commits in the commit graph index", ["repo"],
+                               collect_indexed_commits)
+    metrics.register_collector("gadgit_fetch_queue_depth", "gauge", "Fetch requests waiting to be merged into the next fetch", ["repo"],
+                               lambda: [((repo_full_name,), state.fetch_scheduler.get_stats()["queue_depth"]) for repo_full_name, state in long_git_operations.mirror_states.items()])
+    metrics.register_collector("gadgit_event_queue_depth", "gauge", "Webhook events waiting to be processed", [],
+                               lambda: [((), github_event_queue.depth())])
+
+
+register_metric_collectors()
 
 
 def enforce_signature(req):
@@ -114,37 +387,126 @@ def webhook_handler():
 
     event_type = request.headers['X-GitHub-Event']
 
-    event_record_id = db.insert_event(event_type)
-    # print("Inserted %s event with row ID %d" % (event_type, event_record_id))
+    # Logging and fetching happen on a background thread.
+    github_event_queue.put(event_type, request.get_data())
 
-    payload = json.loads(request.get_data())
+    return "", 202, None
 
-    should_fetch = event_should_trigger_fetch(event_type, payload, event_record_id)
-    print("Should fetch?", should_fetch)
-    if should_fetch:
-        # This is idempotent; if there is already an ongoing fetch,
-        # it will just return without doing anything.
 
-        print("About to re-fetch...")
-        response_dict = long_git_operations.do_pr_fetch()
-        print("Finished re-fetch with response:", response_dict)
+@application.route('/commit-metadata', methods=['POST'])
+def handle_batch_commit_metadata_request():
 
-    return "", 200, None
+    if wants_stream():
+        return stream_request_records(short_git_operations.iter_metadata)
 
+    payload = list(iter_request_items())
+    try:
+        metadata_list = short_git_operations.fetch_metadata_batch(payload)
+    except (git.cat_file_pool.CatFileError, subprocess.CalledProcessError) as e:
+        return short_git_operations.format_error(str(e))
 
-@application.route('/commit-metadata', methods=['POST'])
-def handle_batch_commit_metadata_request():
+    return short_git_operations.format_result(metadata_list)
 
-    payload = json.loads(request.get_data())
-    metadata_list = short_git_operations.fetch_metadata_batch(payload)
 
-    # TODO: Error handling
-    mydict = {
-        "status": "complete",
-        "success": True,
-        "result": metadata_list,
-    }
-    return mydict
+@application.route('/changed-paths', methods=['POST'])
+def handle_batch_changed_paths_request():
+    """
+    To test:
+
+    curl --data '["0c7537c", "0c7537c~"]' http://localhost:5000/changed-paths
+
+    With "?stream=1", each commit's paths are written on their own line.
+    """
+
+    if wants_stream():
+        return stream_request_records(short_git_operations.iter_changed_paths)
+
+    try:
+        entries = short_git_operations.fetch_changed_paths_batch(list(iter_request_items()))
+    except (git.cat_file_pool.CatFileError, subprocess.CalledProcessError) as e:
+        return short_git_operations.format_error(str(e))
+
+    return short_git_operations.format_result(entries)
+
+
+@application.route('/path-commits', methods=['GET'])
+def path_commits_handler():
+    """
+    To test:
+
+    curl 'http://localhost:5000/path-commits?path=torch/csrc/jit&limit=20'
+
+    With "&ref=master", only commits reachable from the ref are listed.
+    """
+
+    return short_git_operations.path_commits(request.args.get('path'), request.args.get('limit'), request.args.get('ref'))
+
+
+@application.route('/master-commit-metadata', methods=['GET'])
+def master_commit_metadata_handler():
+    """
+    To test:
+
+    curl 'http://localhost:5000/master-commit-metadata?since=2020-01-01&until=2020-02-01'
+
+    With "?stream=1", each commit's metadata is written on its own line.
+    """
+
+    error_result, metadata_iter = short_git_operations.prepare_master_commit_metadata(request.args.get('since'), request.args.get('until'))
+    if error_result:
+        return error_result
+
+    if wants_stream():
+        return stream_records(metadata_iter)
+
+    return short_git_operations.format_result(list(metadata_iter))
+
+
+def range_query_response(error_result, records):
+
+    if error_result:
+        return error_result
+
+    if wants_stream():
+        return stream_records(records)
+
+    return short_git_operations.collect_range_page(records)
+
+
+@application.route('/commit-range/<base>/<branch>', methods=['GET'])
+def commit_range_handler(base, branch):
+    """
+    Lists the commits counted by /commit-distance, newest first.
+
+    To test:
+
+    curl 'http://localhost:5000/commit-range/v1.4.0/master?fields=subject,author_name&limit=50'
+
+    The result holds a page of commits and a "next_cursor", which is
+    passed as "?cursor=" to get the following page.  With "?stream=1",
+    each commit is written on its own line, and the whole range is
+    written unless a limit is given.
+    """
+
+    streamed = wants_stream()
+    return range_query_response(*short_git_operations.prepare_commit_range(
+        base, branch, request.args.get('cursor'), request.args.get('limit'), request.args.get('fields'), streamed))
+
+
+@application.route('/pr-commits/<pr>', methods=['GET'])
+def pull_request_commits_handler(pr):
+    """
+    Lists the commits of a PR since its merge base with master,
+    paginated in the same way as /commit-range.
+
+    To test:
+
+    curl 'http://localhost:5000/pr-commits/12345?fields=subject'
+    """
+
+    streamed = wants_stream()
+    return range_query_response(*short_git_operations.prepare_pull_request_commits(
+        pr, request.args.get('cursor'), request.args.get('limit'), request.args.get('fields'), streamed))
 
 
 @application.route('/bulk-rev-parse', methods=['POST'])
@@ -153,15 +515,21 @@ def handle_batch_rev_parse_request():
     To test:
 
     curl --data '["0c7537c~", "0c7537c~2"]' http://localhost:5000/bulk-rev-parse
+
+    With "?stream=1", each ref is written as an {"ref", "output"}
+    record on its own line as soon as it is resolved.
     """
 
-    refs = json.loads(request.get_data())
-    cmd_result = git.parse_bulk_refs(git.CLONE_PATH, refs)
+    if wants_stream():
+        return stream_request_records(short_git_operations.iter_ref_resolutions)
 
-    def value_process_func(result):
+    refs = list(iter_request_items())
+    outputs = short_git_operations.resolve_refs_individually(refs)
+
+    def value_process_func(commit_sha1s):
         ref_associations = []
 
-        for ref, commit_sha1 in zip(refs, result.stdout.splitlines()):
+        for ref, commit_sha1 in zip(refs, commit_sha1s):
             mydict = {
                 "ref": ref,
                 "commit_sha1": commit_sha1,
@@ -171,7 +539,43 @@ def handle_batch_rev_parse_request():
 
         return ref_associations
 
-    return short_git_operations.format_query_result(cmd_result, value_process_func)
+    return short_git_operations.combine_outputs(outputs, value_process_func)
+
+
+# Has individual error handling on each pair
+@application.route('/bulk-is-ancestor', methods=['POST'])
+def handle_batch_ancestry_request():
+    """
+    To test:
+
+    curl --data '[["0c7537c~", "0c7537c"], ["0c7537c", "0c7537c~"]]' http://localhost:5000/bulk-is-ancestor
+
+    With "?stream=1", each pair's entry is written on its own line.
+    """
+
+    if wants_stream():
+        return stream_request_records(short_git_operations.iter_ancestry_results)
+
+    pairs = list(iter_request_items())
+    return short_git_operations.format_result(short_git_operations.bulk_query_ancestry(pairs))
+
+
+# Has individual error handling on each commit
+@application.route('/bulk-master-merge-base', methods=['POST'])
+def handle_batch_master_merge_base_request():
+    """
+    To test:
+
+    curl --data '["f5d59f654ab1a8193fb40541cbd98eed86346b7d", "9999999"]' http://localhost:5000/bulk-master-merge-base
+
+    With "?stream=1", each commit's entry is written on its own line.
+    """
+
+    if wants_stream():
+        return stream_request_records(short_git_operations.iter_master_merge_bases)
+
+    commits = list(iter_request_items())
+    return short_git_operations.format_result(short_git_operations.bulk_master_merge_base(commits))
 
 
 # Has individual error handling on each PR
@@ -183,17 +587,17 @@ def handle_batch_pull_request_heads_request():
     curl --data '[22201, 23463, 9999999]' http://localhost:5000/bulk-pull-request-heads
     """
 
-    pr_numbers = json.loads(request.get_data())
+    if wants_stream():
+        return stream_request_records(short_git_operations.iter_pull_request_heads)
 
-    results = []
-    for pr_number in pr_numbers:
-        ref = git.PR_REF_TEMPLATE % pr_number
-        cmd_result = git.parse_bulk_refs(git.CLONE_PATH, [ref])
-        formatted_result = short_git_operations.format_query_result(cmd_result)
+    pr_numbers = list(iter_request_items())
+    outputs = short_git_operations.resolve_pull_request_heads(pr_numbers)
 
+    results = []
+    for pr_number, output in zip(pr_numbers, outputs):
         entry_dict = {
             "pr_number": pr_number,
-            "output": formatted_result,
+            "output": output,
         }
         results.append(entry_dict)
 
@@ -212,19 +616,22 @@ def handle_batch_pull_request_heads_simple_request():
     """
     To test:
 
-    curl --data '[22201, 23463]' http://localhost:5000/bulk-pull-request-heads
+    curl --data '[22201, 23463]' http://localhost:5000/bulk-pull-request-heads-simple
+
+    Streamed responses have the same records as /bulk-pull-request-heads.
     """
 
-    pr_numbers = json.loads(request.get_data())
-    pr_refs = list(map(lambda x: git.PR_REF_TEMPLATE % x, pr_numbers))
+    if wants_stream():
+        return stream_request_records(short_git_operations.iter_pull_request_heads)
 
-    cmd_result = git.parse_bulk_refs(git.CLONE_PATH, pr_refs)
+    pr_numbers = list(iter_request_items())
+    outputs = short_git_operations.resolve_pull_request_heads(pr_numbers)
 
-    def value_process_func(result):
+    def value_process_func(head_commits):
 
         pr_head_associations = []
 
-        for pr_number, head_commit in zip(pr_numbers, result.stdout.splitlines()):
+        for pr_number, head_commit in zip(pr_numbers, head_commits):
             mydict = {
                 "pr_number": pr_number,
                 "head_commit": head_commit,
@@ -234,7 +641,7 @@ def handle_batch_pull_request_heads_simple_request():
 
         return pr_head_associations
 
-    return short_git_operations.format_query_result(cmd_result, value_process_func)
+    return short_git_operations.combine_outputs(outputs, value_process_func)
 
 
 @application.route('/favicon.ico')
@@ -243,7 +650,11 @@ def favicon():
                                'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
 
+add_repo_scoped_rules(application)
+
+
 if __name__ == "__main__":
+    import db
 
     db.initialize_db()
 
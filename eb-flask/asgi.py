@@ -0,0 +1,178 @@
+"""
+ASGI serving mode
+
+Serves the routes registered by application.generate_rules() from
+an ASGI server, for example:
+
+    uvicorn asgi:application
+
+Queries run as coroutines on the event loop, so that a query waiting
+on a git process does not hold a thread.  The remaining routes, which
+only touch the database or hand work to background threads, run in the
+event loop's default thread pool.
+
+The webhook and bulk POST endpoints are only served by the WSGI application.
+"""
+
+import datetime
+import json
+import time
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date
+from werkzeug.routing import Map, Rule, RequestRedirect
+
+import application as wsgi_application
+import async_git_operations
+import long_git_operations
+import metrics
+import repos
+
+
+ASYNC_VIEW_FUNCTIONS = {
+    'query1': async_git_operations.git_commit_distance,
+    'query2': async_git_operations.git_pull_request_head_commit,
+    'query3': async_git_operations.git_master_merge_base,
+    'query4': async_git_operations.git_pointing_prs,
+    'query5': async_git_operations.query_ancestry_hexadecimal_only,
+    'query6': async_git_operations.single_rev_parse,
+}
+
+
+class RuleCollector:
+    """
+    Stands in for the Flask app in generate_rules().
+    """
+
+    def __init__(self):
+        self.url_map = Map()
+        self.view_functions = {}
+
+    def add_url_rule(self, rule, endpoint, view_func):
+        # Like Flask, only GET (and implicitly HEAD) is allowed
+        self.url_map.add(Rule(rule, endpoint=endpoint, methods=["GET"]))
+        if endpoint not in wsgi_application.UNSCOPED_ENDPOINTS:
+            self.url_map.add(Rule(wsgi_application.REPO_SCOPE_PREFIX + rule, endpoint=endpoint, methods=["GET"]))
+
+        self.view_functions[endpoint] = view_func
+
+
+rules = RuleCollector()
+wsgi_application.generate_rules(rules)
+
+
+def json_default(value):
+    """
+    Encodes dates as Flask's JSON provider does.
+    """
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return http_date(value)
+
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def render_response(value):
+    """
+    Converts a view's return value the same way Flask does
+    for the value types that the views produce.
+    """
+
+    status = 200
+    headers = {}
+    if isinstance(value, tuple):
+        if len(value) > 2:
+            headers = value[2]
+
+        value, status = value[:2]
+
+    if isinstance(value, dict):
+        body = json.dumps(value, sort_keys=True, default=json_default).encode("utf-8")
+        content_type = "application/json"
+    else:
+        body = str(value).encode("utf-8")
+        content_type = "text/html; charset=utf-8"
+
+    headers = {k.lower(): v for k, v in headers.items()}
+    headers.setdefault("content-type", content_type)
+
+    return status, [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()], body
+
+
+async def call_view(path, method):
+    """
+    Returns the route pattern along with the response.
+    """
+
+    adapter = rules.url_map.bind("localhost")
+    try:
+        rule, view_args = adapter.match(path, method, return_rule=True)
+    except RequestRedirect as e:
+        return "unmatched", (308, [(b"location", e.new_url.encode("latin-1"))], b"")
+    except HTTPException as e:
+        return "unmatched", (e.code, [(b"content-type", b"text/plain; charset=utf-8")], e.description.encode("utf-8"))
+
+    try:
+        repo = wsgi_application.get_scoped_repo(view_args)
+    except HTTPException as e:
+        return rule.rule, (e.code, [(b"content-type", b"text/plain; charset=utf-8")], e.description.encode("utf-8"))
+
+    # Each request runs in its own task, so this does not leak into other requests
+    if repo is not None:
+        repos.current_repo.set(repo)
+
+    endpoint = rule.endpoint
+    async_view_func = ASYNC_VIEW_FUNCTIONS.get(endpoint)
+    if async_view_func:
+        value = await async_view_func(**view_args)
+    else:
+        value = await async_git_operations.run_blocking(rules.view_functions[endpoint], **view_args)
+
+    return rule.rule, render_response(value)
+
+
+async def handle_lifespan(receive, send):
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            long_git_operations.start_background_work()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+
+    if scope["type"] == "lifespan":
+        return await handle_lifespan(receive, send)
+
+    if scope["type"] != "http":
+        return
+
+    # For servers that do not send lifespan events
+    long_git_operations.start_background_work()
+
+    start_time = time.monotonic()
+    try:
+        route, (status, headers, body) = await call_view(scope["path"], scope["method"])
+    except Exception as e:
+        print("Error serving {}: {}".format(scope["path"], e))
+        route = "unmatched"
+        status, headers, body = 500, [(b"content-type", b"text/plain; charset=utf-8")], b"Internal Server Error"
+
+    metrics.REQUESTS.inc(route, scope["method"], status)
+    metrics.REQUEST_SECONDS.observe(time.monotonic() - start_time, route, scope["method"])
+
+    headers.append((b"content-length", str(len(body)).encode("latin-1")))
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    await send({
+        "type": "http.response.body",
+        "body": body,
+    })
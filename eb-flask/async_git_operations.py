@@ -0,0 +1,135 @@
+"""
+Asynchronous short Git operations
+
+Counterparts of the queries in short_git_operations for the ASGI
+serving mode.  Queries are answered from the in-memory indexes where
+possible, exactly as in the synchronous versions, and otherwise await
+a git process rather than blocking a thread on it.
+
+Index lookups may still block, on a persistent "cat-file" worker or
+on loading the PR ref table, so they run on executor threads to keep
+the event loop free for other requests.
+
+The results share the synchronous versions' cache entries.
+"""
+
+import asyncio
+import contextvars
+import functools
+
+import git
+import query_cache
+import repos
+import snapshots
+import short_git_operations
+
+
+# Git processes allowed to run at once on each repo;
+# further queries wait for a slot as coroutines.
+MAX_CONCURRENT_COMMANDS = 8
+
+
+# Keyed by repo rather than directory, since each snapshot has its own
+command_semaphores_by_repo_name = {}
+
+
+def command_runner():
+    """
+    Returns a replacement for git.get_command_result that limits
+    the number of concurrent processes on the current repo.
+    """
+
+    repo_full_name = repos.current().full_name
+    semaphore = command_semaphores_by_repo_name.get(repo_full_name)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS)
+        command_semaphores_by_repo_name[repo_full_name] = semaphore
+
+    async def run_command(cmd_args, stdin_text=None):
+        async with semaphore:
+            return await git.get_command_result_async(cmd_args, stdin_text)
+
+    return run_command
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a synchronous function on an executor thread,
+    in the context of the current request's repo.
+    """
+
+    # Executor threads do not inherit the task's context
+    blocking_func = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, blocking_func)
+
+
+@query_cache.cached_query()
+async def git_commit_distance(base, branch):
+
+    result = await run_blocking(short_git_operations.commit_distance_from_index, base, branch)
+    if result is None:
+        cmd_result = await git.commit_distance(snapshots.get_read_path(), base, branch, command_runner())
+        result = short_git_operations.format_commit_distance_result(cmd_result)
+
+    return result
+
+
+async def git_pull_request_head_commit(pr):
+    """
+    Answered from the PR ref table or a persistent "cat-file"
+    worker, neither of which starts a process.
+    """
+
+    return await run_blocking(short_git_operations.git_pull_request_head_commit, pr)
+
+
+@query_cache.cached_query(ref_dependent=True)
+async def git_master_merge_base(commit):
+
+    result = await run_blocking(short_git_operations.master_merge_base_from_index, commit)
+    if result is None:
+        cmd_result = await git.master_merge_base(snapshots.get_read_path(), commit, command_runner())
+        result = short_git_operations.format_query_result(cmd_result)
+
+    return result
+
+
+@query_cache.cached_query(ref_dependent=True)
+async def git_pointing_prs(commit):
+
+    result = await run_blocking(short_git_operations.pointing_prs_from_index, commit)
+    if result is None:
+        cmd_result = await git.current_pointing_prs(snapshots.get_read_path(), commit, command_runner())
+        result = short_git_operations.format_pointing_prs_result(cmd_result)
+
+    return result
+
+
+async def query_ancestry_hexadecimal_only(ancestor, descendant):
+
+    if not short_git_operations.is_hex_string(ancestor):
+        return short_git_operations.format_error("ancestor commit {} is not a hexadecimal string".format(ancestor))
+
+    if not short_git_operations.is_hex_string(descendant):
+        return short_git_operations.format_error("descendant commit {} is not a hexadecimal string".format(descendant))
+
+    return await query_ancestry(ancestor, descendant)
+
+
+@query_cache.cached_query()
+async def query_ancestry(ancestor, descendant):
+
+    result = await run_blocking(short_git_operations.ancestry_from_index, ancestor, descendant)
+    if result is None:
+        cmd_result = await git.is_git_ancestor(snapshots.get_read_path(), ancestor, descendant, command_runner())
+        result = short_git_operations.format_ancestry_result(cmd_result, ancestor, descendant)
+
+    return result
+
+
+async def single_rev_parse(ref):
+    """
+    Answered by a persistent "cat-file" worker.
+    """
+
+    return await run_blocking(short_git_operations.single_rev_parse, ref)
@@ -0,0 +1,193 @@
+"""
+Persistent "git cat-file" worker processes
+
+Starting a git process costs far more than the object lookup itself on a
+large repo, since each new process must load the packfile indexes.
+These workers stay attached to a repo and answer one query per line.
+"""
+
+import queue
+import subprocess
+import threading
+
+import metrics
+
+POOL_SIZE = 4
+
+BATCH_CHECK_FORMAT = "%(objectname) %(objecttype)"
+
+
+class CatFileError(Exception):
+    pass
+
+
+class CatFileWorker:
+    """
+    Wraps a single "git cat-file --batch-check" process.
+    Not thread-safe; the pool lends each worker to one thread at a time.
+    """
+
+    def __init__(self, git_binary_path, git_objdir, generation):
+        self.generation = generation
+
+        cmd_args = [
+            git_binary_path,
+            '--git-dir', git_objdir,
+            'cat-file',
+            '--batch-check=' + BATCH_CHECK_FORMAT,
+        ]
+
+        metrics.GIT_COMMANDS.inc("cat-file")
+        self.process = subprocess.Popen(
+            cmd_args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+
+    def _send(self, revision):
+        try:
+            self.process.stdin.write(revision.encode("utf-8") + b"\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise CatFileError("cat-file worker is not accepting input: " + str(e))
+
+    def _read_header(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise CatFileError("cat-file worker exited with code {}".format(self.process.wait()))
+
+        return line.decode("utf-8").rstrip("\n")
+
+    def check(self, revision):
+        """
+        Returns a (full sha1, object type) pair, or (None, reason)
+        if the revision does not name an object.
+        """
+
+        self._send(revision)
+
+        # Unresolvable lines take the form "<revision> missing", and the
+        # revision itself may contain spaces, so split from the right.
+        objectname, objecttype = self._read_header().rsplit(" ", 1)
+        if objecttype in ["missing", "ambiguous"]:
+            return None, objecttype
+
+        return objectname, objecttype
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+        self.process.wait()
+
+
+class CatFilePool:
+    """
+    Lends out long-lived workers to request handler threads.
+
+    Calling restart() retires every worker, so that objects and refs
+    written by a fetch are visible to subsequent queries.
+    """
+
+    def __init__(self, git_binary_path, git_objdir, pool_size=POOL_SIZE):
+        self.git_binary_path = git_binary_path
+        self.git_objdir = git_objdir
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.idle_workers = queue.LifoQueue()
+        self.capacity = threading.BoundedSemaphore(pool_size)
+
+    def _checkout(self):
+        while True:
+            try:
+                worker = self.idle_workers.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    generation = self.generation
+                return CatFileWorker(self.git_binary_path, self.git_objdir, generation)
+
+            if worker.generation == self.generation and worker.process.poll() is None:
+                return worker
+
+            worker.close()
+
+    def _checkin(self, worker, healthy):
+        if healthy and worker.generation == self.generation:
+            self.idle_workers.put(worker)
+        else:
+            worker.close()
+
+    def resolve(self, revisions):
+        """
+        Resolves each revision to a (full sha1, object type) pair.
+        Unresolvable revisions map to (None, reason).
+        """
+
+        with self.capacity:
+            worker = self._checkout()
+
+            healthy = False
+            try:
+                results = []
+                for revision in revisions:
+                    # Input is line-delimited, so a revision containing
+                    # a newline can never name an object.
+                    if "\n" in revision:
+                        results.append((None, "missing"))
+                    else:
+                        results.append(worker.check(revision))
+
+                healthy = True
+                return results
+
+            finally:
+                self._checkin(worker, healthy)
+
+    def restart(self):
+        with self.lock:
+            self.generation += 1
+
+        # Busy workers are retired as they are checked back in
+        while True:
+            try:
+                self.idle_workers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+pools_by_objdir = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(git_binary_path, git_objdir):
+
+    with pools_lock:
+        pool = pools_by_objdir.get(git_objdir)
+        if pool is None:
+            pool = CatFilePool(git_binary_path, git_objdir)
+            pools_by_objdir[git_objdir] = pool
+
+        return pool
+
+
+def restart(git_objdir):
+
+    with pools_lock:
+        pool = pools_by_objdir.get(git_objdir)
+
+    if pool:
+        pool.restart()
+
+
+def discard(git_objdir):
+    """
+    Stops the workers of a repo that will no longer be queried.
+    """
+
+    with pools_lock:
+        pool = pools_by_objdir.pop(git_objdir, None)
+
+    if pool:
+        pool.restart()
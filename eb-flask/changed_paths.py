@@ -0,0 +1,77 @@
+"""
+Persistent changed-paths index
+
+Keeps the paths changed by every indexed commit, compared with its
+first parent, in the commit_changed_paths table of the database, along
+with the reverse mapping from path to commits in the path_commits table.
+
+The index is filled with newly indexed commits after each fetch.
+"""
+
+import sqlite3
+import subprocess
+
+import db
+import git
+import repos
+
+
+# Commits read from git and committed per transaction
+FILL_CHUNK_SIZE = 5000
+
+
+def fill(git_objdir, sha1s):
+    """
+    Stores the paths of those commits that are not stored yet.
+    Returns the number of commits added.
+    """
+
+    repo_name = repos.current().full_name
+    missing_sha1s = sorted(set(sha1s) - db.get_sha1s_with_changed_paths(repo_name, sha1s))
+
+    for i in range(0, len(missing_sha1s), FILL_CHUNK_SIZE):
+        chunk = missing_sha1s[i:i + FILL_CHUNK_SIZE]
+        db.insert_changed_paths(repo_name, dict(git.iter_changed_paths(git_objdir, chunk)))
+
+    return len(missing_sha1s)
+
+
+def fill_after_indexing(git_objdir, new_sha1s):
+    """
+    Failing to fill the index is not fatal, since
+    changed-path requests fall back to git.
+    """
+
+    try:
+        added_count = fill(git_objdir, new_sha1s)
+        print("Stored changed paths of %d commits of %s" % (added_count, repos.current().full_name))
+    except (sqlite3.Error, subprocess.CalledProcessError) as e:
+        print("Could not store changed paths of %s: %s" % (repos.current().full_name, e))
+
+
+def lookup(sha1s):
+    """
+    Returns a dict of path lists keyed by sha1, for the commits that are stored.
+    """
+
+    return db.get_changed_paths(repos.current().full_name, sha1s)
+
+
+def remember(paths_by_sha1):
+    """
+    Stores paths that were read from git to answer a
+    request, without waiting for them to be committed.
+    """
+
+    db.insert_changed_paths_buffered(repos.current().full_name, paths_by_sha1)
+
+
+def get_recent_commits(path, limit):
+    """
+    Returns {"sha1", "committer_date"} entries for the stored commits that
+    changed the path or anything below it, newest first.  Commits are
+    ordered by the metadata store, which is filled alongside this index.
+    """
+
+    rows = db.get_recent_commits_by_path(repos.current().full_name, path, limit)
+    return [{"sha1": sha1, "committer_date": committer_date} for sha1, committer_date in rows]
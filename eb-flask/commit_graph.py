@@ -0,0 +1,240 @@
+"""
+In-memory commit graph index
+
+Maps each commit reachable from the repo's branches and PR refs to a
+compact integer id, and stores its parents and generation number, so
+that ancestry questions can be answered without starting a git process.
+
+The generation number of a commit is one more than the greatest
+generation number among its parents, so a commit can only be an
+ancestor of commits with strictly greater generation numbers.
+"""
+
+import array
+import heapq
+import threading
+
+import git
+import repos
+
+
+INDEXED_REF_PATTERNS = [
+    "refs/heads/",
+    "refs/remotes/",
+]
+
+# Paint flags for merge-base traversal
+FROM_FIRST = 1
+FROM_SECOND = 2
+
+
+class CommitGraphIndex:
+    """
+    Readers do not take the lock; a commit only becomes visible in
+    ids_by_sha1 after its parents and generation number are stored.
+    """
+
+    def __init__(self):
+        self.update_lock = threading.Lock()
+        self.ids_by_sha1 = {}
+        self.sha1s = []
+        self.parents = []
+        self.generations = array.array('L')
+
+        # Ref name -> sha1 as of the last update; everything
+        # reachable from these is already indexed.
+        self.indexed_refs = {}
+
+        # Commits indexed by extend() that no indexed ref reaches yet
+        self.unreferenced_sha1s = set()
+
+    def __len__(self):
+        return len(self.sha1s)
+
+    def lookup(self, sha1):
+        return self.ids_by_sha1.get(sha1)
+
+    def update(self, git_objdir, ref_changes=None):
+        """
+        Indexes the commits that have become reachable since the last update.
+        Without ref_changes from a fetch, all branch and PR refs are rescanned.
+
+        Returns the list of newly indexed sha1s, parents first.
+        """
+
+        with self.update_lock:
+            if ref_changes is None or not self.indexed_refs:
+                current_refs = git.snapshot_refs(git_objdir, INDEXED_REF_PATTERNS)
+            else:
+                current_refs = dict(self.indexed_refs)
+                for refname, (_, new_sha1) in ref_changes.items():
+                    if new_sha1 is None:
+                        current_refs.pop(refname, None)
+                    elif any(refname.startswith(p) for p in INDEXED_REF_PATTERNS):
+                        current_refs[refname] = new_sha1
+
+            # Only tips that are still referenced are excluded, since
+            # unreferenced commits may eventually be pruned.
+            indexed_tips = set(self.indexed_refs.values()) & set(current_refs.values())
+            new_tips = set(current_refs.values()) - set(self.indexed_refs.values())
+
+            new_sha1s = []
+            if new_tips:
+                for sha1, parent_sha1s in git.iter_commit_parents(git_objdir, new_tips, indexed_tips):
+                    if self._add_commit(sha1, parent_sha1s) or sha1 in self.unreferenced_sha1s:
+                        self.unreferenced_sha1s.discard(sha1)
+                        new_sha1s.append(sha1)
+
+            self.indexed_refs = current_refs
+            return new_sha1s
+
+    def extend(self, git_objdir, sha1s):
+        """
+        Indexes commits that no indexed ref reaches, such as commits of
+        deleted branches, along with their unindexed ancestors, from a
+        single git process.  An update() that finds them reachable from
+        a ref still reports them as newly indexed.
+        """
+
+        with self.update_lock:
+            new_tips = set(sha1 for sha1 in sha1s if sha1 not in self.ids_by_sha1)
+            if not new_tips:
+                return
+
+            for sha1, parent_sha1s in git.iter_commit_parents(git_objdir, new_tips, set(self.indexed_refs.values())):
+                if self._add_commit(sha1, parent_sha1s):
+                    self.unreferenced_sha1s.add(sha1)
+
+    def _add_commit(self, sha1, parent_sha1s):
+
+        if sha1 in self.ids_by_sha1:
+            return False
+
+        parent_ids = tuple(self.ids_by_sha1[p] for p in parent_sha1s)
+        generation = 1 + max((self.generations[p] for p in parent_ids), default=0)
+
+        self.sha1s.append(sha1)
+        self.parents.append(parent_ids)
+        self.generations.append(generation)
+        self.ids_by_sha1[sha1] = len(self.sha1s) - 1
+        return True
+
+    def is_ancestor(self, ancestor_id, descendant_id):
+
+        if ancestor_id == descendant_id:
+            return True
+
+        min_generation = self.generations[ancestor_id]
+
+        visited = {descendant_id}
+        stack = [descendant_id]
+        while stack:
+            for parent_id in self.parents[stack.pop()]:
+                if parent_id == ancestor_id:
+                    return True
+
+                # Commits at or below the ancestor's generation
+                # cannot have it as an ancestor.
+                if parent_id not in visited and self.generations[parent_id] > min_generation:
+                    visited.add(parent_id)
+                    stack.append(parent_id)
+
+        return False
+
+    def ancestors_among(self, descendant_id, candidate_ids):
+        """
+        Returns the subset of candidate ids that are ancestors of the
+        descendant (or the descendant itself), using a single walk.
+        """
+
+        remaining = set(candidate_ids)
+        found = set()
+        if descendant_id in remaining:
+            remaining.discard(descendant_id)
+            found.add(descendant_id)
+
+        if not remaining:
+            return found
+
+        min_generation = min(self.generations[x] for x in remaining)
+
+        visited = {descendant_id}
+        stack = [descendant_id]
+        while stack and remaining:
+            for parent_id in self.parents[stack.pop()]:
+                if parent_id in remaining:
+                    remaining.discard(parent_id)
+                    found.add(parent_id)
+
+                if parent_id not in visited and self.generations[parent_id] > min_generation:
+                    visited.add(parent_id)
+                    stack.append(parent_id)
+
+        return found
+
+    def merge_base(self, first_id, second_id):
+        """
+        Returns the id of a best common ancestor, or None.
+
+        Commits are visited in order of decreasing generation number,
+        so the first commit reached from both sides cannot be an
+        ancestor of any other common ancestor.
+        """
+
+        if first_id == second_id:
+            return first_id
+
+        flags = {first_id: FROM_FIRST, second_id: FROM_SECOND}
+        queue = [(-self.generations[first_id], first_id), (-self.generations[second_id], second_id)]
+        heapq.heapify(queue)
+
+        while queue:
+            _, commit_id = heapq.heappop(queue)
+            commit_flags = flags[commit_id]
+            if commit_flags == FROM_FIRST | FROM_SECOND:
+                return commit_id
+
+            for parent_id in self.parents[commit_id]:
+                parent_flags = flags.get(parent_id, 0)
+                if parent_flags | commit_flags != parent_flags:
+                    if not parent_flags:
+                        heapq.heappush(queue, (-self.generations[parent_id], parent_id))
+
+                    flags[parent_id] = parent_flags | commit_flags
+
+        return None
+
+    def ancestry_path_count(self, base_id, branch_id):
+        """
+        Equivalent to "git rev-list --ancestry-path --count base..branch";
+        counts the ancestors of branch (inclusive) that are descendants of base.
+        """
+
+        min_generation = self.generations[base_id]
+
+        candidates = []
+        visited = {branch_id}
+        stack = [branch_id]
+        while stack:
+            commit_id = stack.pop()
+            if self.generations[commit_id] <= min_generation:
+                continue
+
+            candidates.append(commit_id)
+            for parent_id in self.parents[commit_id]:
+                if parent_id not in visited:
+                    visited.add(parent_id)
+                    stack.append(parent_id)
+
+        candidates.sort(key=lambda x: self.generations[x])
+
+        descendants = {base_id}
+        for commit_id in candidates:
+            if any(parent_id in descendants for parent_id in self.parents[commit_id]):
+                descendants.add(commit_id)
+
+        return len(descendants) - 1
+
+
+# One index per mirrored repo
+indexes = repos.PerRepo(CommitGraphIndex)
@@ -1,8 +1,32 @@
+import collections
+import json
 import os
+import queue
 import sqlite3
+import threading
+import time
 
 
-DEFAULT_PATH = os.path.join(os.path.dirname(__file__), 'database.sqlite3')
+# Like the clones, the database is kept outside of the application
+# directory, which is replaced on each redeployment, so that its
+# commit metadata and changed paths do not have to be filled again.
+DEFAULT_PATH = '/var/opt/gadgit/database.sqlite3'
+
+# Buffered log writes are committed together at this interval
+FLUSH_INTERVAL_SECONDS = 1.0
+
+# Flushes of a row that may fail because the database is locked,
+# before the row is dropped
+MAX_FLUSH_ATTEMPTS = 10
+
+# Buffered rows, beyond which further rows are dropped
+MAX_PENDING_ROWS = 100000
+
+# Dropped rows kept in memory for inspection
+MAX_DEAD_LETTERS = 1000
+
+# Every this many dropped rows, one is logged
+DROPPED_ROWS_LOG_INTERVAL = 1000
 
 
 CREATE_TABLE_LOGS = """
@@ -17,6 +41,11 @@ CREATE TABLE IF NOT EXISTS command_logs (
 )
 """
 
+CREATE_INDEX_LOGS_OPERATION = """
+CREATE INDEX IF NOT EXISTS command_logs_operation_created_at
+ON command_logs (operation, created_at)
+"""
+
 CREATE_TABLE_GITHUB_EVENTS = """
 CREATE TABLE IF NOT EXISTS github_events (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -26,66 +55,478 @@ CREATE TABLE IF NOT EXISTS github_events (
 """
 
 
+# Commit metadata never changes, so rows are only ever inserted.
+# The committer timestamp is stored in seconds for date range reads.
+CREATE_TABLE_COMMIT_METADATA = """
+CREATE TABLE IF NOT EXISTS commit_metadata (
+    repo TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    tree_sha1 TEXT,
+    subject TEXT,
+    message TEXT,
+    author_name TEXT,
+    author_email TEXT,
+    author_date TEXT,
+    committer_name TEXT,
+    committer_email TEXT,
+    committer_date TEXT,
+    committer_timestamp INTEGER,
+    PRIMARY KEY (repo, sha1)
+) WITHOUT ROWID
+"""
+
+CREATE_INDEX_COMMIT_METADATA_TIMESTAMP = """
+CREATE INDEX IF NOT EXISTS commit_metadata_repo_committer_timestamp
+ON commit_metadata (repo, committer_timestamp)
+"""
+
+
+# Paths changed by each commit, as a JSON list, and the reverse mapping
+# for path queries.  A commit is only present once all its paths are.
+CREATE_TABLE_COMMIT_CHANGED_PATHS = """
+CREATE TABLE IF NOT EXISTS commit_changed_paths (
+    repo TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    paths TEXT NOT NULL,
+    PRIMARY KEY (repo, sha1)
+) WITHOUT ROWID
+"""
+
+CREATE_TABLE_PATH_COMMITS = """
+CREATE TABLE IF NOT EXISTS path_commits (
+    repo TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    PRIMARY KEY (repo, path, sha1)
+) WITHOUT ROWID
+"""
+
+
 TABLE_CREATION_COMMANDS = [
     CREATE_TABLE_LOGS,
+    CREATE_INDEX_LOGS_OPERATION,
     CREATE_TABLE_GITHUB_EVENTS,
+    CREATE_TABLE_COMMIT_METADATA,
+    CREATE_INDEX_COMMIT_METADATA_TIMESTAMP,
+    CREATE_TABLE_COMMIT_CHANGED_PATHS,
+    CREATE_TABLE_PATH_COMMITS,
 ]
 
 
-def db_connect(db_path=DEFAULT_PATH):
-    return sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+INSERT_OPERATION_LOG_SQL = "INSERT INTO command_logs (operation, duration, return_code, stdout, stderr) VALUES (?, ?, ?, ?, ?)"
 
+INSERT_EVENT_SQL = "INSERT INTO github_events (event) VALUES (?);"
 
-def initialize_db():
-    with db_connect() as conn:
+# The keys of git.KEYS_AND_FORMAT_SPECIFIERS
+COMMIT_METADATA_KEYS = [
+    "sha1",
+    "tree_sha1",
+    "subject",
+    "message",
+    "author_name",
+    "author_email",
+    "author_date",
+    "committer_name",
+    "committer_email",
+    "committer_date",
+]
+
+INSERT_COMMIT_METADATA_SQL = "INSERT OR IGNORE INTO commit_metadata (repo, committer_timestamp, {}) VALUES ({})".format(
+    ", ".join(COMMIT_METADATA_KEYS), ", ".join("?" * (len(COMMIT_METADATA_KEYS) + 2)))
+
+INSERT_PATH_COMMIT_SQL = "INSERT OR IGNORE INTO path_commits (repo, path, sha1) VALUES (?, ?, ?)"
+
+INSERT_COMMIT_CHANGED_PATHS_SQL = "INSERT OR IGNORE INTO commit_changed_paths (repo, sha1, paths) VALUES (?, ?, ?)"
+
+# SQLite limits the number of parameters in a statement
+MAX_SHA1S_PER_SELECT = 500
+
+
+thread_local = threading.local()
+
+initialized_paths = set()
+initialization_lock = threading.Lock()
+
+
+def db_connect(db_path=None):
+    """
+    Returns this thread's connection to the database, opening it on first use.
+
+    Connections are kept open and use write-ahead logging, so that
+    readers do not block writers.  Use the connection as a context
+    manager to commit or roll back a transaction.
+    """
+
+    db_path = db_path or DEFAULT_PATH
+
+    connections = getattr(thread_local, "connections", None)
+    if connections is None:
+        connections = thread_local.connections = {}
+
+    conn = connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        connections[db_path] = conn
+
+        with initialization_lock:
+            if db_path not in initialized_paths:
+                initialize_db(conn)
+                initialized_paths.add(db_path)
+
+    return conn
+
+
+def is_transient_error(e):
+    """
+    Whether a write may succeed if retried: another connection held the
+    lock for longer than the timeout.  Other errors, such as a missing
+    table or a violated constraint, fail again on every retry.
+    """
+
+    return isinstance(e, sqlite3.OperationalError) and str(e).startswith(("database is locked", "database table is locked"))
+
+
+def initialize_db(conn=None):
+    with conn or db_connect() as conn:
         cur = conn.cursor()
 
         for table_creation_sql in TABLE_CREATION_COMMANDS:
             cur.execute(table_creation_sql)
 
 
-def insert_operation_log(operation, duration, command_result_obj):
+class BufferedWriter:
+    """
+    Collects inserts from any thread and commits them from a
+    background thread, one transaction per flush interval.
+    """
 
-    with db_connect() as conn:
-        cur = conn.cursor()
-        values_to_insert = (operation, duration, command_result_obj.return_code, command_result_obj.stdout, command_result_obj.stderr)
-        cur.execute("INSERT INTO command_logs (operation, duration, return_code, stdout, stderr) VALUES (?, ?, ?, ?, ?)", values_to_insert)
-        conn.commit()
+    def __init__(self, flush_interval_seconds=FLUSH_INTERVAL_SECONDS, max_pending_rows=MAX_PENDING_ROWS):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending_rows = max_pending_rows
+        self.pending = queue.Queue(maxsize=max_pending_rows)
 
+        # (sql, values, failed attempts) of rows whose flush failed
+        # transiently, retried ahead of newer rows
+        self.unwritten = []
 
-def insert_event(event_type):
+        # Rows given up on, with the error, newest last
+        self.dead_letters = collections.deque(maxlen=MAX_DEAD_LETTERS)
+        self.dropped_row_count = 0
 
-    with db_connect() as conn:
-        cur = conn.cursor()
+        self.flush_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.dropped_lock = threading.Lock()
+        self.thread = None
+
+    def add(self, sql, values):
+
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self.thread.start()
+
+        try:
+            self.pending.put_nowait((sql, values))
+        except queue.Full:
+            self._drop(sql, values, "buffer full")
+
+    def flush(self):
+        """
+        Commits everything added so far; may be called from any thread.
+
+        If the database is locked, the rows are kept for the next flush,
+        up to MAX_FLUSH_ATTEMPTS times.  If the transaction fails otherwise,
+        the rows are written one at a time, and those that still fail are
+        given up on.
+        """
+
+        with self.flush_lock:
+            batch = self.unwritten
+            self.unwritten = []
+            while True:
+                try:
+                    sql, values = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append((sql, values, 0))
+
+            if not batch:
+                return
+
+            try:
+                self._write(batch)
+            except sqlite3.Error as e:
+                if is_transient_error(e):
+                    self._keep_for_retry(batch, e)
+                else:
+                    self._write_one_at_a_time(batch)
+
+    def _write(self, batch):
+
+        rows_by_sql = {}
+        for sql, values, _ in batch:
+            rows_by_sql.setdefault(sql, []).append(values)
+
+        with db_connect() as conn:
+            for sql, rows in rows_by_sql.items():
+                conn.executemany(sql, rows)
+
+    def _write_one_at_a_time(self, batch):
+
+        retried = []
+        for row in batch:
+            try:
+                self._write([row])
+            except sqlite3.Error as e:
+                if is_transient_error(e):
+                    retried.append(row)
+                else:
+                    sql, values, _ = row
+                    self._drop(sql, values, e)
+
+        if retried:
+            self._keep_for_retry(retried, "database is locked")
+
+    def _keep_for_retry(self, batch, error):
+
+        print("Could not write {} buffered rows, retrying: {}".format(len(batch), error))
+        for sql, values, attempts in batch:
+            if attempts + 1 >= MAX_FLUSH_ATTEMPTS:
+                self._drop(sql, values, error)
+            else:
+                self.unwritten.append((sql, values, attempts + 1))
+
+        # Rows added while the database stayed locked are capped like the pending ones
+        excess = len(self.unwritten) - self.max_pending_rows
+        if excess > 0:
+            for sql, values, _ in self.unwritten[:excess]:
+                self._drop(sql, values, "buffer full")
+            del self.unwritten[:excess]
+
+    def _drop(self, sql, values, error):
 
-        cur.execute("INSERT INTO github_events (event) VALUES (?);", (event_type,))
+        with self.dropped_lock:
+            if self.dropped_row_count % DROPPED_ROWS_LOG_INTERVAL == 0:
+                print("Dropped buffered row ({} so far): {}".format(self.dropped_row_count + 1, error))
+            self.dropped_row_count += 1
+            self.dead_letters.append((sql, values, str(error)))
 
-        cur.execute("SELECT last_insert_rowid();")
-        row_id = cur.fetchone()[0]
+    def _run(self):
 
-        conn.commit()
-        return row_id
+        while True:
+            time.sleep(self.flush_interval_seconds)
+            self.flush()
+
+
+# A singleton
+buffered_writer = BufferedWriter()
+
+
+def insert_operation_log(operation, duration, command_result_obj):
+
+    values_to_insert = (operation, duration, command_result_obj.return_code, command_result_obj.stdout, command_result_obj.stderr)
+    buffered_writer.add(INSERT_OPERATION_LOG_SQL, values_to_insert)
+
+
+def insert_event(event_type):
+    buffered_writer.add(INSERT_EVENT_SQL, (event_type,))
+
+
+def insert_events(event_types):
+    for event_type in event_types:
+        insert_event(event_type)
 
 
 def get_operation_logs(operation):
 
+    # Readers should see everything logged before the request
+    buffered_writer.flush()
+
     sql = "SELECT duration, created_at, return_code, stdout, stderr FROM command_logs WHERE operation = ? ORDER BY created_at DESC LIMIT 10"
-    with db_connect() as conn:
-        cur = conn.cursor()  # instantiate a cursor obj
-        cur.execute(sql, (operation,))
-        return cur.fetchall()
+    cur = db_connect().cursor()  # instantiate a cursor obj
+    cur.execute(sql, (operation,))
+    return cur.fetchall()
 
 
 def get_github_event_logs():
 
+    buffered_writer.flush()
+
     sql = "SELECT id, event, received_at FROM github_events ORDER BY id DESC LIMIT 50"
-    with db_connect() as conn:
-        cur = conn.cursor()  # instantiate a cursor obj
-        cur.execute(sql)
-        return cur.fetchall()
+    cur = db_connect().cursor()  # instantiate a cursor obj
+    cur.execute(sql)
+    return cur.fetchall()
 
 
 def clear_command_logs():
-    os.remove(DEFAULT_PATH)
-    initialize_db()
+    """
+    Deletes rows rather than the database file, which
+    other threads may have open.
+    """
+
+    buffered_writer.flush()
+
+    with db_connect() as conn:
+        conn.execute("DELETE FROM command_logs")
+        conn.execute("DELETE FROM github_events")
+
+
+def commit_metadata_row(repo_name, committer_timestamp, metadata):
+    return (repo_name, committer_timestamp) + tuple(metadata[k] for k in COMMIT_METADATA_KEYS)
+
+
+def insert_commit_metadata(rows):
+    """
+    Commits the rows immediately, in a single transaction.
+    """
+
+    with db_connect() as conn:
+        conn.executemany(INSERT_COMMIT_METADATA_SQL, rows)
+
+
+def insert_commit_metadata_buffered(rows):
+    for row in rows:
+        buffered_writer.add(INSERT_COMMIT_METADATA_SQL, row)
+
+
+def get_commit_metadata(repo_name, sha1s):
+    """
+    Returns a dict of metadata keyed by sha1, for the sha1s that are stored.
+    """
+
+    select_sql = "SELECT {} FROM commit_metadata WHERE repo = ? AND sha1 IN ({})"
+
+    sha1s = list(sha1s)
+    metadata_by_sha1 = {}
+    cur = db_connect().cursor()
+    for i in range(0, len(sha1s), MAX_SHA1S_PER_SELECT):
+        chunk = sha1s[i:i + MAX_SHA1S_PER_SELECT]
+        cur.execute(select_sql.format(", ".join(COMMIT_METADATA_KEYS), ", ".join("?" * len(chunk))), [repo_name] + chunk)
+        for row in cur.fetchall():
+            metadata_by_sha1[row[0]] = dict(zip(COMMIT_METADATA_KEYS, row))
+
+    return metadata_by_sha1
+
+
+def get_stored_sha1s(repo_name, sha1s):
+    """
+    Returns the subset of the sha1s that are stored.
+    """
+
+    select_sql = "SELECT sha1 FROM commit_metadata WHERE repo = ? AND sha1 IN ({})"
+
+    sha1s = list(sha1s)
+    stored_sha1s = set()
+    cur = db_connect().cursor()
+    for i in range(0, len(sha1s), MAX_SHA1S_PER_SELECT):
+        chunk = sha1s[i:i + MAX_SHA1S_PER_SELECT]
+        cur.execute(select_sql.format(", ".join("?" * len(chunk))), [repo_name] + chunk)
+        stored_sha1s.update(row[0] for row in cur.fetchall())
+
+    return stored_sha1s
+
+
+def iter_commit_metadata_by_committer_time(repo_name, since_timestamp, until_timestamp, batch_size=1000):
+    """
+    Yields the metadata of stored commits committed within
+    the range, newest first, reading a batch of rows at a time.
+    """
+
+    select_sql = "SELECT {} FROM commit_metadata WHERE repo = ? AND committer_timestamp >= ? AND committer_timestamp < ? ORDER BY committer_timestamp DESC".format(
+        ", ".join(COMMIT_METADATA_KEYS))
+
+    cur = db_connect().cursor()
+    cur.execute(select_sql, (repo_name, since_timestamp, until_timestamp))
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+
+        for row in rows:
+            yield dict(zip(COMMIT_METADATA_KEYS, row))
+
+
+def insert_changed_paths(repo_name, paths_by_sha1):
+    """
+    Commits the paths of all of the commits in a single transaction.
+    """
+
+    with db_connect() as conn:
+        for sha1, paths in paths_by_sha1.items():
+            conn.executemany(INSERT_PATH_COMMIT_SQL, [(repo_name, path, sha1) for path in paths])
+
+        conn.executemany(INSERT_COMMIT_CHANGED_PATHS_SQL, [(repo_name, sha1, json.dumps(paths)) for sha1, paths in paths_by_sha1.items()])
+
+
+def insert_changed_paths_buffered(repo_name, paths_by_sha1):
+    """
+    The reverse mapping is queued first, so that a
+    stored commit always has all of its paths.
+    """
+
+    for sha1, paths in paths_by_sha1.items():
+        for path in paths:
+            buffered_writer.add(INSERT_PATH_COMMIT_SQL, (repo_name, path, sha1))
+
+    for sha1, paths in paths_by_sha1.items():
+        buffered_writer.add(INSERT_COMMIT_CHANGED_PATHS_SQL, (repo_name, sha1, json.dumps(paths)))
+
+
+def get_changed_paths(repo_name, sha1s):
+    """
+    Returns a dict of path lists keyed by sha1, for the sha1s that are stored.
+    """
+
+    select_sql = "SELECT sha1, paths FROM commit_changed_paths WHERE repo = ? AND sha1 IN ({})"
+
+    sha1s = list(sha1s)
+    paths_by_sha1 = {}
+    cur = db_connect().cursor()
+    for i in range(0, len(sha1s), MAX_SHA1S_PER_SELECT):
+        chunk = sha1s[i:i + MAX_SHA1S_PER_SELECT]
+        cur.execute(select_sql.format(", ".join("?" * len(chunk))), [repo_name] + chunk)
+        for sha1, paths in cur.fetchall():
+            paths_by_sha1[sha1] = json.loads(paths)
+
+    return paths_by_sha1
+
+
+def get_sha1s_with_changed_paths(repo_name, sha1s):
+    """
+    Returns the subset of the sha1s whose paths are stored.
+    """
+
+    select_sql = "SELECT sha1 FROM commit_changed_paths WHERE repo = ? AND sha1 IN ({})"
+
+    sha1s = list(sha1s)
+    stored_sha1s = set()
+    cur = db_connect().cursor()
+    for i in range(0, len(sha1s), MAX_SHA1S_PER_SELECT):
+        chunk = sha1s[i:i + MAX_SHA1S_PER_SELECT]
+        cur.execute(select_sql.format(", ".join("?" * len(chunk))), [repo_name] + chunk)
+        stored_sha1s.update(row[0] for row in cur.fetchall())
+
+    return stored_sha1s
+
+
+def get_recent_commits_by_path(repo_name, path, limit):
+    """
+    Returns (sha1, committer date) pairs of the stored commits that
+    changed the path or anything below it, newest first.
+    """
+
+    # Paths below a directory sort between "dir/" and "dir0"
+    directory = path.rstrip("/") + "/"
+    select_sql = """SELECT pc.sha1, cm.committer_date
+FROM path_commits pc JOIN commit_metadata cm ON cm.repo = pc.repo AND cm.sha1 = pc.sha1
+WHERE pc.repo = ? AND (pc.path = ? OR (pc.path >= ? AND pc.path < ?))
+GROUP BY pc.sha1
+ORDER BY cm.committer_timestamp DESC
+LIMIT ?"""
 
+    cur = db_connect().cursor()
+    cur.execute(select_sql, (repo_name, path.rstrip("/"), directory, directory[:-1] + "0", limit))
+    return cur.fetchall()
@@ -0,0 +1,66 @@
+"""
+In-process queue of received webhook events
+
+The webhook handler only verifies and enqueues each event, so that
+GitHub gets a response immediately; a background thread processes
+the events in batches.
+"""
+
+import queue
+import threading
+
+
+MAX_BATCH_SIZE = 100
+
+
+class EventQueue:
+    """
+    The batch function is called from a single background thread
+    with a list of (event type, raw payload bytes) pairs.
+    """
+
+    def __init__(self, process_batch_func, max_batch_size=MAX_BATCH_SIZE):
+        self.process_batch_func = process_batch_func
+        self.max_batch_size = max_batch_size
+        self.events = queue.Queue()
+        self.start_lock = threading.Lock()
+        self.thread = None
+        self.processed_count = 0
+
+    def put(self, event_type, payload_bytes):
+
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="event-queue", daemon=True)
+                self.thread.start()
+
+        self.events.put((event_type, payload_bytes))
+
+    def _take_batch(self):
+        """
+        Blocks until at least one event is available.
+        """
+
+        batch = [self.events.get()]
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+
+        while True:
+            batch = self._take_batch()
+
+            try:
+                self.process_batch_func(batch)
+            except Exception as e:
+                print("Failed to process %d events: %s" % (len(batch), e))
+
+            self.processed_count += len(batch)
+
+    def depth(self):
+        return self.events.qsize()
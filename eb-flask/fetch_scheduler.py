@@ -0,0 +1,157 @@
+"""
+Coalescing fetch scheduler
+
+Fetch requests that arrive while a fetch is pending or running are
+merged into the next fetch rather than dropped, so the last of a burst
+of pushes is always picked up.
+"""
+
+import threading
+import time
+
+
+# A fetch starts once no new request has arrived for this long...
+DEBOUNCE_SECONDS = 5
+
+# ...or once the oldest pending request has waited this long.
+MAX_STALENESS_SECONDS = 60
+
+
+class FetchScheduler:
+    """
+    The fetch function is called from a single background thread
+    with a sorted list of refspecs, or None for a full fetch.
+    """
+
+    def __init__(self, fetch_func,
+                 debounce_seconds=DEBOUNCE_SECONDS,
+                 max_staleness_seconds=MAX_STALENESS_SECONDS,
+                 full_fetch_min_interval_seconds=0):
+
+        self.fetch_func = fetch_func
+        self.debounce_seconds = debounce_seconds
+        self.max_staleness_seconds = max_staleness_seconds
+        self.full_fetch_min_interval_seconds = full_fetch_min_interval_seconds
+
+        self.condition = threading.Condition()
+        self.thread = None
+
+        # Pending requests
+        self.pending_count = 0
+        self.pending_full = False
+        self.pending_refspecs = set()
+        self.first_pending_time = None
+        self.last_pending_time = None
+        self.last_full_fetch_start = None
+
+        # Statistics
+        self.completed_fetches = 0
+        self.merged_requests_total = 0
+        self.last_merged_count = 0
+        self.max_merged_count = 0
+        self.last_latency_seconds = None
+        self.total_latency_seconds = 0
+        self.max_latency_seconds = 0
+
+    def request(self, refspecs=None):
+
+        with self.condition:
+            now = time.monotonic()
+            if refspecs is None:
+                self.pending_full = True
+            else:
+                self.pending_refspecs.update(refspecs)
+
+            self.pending_count += 1
+            if self.first_pending_time is None:
+                self.first_pending_time = now
+            self.last_pending_time = now
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="fetch-scheduler", daemon=True)
+                self.thread.start()
+
+            self.condition.notify()
+
+            return {"status": "queued", "queue_depth": self.pending_count}
+
+    def _start_deadline(self):
+        deadline = min(
+            self.last_pending_time + self.debounce_seconds,
+            self.first_pending_time + self.max_staleness_seconds)
+
+        if self.pending_full and self.last_full_fetch_start is not None:
+            deadline = max(deadline, self.last_full_fetch_start + self.full_fetch_min_interval_seconds)
+
+        return deadline
+
+    def _take_pending(self):
+        """
+        Waits until the pending requests are due, then claims them.
+        """
+
+        with self.condition:
+            while not self.pending_count:
+                self.condition.wait()
+
+            while True:
+                remaining_seconds = self._start_deadline() - time.monotonic()
+                if remaining_seconds <= 0:
+                    break
+
+                self.condition.wait(remaining_seconds)
+
+            refspecs = None if self.pending_full else sorted(self.pending_refspecs)
+            merged_count = self.pending_count
+            first_pending_time = self.first_pending_time
+
+            if self.pending_full:
+                self.last_full_fetch_start = time.monotonic()
+
+            self.pending_count = 0
+            self.pending_full = False
+            self.pending_refspecs = set()
+            self.first_pending_time = None
+            self.last_pending_time = None
+
+            return refspecs, merged_count, first_pending_time
+
+    def _run(self):
+
+        while True:
+            refspecs, merged_count, first_pending_time = self._take_pending()
+
+            try:
+                self.fetch_func(refspecs)
+            except Exception as e:
+                print("Scheduled fetch failed: " + str(e))
+
+            latency_seconds = time.monotonic() - first_pending_time
+            with self.condition:
+                self.completed_fetches += 1
+                self.merged_requests_total += merged_count
+                self.last_merged_count = merged_count
+                self.max_merged_count = max(self.max_merged_count, merged_count)
+                self.last_latency_seconds = latency_seconds
+                self.total_latency_seconds += latency_seconds
+                self.max_latency_seconds = max(self.max_latency_seconds, latency_seconds)
+
+    def get_stats(self):
+
+        with self.condition:
+            return {
+                "queue_depth": self.pending_count,
+                "pending_full_fetch": self.pending_full,
+                "pending_refspec_count": len(self.pending_refspecs),
+                "completed_fetches": self.completed_fetches,
+                "merged_requests": {
+                    "total": self.merged_requests_total,
+                    "last_fetch": self.last_merged_count,
+                    "max": self.max_merged_count,
+                },
+                "request_to_completion_seconds": {
+                    "last": self.last_latency_seconds,
+                    "mean": self.total_latency_seconds / self.completed_fetches if self.completed_fetches else None,
+                    "max": self.max_latency_seconds,
+                },
+            }
@@ -6,21 +6,70 @@ Git operations
 
 import os
 import subprocess
+import tempfile
+import time
+
+import cat_file_pool
+import metrics
+import query_cache
+import repos
 
 
 GIT_BINARY_PATH = "git"
 
 
-# In contrast with the "/opt/python/current/app" directory in which the
-# python application files are stored, the "/tmp" directory persists across
-# application redeployments.  This persistence is desirable as a fresh
-# fetch of all of the pytorch PR refs can take over 10 minutes.
-CLONE_PATH = '/var/opt/gadgit/repo/pytorch.git'
+PULL_REQUEST_REF_MAPPING = "refs/pull/*:refs/remotes/origin/pr/*"
+
+# Fetches only the refs of a single PR
+SINGLE_PULL_REQUEST_REF_MAPPING_TEMPLATE = "refs/pull/%d/*:refs/remotes/origin/pr/%d/*"
 
+PR_REF_PREFIX = "refs/remotes/origin/pr/"
 
-PULL_REQUEST_REF_MAPPING = "refs/pull/*:refs/remotes/origin/pr/*"
+PR_REF_TEMPLATE = PR_REF_PREFIX + "%d/head"
+
+TRACKED_BRANCHES = [
+    "viable/strict",
+    "master",
+]
+
+FULL_FETCH_REFSPECS = [branch + ":" + branch for branch in TRACKED_BRANCHES] + [PULL_REQUEST_REF_MAPPING]
+
+# Changed paths are listed with "diff-tree --diff-merges=first-parent",
+# from git 2.31, and maintenance runs "repack --write-midx", from 2.34
+MIN_GIT_VERSION = (2, 34)
+
+
+class UnsupportedGitVersionError(Exception):
+    pass
+
+
+def get_version():
+    """
+    Returns the version of the git binary as a tuple of ints,
+    e.g. (2, 39, 5) for "git version 2.39.5 (Apple Git-143)".
+    """
+
+    output = subprocess.check_output([GIT_BINARY_PATH, "--version"]).decode("utf-8")
+
+    version = []
+    for part in output.split()[2].split("."):
+        if not part.isdigit():
+            break
+        version.append(int(part))
+
+    return tuple(version)
+
+
+def check_version():
+    """
+    Raises UnsupportedGitVersionError if the git binary is older than
+    MIN_GIT_VERSION, rather than failing later on an unknown option.
+    """
 
-PR_REF_TEMPLATE = "refs/remotes/origin/pr/%d/head"
+    version = get_version()
+    if version < MIN_GIT_VERSION:
+        raise UnsupportedGitVersionError("git {} is installed, but {} or later is required".format(
+            ".".join(map(str, version)), ".".join(map(str, MIN_GIT_VERSION))))
 
 
 class CommandResult:
@@ -30,14 +79,58 @@ class CommandResult:
         self.stderr = stderr
 
 
-def get_command_result(cmd_args):
-    p = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
+def get_subcommand(cmd_args):
+    """
+    Returns the git subcommand, skipping global options.
+    """
+
+    args = iter(cmd_args[1:])
+    for arg in args:
+        if arg in ['--git-dir', '-C', '-c']:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+
+    return "unknown"
+
+
+def get_command_result(cmd_args, stdin_text=None):
+    subcommand = get_subcommand(cmd_args)
+    metrics.GIT_COMMANDS.inc(subcommand)
+    start_time = time.monotonic()
+
+    stdin = subprocess.PIPE if stdin_text is not None else None
+    p = subprocess.Popen(cmd_args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(stdin_text.encode("utf-8") if stdin_text is not None else None)
+
+    metrics.GIT_COMMAND_SECONDS.observe(time.monotonic() - start_time, subcommand)
     return CommandResult(p.returncode, stdout.decode("utf-8").strip(), stderr.decode("utf-8").strip())
 
 
-def fetch_pr_refs():
-    git_objdir = CLONE_PATH
+async def get_command_result_async(cmd_args, stdin_text=None):
+    """
+    Same as get_command_result(), but awaits the process
+    instead of blocking the calling thread.
+
+    Query functions that accept a run_command argument
+    return a coroutine when given an async runner.
+    """
+    # Only the ASGI serving mode runs commands asynchronously
+    import asyncio
+
+    subcommand = get_subcommand(cmd_args)
+    metrics.GIT_COMMANDS.inc(subcommand)
+    start_time = time.monotonic()
+
+    stdin = subprocess.PIPE if stdin_text is not None else None
+    p = await asyncio.create_subprocess_exec(*cmd_args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = await p.communicate(stdin_text.encode("utf-8") if stdin_text is not None else None)
+
+    metrics.GIT_COMMAND_SECONDS.observe(time.monotonic() - start_time, subcommand)
+    return CommandResult(p.returncode, stdout.decode("utf-8").strip(), stderr.decode("utf-8").strip())
+
+
+def fetch_refspecs(git_objdir, refspecs):
 
     cmd_args = [
         GIT_BINARY_PATH,
@@ -45,15 +138,131 @@ def fetch_pr_refs():
         "fetch",
         "--force",
         "origin",
-        "viable/strict:viable/strict",
-        "master:master",
-        PULL_REQUEST_REF_MAPPING,
-    ]
+    ] + refspecs
 
     return get_command_result(cmd_args)
 
 
-def master_merge_base(git_objdir, branch_commit_sha1):
+def fetch_pr_refs(git_objdir):
+    return fetch_refspecs(git_objdir, FULL_FETCH_REFSPECS)
+
+
+def refspecs_for_pushed_ref(pushed_ref):
+    """
+    Returns an empty list if the pushed ref is not mirrored.
+    """
+
+    for branch in TRACKED_BRANCHES:
+        if pushed_ref == "refs/heads/" + branch:
+            return [branch + ":" + branch]
+
+    return []
+
+
+def refspecs_for_pull_request(pr_number):
+    return [SINGLE_PULL_REQUEST_REF_MAPPING_TEMPLATE % (pr_number, pr_number)]
+
+
+def refspec_destination_patterns(refspecs):
+    """
+    Converts the destination side of each refspec into
+    a pattern that "for-each-ref" understands.
+    """
+
+    patterns = []
+    for refspec in refspecs:
+        destination = refspec.lstrip("+").split(":")[-1]
+        if destination.endswith("*"):
+            destination = destination[:-1]
+        elif not destination.startswith("refs/"):
+            destination = "refs/heads/" + destination
+
+        patterns.append(destination)
+
+    return patterns
+
+
+def snapshot_refs(git_objdir, patterns):
+    """
+    Returns a dict of ref name to sha1 for refs matching the patterns.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'for-each-ref',
+        '--format=%(objectname) %(refname)',
+    ] + patterns
+
+    cmd_result = get_command_result(cmd_args)
+    if cmd_result.return_code:
+        raise subprocess.CalledProcessError(cmd_result.return_code, cmd_args, stderr=cmd_result.stderr)
+
+    snapshot = {}
+    for line in cmd_result.stdout.splitlines():
+        sha1, refname = line.split(" ", 1)
+        snapshot[refname] = sha1
+
+    return snapshot
+
+
+def diff_ref_snapshots(before, after):
+    """
+    Returns a dict of ref name to (old sha1, new sha1) for every ref
+    that moved; created refs have an old sha1 of None, and
+    deleted refs a new sha1 of None.
+    """
+
+    ref_changes = {}
+    for refname in set(before) | set(after):
+        old_sha1 = before.get(refname)
+        new_sha1 = after.get(refname)
+        if old_sha1 != new_sha1:
+            ref_changes[refname] = (old_sha1, new_sha1)
+
+    return ref_changes
+
+
+def get_object_store_size(git_objdir):
+    """
+    Returns the total size in bytes of loose and packed objects.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'count-objects',
+        '-v',
+    ]
+
+    cmd_result = get_command_result(cmd_args)
+    if cmd_result.return_code:
+        raise subprocess.CalledProcessError(cmd_result.return_code, cmd_args, stderr=cmd_result.stderr)
+
+    sizes_kib = {}
+    for line in cmd_result.stdout.splitlines():
+        key, value = line.split(": ", 1)
+        sizes_kib[key] = value
+
+    return (int(sizes_kib.get("size", 0)) + int(sizes_kib.get("size-pack", 0))) * 1024
+
+
+def fetch_with_ref_changes(git_objdir, refspecs):
+    """
+    Returns the fetch command result along with the changes
+    to the refs that the refspecs write to.
+    """
+
+    patterns = refspec_destination_patterns(refspecs)
+
+    before = snapshot_refs(git_objdir, patterns)
+    cmd_result = fetch_refspecs(git_objdir, refspecs)
+    after = snapshot_refs(git_objdir, patterns)
+
+    return cmd_result, diff_ref_snapshots(before, after)
+
+
+def master_merge_base(git_objdir, branch_commit_sha1, run_command=get_command_result):
 
     cmd_args = [
         GIT_BINARY_PATH,
@@ -64,7 +273,7 @@ def master_merge_base(git_objdir, branch_commit_sha1):
         branch_commit_sha1,
     ]
 
-    return get_command_result(cmd_args)
+    return run_command(cmd_args)
 
 
 def parse_bulk_refs(git_objdir, refs):
@@ -80,10 +289,10 @@ def parse_bulk_refs(git_objdir, refs):
 
 
 def pull_request_head_commit(git_objdir, pr_number):
-    return parse_bulk_refs(git_objdir, [PR_REF_TEMPLATE % pr_number])
+    return resolve_refs(git_objdir, [PR_REF_TEMPLATE % pr_number])
 
 
-def commit_distance(git_objdir, merge_base_sha1, branch_commit_sha1):
+def commit_distance(git_objdir, merge_base_sha1, branch_commit_sha1, run_command=get_command_result):
 
     cmd_args = [
         GIT_BINARY_PATH,
@@ -95,10 +304,10 @@ def commit_distance(git_objdir, merge_base_sha1, branch_commit_sha1):
         merge_base_sha1 + ".." + branch_commit_sha1,
     ]
 
-    return get_command_result(cmd_args)
+    return run_command(cmd_args)
 
 
-def current_pointing_prs(git_objdir, commit_sha1):
+def current_pointing_prs(git_objdir, commit_sha1, run_command=get_command_result):
 
     cmd_args = [
         GIT_BINARY_PATH,
@@ -112,45 +321,419 @@ def current_pointing_prs(git_objdir, commit_sha1):
         commit_sha1,
     ]
 
-    return get_command_result(cmd_args)
+    return run_command(cmd_args)
+
+
+def iter_commit_parents(git_objdir, include_sha1s, exclude_sha1s):
+    """
+    Yields (sha1, parent sha1 list) for every commit reachable from
+    include_sha1s but not from exclude_sha1s, with parents before children.
+
+    Output is streamed, since the full history of a large repo
+    does not comfortably fit in a single string.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'rev-list',
+        '--parents',
+        '--topo-order',
+        '--reverse',
+        '--stdin',
+    ]
+
+    stdin_text = "".join(c + "\n" for c in include_sha1s) + "".join("^" + c + "\n" for c in exclude_sha1s)
+
+    with tempfile.TemporaryFile() as stderr_file:
+        metrics.GIT_COMMANDS.inc(get_subcommand(cmd_args))
+        p = subprocess.Popen(cmd_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file)
+
+        # With --reverse, no output is produced until all input is read
+        p.stdin.write(stdin_text.encode("utf-8"))
+        p.stdin.close()
+
+        for line in p.stdout:
+            sha1s = line.decode("utf-8").split()
+            yield sha1s[0], sha1s[1:]
+
+        if p.wait():
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(p.returncode, cmd_args, stderr=stderr_file.read().decode("utf-8"))
+
+
+def iter_ancestry_path(git_objdir, base_sha1, tip_sha1, after_sha1=None, max_count=None):
+    """
+    Yields the sha1s of the commits counted by commit_distance(),
+    newest first, as "rev-list" produces them.
+
+    The order is stable for a given pair of commits, so
+    that a range can be read one page at a time: with after_sha1,
+    only the commits after that one are yielded.  The walk cannot be
+    started there, so the commits up to it are read and dropped.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'rev-list',
+        '--ancestry-path',
+    ]
+
+    if max_count is not None and after_sha1 is None:
+        cmd_args.append('--max-count=%d' % max_count)
+
+    cmd_args.append(base_sha1 + ".." + tip_sha1)
+
+    with tempfile.TemporaryFile() as stderr_file:
+        metrics.GIT_COMMANDS.inc(get_subcommand(cmd_args))
+        p = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=stderr_file)
+
+        finished_reading = False
+        try:
+            skipping = after_sha1 is not None
+            yielded_count = 0
+            for line in p.stdout:
+                sha1 = line.decode("utf-8").strip()
+                if skipping:
+                    skipping = sha1 != after_sha1
+                    continue
+
+                yield sha1
+                yielded_count += 1
+                if after_sha1 is not None and yielded_count == max_count:
+                    break
+            else:
+                finished_reading = True
+        finally:
+            # The reader may stop early, e.g. when a streaming client
+            # disconnects, and a resumed walk is stopped at max_count
+            if not finished_reading:
+                p.kill()
+                p.wait()
+
+        if finished_reading and p.wait():
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(p.returncode, cmd_args, stderr=stderr_file.read().decode("utf-8"))
+
+
+def iter_changed_paths(git_objdir, commit_sha1_list):
+    """
+    Yields (sha1, list of paths) for every commit, in order, from a
+    single "diff-tree" process.  Merges are compared with their first
+    parent, and root commits with the empty tree.
+
+    Only trees are compared, so no blobs are read from a partial clone.
+    """
+
+    if not commit_sha1_list:
+        return
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'diff-tree',
+        '--stdin',
+        '-r',
+        '-z',
+        '--name-only',
+        '--root',
+        '--always',
+        '--diff-merges=first-parent',
+    ]
+
+    # Output starts before all input is read, so the input is
+    # given as a file rather than written to a pipe that could block.
+    with tempfile.TemporaryFile() as stdin_file, tempfile.TemporaryFile() as stderr_file:
+        stdin_file.write("".join(c + "\n" for c in commit_sha1_list).encode("utf-8"))
+        stdin_file.seek(0)
+
+        metrics.GIT_COMMANDS.inc(get_subcommand(cmd_args))
+        p = subprocess.Popen(cmd_args, stdin=stdin_file, stdout=subprocess.PIPE, stderr=stderr_file)
+
+        # With --always, each commit's paths follow a line naming the commit
+        remaining_sha1s = iter(commit_sha1_list)
+        next_sha1 = next(remaining_sha1s)
+        current_sha1 = None
+        paths = []
+
+        remainder = b""
+        for chunk in iter(lambda: p.stdout.read(64 * 1024), b""):
+            pieces = (remainder + chunk).split(b"\0")
+            remainder = pieces.pop()
+
+            for piece in pieces:
+                item = piece.decode("utf-8", errors="replace")
+                if item == next_sha1:
+                    if current_sha1 is not None:
+                        yield current_sha1, paths
+
+                    current_sha1, paths = next_sha1, []
+                    next_sha1 = next(remaining_sha1s, None)
+                elif item:
+                    paths.append(item)
+
+        if current_sha1 is not None:
+            yield current_sha1, paths
+
+        if p.wait():
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(p.returncode, cmd_args, stderr=stderr_file.read().decode("utf-8"))
+
+
+def diff_paths(git_objdir, base_sha1, tip_sha1, run_command=get_command_result):
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'diff-tree',
+        '-r',
+        '-z',
+        '--name-only',
+        base_sha1,
+        tip_sha1,
+    ]
+
+    return run_command(cmd_args)
+
+
+def recent_commits_touching_path(git_objdir, ref, path, max_count, run_command=get_command_result):
+    """
+    Path-limited history is answered from the changed-path
+    Bloom filters of the commit-graph, where it has them.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'log',
+        '--max-count=%d' % max_count,
+        '--format=%H %ci',
+        ref,
+        '--',
+        path,
+    ]
+
+    return run_command(cmd_args)
 
 
-CONFIG_TEXT = """
+CONFIG_TEXT_TEMPLATE = """
 [core]
-    repositoryformatversion = 0
+    repositoryformatversion = %d
     filemode = true
     bare = true
 [remote "origin"]
-    url = https://github.com/pytorch/pytorch.git
+    url = %s
+"""
+
+# Marks objects missing from a partial clone as available from origin,
+# and applies the filter to later fetches.
+PARTIAL_CLONE_CONFIG_TEXT_TEMPLATE = """    promisor = true
+    partialclonefilter = %s
+[extensions]
+    partialClone = origin
 """
 
 
+def render_config_text(repo_clone_url, clone_filter=None):
+
+    if clone_filter:
+        return CONFIG_TEXT_TEMPLATE % (1, repo_clone_url) + PARTIAL_CLONE_CONFIG_TEXT_TEMPLATE % clone_filter
+
+    return CONFIG_TEXT_TEMPLATE % (0, repo_clone_url)
+
+
+def get_clone_filter(git_objdir):
+    """
+    Returns None unless the repo is a partial clone.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'config',
+        '--get',
+        'remote.origin.partialclonefilter',
+    ]
+
+    cmd_result = get_command_result(cmd_args)
+    return cmd_result.stdout if not cmd_result.return_code and cmd_result.stdout else None
+
+
 def restore_head_ref():
-    with open(os.path.join(CLONE_PATH, "HEAD"), "w") as fh:
+    repo = repos.current()
+
+    # A partial clone must stay one, or its missing objects would be an error
+    clone_filter = get_clone_filter(repo.clone_path)
+
+    with open(os.path.join(repo.clone_path, "HEAD"), "w") as fh:
         fh.write("ref: refs/heads/master")
 
-    with open(os.path.join(CLONE_PATH, "config"), "w") as fh:
-        fh.write(CONFIG_TEXT)
+    with open(os.path.join(repo.clone_path, "config"), "w") as fh:
+        fh.write(render_config_text(repo.clone_url, clone_filter))
+
+    reset_object_readers(repo.clone_path)
+    query_cache.invalidate_ref_dependent()
 
     return "Done."
 
 
-def bare_clone(repo_clone_url):
-    os.makedirs(os.path.dirname(CLONE_PATH), mode=0o777, exist_ok=True)
+def bare_clone(git_objdir, repo_clone_url, clone_filter=None):
+    """
+    With a filter, such as "blob:none", makes a partial clone.
+    Later fetches apply the same filter.
+    """
+
+    os.makedirs(os.path.dirname(git_objdir), mode=0o777, exist_ok=True)
 
     cmd_args = [
         GIT_BINARY_PATH,
         "clone",
         "--bare",
         "--single-branch",
+    ]
+
+    if clone_filter:
+        cmd_args.append("--filter=" + clone_filter)
+
+    cmd_args += [
         repo_clone_url,
-        CLONE_PATH,
+        git_objdir,
+    ]
+
+    return get_command_result(cmd_args)
+
+
+def init_from_bundle(git_objdir, bundle_path, repo_clone_url, clone_filter=None):
+    """
+    Creates a bare repo holding every ref in the bundle, with origin
+    set up as in bare_clone().  Objects newer than the bundle still
+    need to be fetched from origin.
+
+    A bundle of an existing mirror can be made with
+    "git bundle create <path> --all".
+    """
+
+    os.makedirs(os.path.dirname(git_objdir), mode=0o777, exist_ok=True)
+
+    cmd_result = get_command_result([GIT_BINARY_PATH, "init", "--quiet", "--bare", git_objdir])
+    if cmd_result.return_code:
+        return cmd_result
+
+    with open(os.path.join(git_objdir, "HEAD"), "w") as fh:
+        fh.write("ref: refs/heads/master")
+
+    with open(os.path.join(git_objdir, "config"), "w") as fh:
+        fh.write(render_config_text(repo_clone_url, clone_filter))
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        "fetch",
+        bundle_path,
+        "+refs/*:refs/*",
+    ]
+
+    return get_command_result(cmd_args)
+
+
+def pack_refs(git_objdir):
+    """
+    Moves loose refs into the packed-refs file.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'pack-refs',
+        '--all',
+        '--prune',
+    ]
+
+    return get_command_result(cmd_args)
+
+
+def repack_geometric(git_objdir):
+    """
+    Merges small packs so that pack sizes form a geometric
+    progression, without rewriting the largest packs, and writes
+    a reachability bitmap over all packs via a multi-pack-index.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'repack',
+        '--geometric=2',
+        '-d',
+        '--write-midx',
+        '--write-bitmap-index',
+    ]
+
+    return get_command_result(cmd_args)
+
+
+def repack_all(git_objdir):
+    """
+    Rewrites all reachable objects into a single pack.  Bitmaps are
+    turned off, since git writes them by default in a bare repo, but
+    cannot write them for a partial clone.
+
+    Unreachable objects are written out as loose objects rather than
+    deleted, so that prune_loose_objects() only removes them once they
+    have expired, like every other object that the refs stop reaching.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'repack',
+        '-A',
+        '-d',
+        '--no-write-bitmap-index',
+    ]
+
+    return get_command_result(cmd_args)
+
+
+def write_commit_graph(git_objdir):
+    """
+    Adds the commits that are not yet in the commit-graph as a new
+    layer of a split commit-graph, which stores generation numbers
+    and changed-path Bloom filters.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'commit-graph',
+        'write',
+        '--reachable',
+        '--split',
+        '--changed-paths',
     ]
 
     return get_command_result(cmd_args)
 
 
-def is_git_ancestor(git_objdir, supposed_ancestor, supposed_descendant):
+def prune_loose_objects(git_objdir, expire="2.weeks.ago"):
+    """
+    Objects are only pruned once they are older than the expiry,
+    since snapshots may still reference commits that the mirror's
+    refs no longer reach.
+    """
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'prune',
+        '--expire=' + expire,
+    ]
+
+    return get_command_result(cmd_args)
+
+
+def is_git_ancestor(git_objdir, supposed_ancestor, supposed_descendant, run_command=get_command_result):
     cmd_args = [
         GIT_BINARY_PATH,
         '--git-dir', git_objdir,
@@ -160,9 +743,7 @@ def is_git_ancestor(git_objdir, supposed_ancestor, supposed_descendant):
         supposed_descendant,
     ]
 
-    print("Running command:", " ".join(cmd_args))
-
-    return get_command_result(cmd_args)
+    return run_command(cmd_args)
 
 
 def get_metadata_aspect(git_objdir, commit_sha1, format_specifier):
@@ -203,7 +784,124 @@ def get_all_metadata_aspects(git_objdir, commit_sha1):
     return newdict
 
 
+def resolve_objects(git_objdir, revisions):
+    """
+    Resolves each revision to a (full sha1, object type) pair
+    using a persistent "cat-file" worker.
+
+    Unresolvable revisions map to (None, reason), where reason
+    is "missing" or "ambiguous".
+    """
+
+    return cat_file_pool.get_pool(GIT_BINARY_PATH, git_objdir).resolve(revisions)
+
+
+def resolve_refs(git_objdir, refs):
+    """
+    A drop-in replacement for parse_bulk_refs() that is answered
+    by a persistent "cat-file" worker instead of a new process.
+    """
+
+    try:
+        resolved = resolve_objects(git_objdir, refs)
+    except cat_file_pool.CatFileError as e:
+        return CommandResult(128, "", str(e))
+
+    error_lines = []
+    for ref, (sha1, reason) in zip(refs, resolved):
+        if sha1 is None:
+            error_lines.append("fatal: {} revision '{}'".format(reason, ref))
+
+    if error_lines:
+        return CommandResult(128, "", "\n".join(error_lines))
+
+    return CommandResult(0, "\n".join(sha1 for sha1, _ in resolved), "")
+
+
+def reset_object_readers(git_objdir):
+    """
+    Must be called after refs or objects in the repo change,
+    since "cat-file" workers do not notice updated refs.
+    """
+
+    cat_file_pool.restart(git_objdir)
+
+
+def discard_object_readers(git_objdir):
+    """
+    Must be called before a repo is deleted.
+    """
+
+    cat_file_pool.discard(git_objdir)
+
+
+def iter_metadata_batch(git_objdir, commit_sha1_list):
+    """
+    Yields all of the KEYS_AND_FORMAT_SPECIFIERS aspects of every
+    commit from a single "git log" process, as its output is read.
+
+    The commits must already be resolved to full sha1s.
+    Fields and commits are both delimited by NUL bytes,
+    which cannot appear in commit messages.  Bytes that are not
+    UTF-8, from commits that were made in another encoding without
+    saying so, are replaced rather than failing the whole batch.
+    """
+
+    if not commit_sha1_list:
+        return
+
+    keys = list(KEYS_AND_FORMAT_SPECIFIERS.keys())
+
+    cmd_args = [
+        GIT_BINARY_PATH,
+        '--git-dir', git_objdir,
+        'log',
+        '-z',
+        '--no-walk=unsorted',
+        '--stdin',
+        '--format=' + "%x00".join(KEYS_AND_FORMAT_SPECIFIERS[k] for k in keys),
+    ]
+
+    with tempfile.TemporaryFile() as stderr_file:
+        metrics.GIT_COMMANDS.inc(get_subcommand(cmd_args))
+        p = subprocess.Popen(cmd_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file)
+
+        # With --stdin, no output is produced until all input is read
+        p.stdin.write("".join(c + "\n" for c in commit_sha1_list).encode("utf-8"))
+        p.stdin.close()
+
+        fields = []
+        remainder = b""
+        for chunk in iter(lambda: p.stdout.read(64 * 1024), b""):
+            pieces = (remainder + chunk).split(b"\0")
+            remainder = pieces.pop()
+
+            for piece in pieces:
+                fields.append(piece.decode("utf-8", errors="replace").strip())
+                if len(fields) == len(keys):
+                    yield dict(zip(keys, fields))
+                    fields = []
+
+        # The output is usually terminated by a trailing NUL
+        if remainder:
+            fields.append(remainder.decode("utf-8", errors="replace").strip())
+            if len(fields) == len(keys):
+                yield dict(zip(keys, fields))
+
+        if p.wait():
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(p.returncode, cmd_args, stderr=stderr_file.read().decode("utf-8"))
+
+
+def get_metadata_batch(git_objdir, commit_sha1_list):
+    """
+    Returns a dict of commit metadata keyed by sha1.
+    """
+
+    return {metadata["sha1"]: metadata for metadata in iter_metadata_batch(git_objdir, commit_sha1_list)}
+
+
 if __name__ == "__main__":
     # Test rev-parse
 
-    parse_bulk_refs(CLONE_PATH, ["master", "add_xla_cpp_test", "boolPrint"])
\ No newline at end of file
+    parse_bulk_refs(repos.current().clone_path, ["master", "add_xla_cpp_test", "boolPrint"])
\ No newline at end of file
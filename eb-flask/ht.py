@@ -6,6 +6,7 @@ import os
 import arrow
 
 import db
+import repos
 
 
 STATIC_FILES_DIR = os.path.join(os.path.dirname(__file__), 'static')
@@ -40,7 +41,7 @@ def render_log_entry_html(duration, created_at, return_code, stdout, stderr):
 
 def dump_command_logs(cmd):
     list_content = ""
-    for x in db.get_operation_logs(cmd):
+    for x in db.get_operation_logs(repos.get_log_operation_name(cmd)):
         list_content += render_log_entry_html(*x)
 
     return '''
@@ -0,0 +1,150 @@
+"""
+Incremental reading and writing of large JSON bodies
+
+Request bodies are parsed as they arrive, and responses are written as
+newline-delimited JSON (one record per line), so that neither has to be
+held in memory in full.
+"""
+
+import codecs
+import json
+
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+READ_CHUNK_SIZE = 64 * 1024
+
+ELEMENT_DELIMITERS = ",] \t\r\n"
+
+
+class InvalidJsonError(ValueError):
+    """
+    Raised while reading a request body that is not valid JSON,
+    or is not an array or a sequence of newline-delimited records.
+    """
+
+
+class JsonArrayReader:
+    """
+    Decodes a binary stream holding a single JSON array, one element at a time.
+    """
+
+    def __init__(self, stream, chunk_size=READ_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.at_eof = False
+
+    def _read_more(self):
+        if self.at_eof:
+            return False
+
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.at_eof = True
+
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(chunk, final=self.at_eof)
+        self.position = 0
+        return True
+
+    def _next_char(self):
+        """
+        Skips whitespace and returns the next character without consuming it.
+        """
+
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self._read_more():
+                raise ValueError("Unexpected end of JSON array")
+
+    def _expect(self, chars):
+        c = self._next_char()
+        if c not in chars:
+            raise ValueError("Expected one of {} in JSON array, found {}".format(list(chars), repr(c)))
+
+        self.position += 1
+        return c
+
+    def _decode_element(self):
+
+        self._next_char()
+        while True:
+            try:
+                element, end = self.json_decoder.raw_decode(self.buffer, self.position)
+
+                # A number may continue in the next chunk unless a delimiter follows it
+                if self.at_eof or (end < len(self.buffer) and self.buffer[end] in ELEMENT_DELIMITERS):
+                    self.position = end
+                    return element
+
+            except ValueError:
+                if self.at_eof:
+                    raise
+
+            self._read_more()
+
+    def __iter__(self):
+
+        self._expect("[")
+        if self._next_char() == "]":
+            self.position += 1
+            return
+
+        while True:
+            yield self._decode_element()
+            if self._expect(",]") == "]":
+                return
+
+
+def iter_json_array(stream):
+
+    try:
+        yield from JsonArrayReader(stream)
+    except ValueError as e:
+        raise InvalidJsonError(str(e)) from e
+
+
+def iter_ndjson(stream):
+    """
+    Yields the record on each non-blank line of a binary stream.
+    """
+
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise InvalidJsonError("line {}: {}".format(line_number, e)) from e
+
+            yield record
+
+
+class CheckedItems:
+    """
+    Iterates over items read by iter_json_array() or iter_ndjson(),
+    stopping at the first parse error instead of raising it, so that
+    a streamed response can still answer the items before it.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.error = None
+
+    def __iter__(self):
+        try:
+            yield from self.items
+        except InvalidJsonError as e:
+            self.error = e
+
+
+def iter_ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record) + "\n"
@@ -2,24 +2,71 @@
 Long Git operations
 """
 
+import contextvars
+import functools
 import threading
 import os
 import datetime
 import subprocess
-from multiprocessing.pool import ThreadPool
+import time
 
-import db
+import fetch_scheduler
 import git
+import metrics
+import pr_refs
+import query_cache
+import repos
 
+# The index, database and snapshot modules are imported where they are
+# used, so that importing the application does not load them before a
+# request or a background operation needs them.
 
+
+# Minimum interval between the starts of full fetches
 RATE_LIMIT_SECONDS = 60
 
-REPO_CLONE_URL = "https://github.com/pytorch/pytorch.git"
+# Incremental fetches may miss refs, e.g. if a webhook delivery fails,
+# so everything is periodically re-fetched.
+FULL_FETCH_INTERVAL_SECONDS = 60 * 60
+
+# How often the schedule checks whether a full fetch is due
+FULL_FETCH_CHECK_SECONDS = 60
+
+# Maintenance of each repo is attempted this often...
+MAINTENANCE_INTERVAL_SECONDS = 24 * 60 * 60
+
+# ...and is due this long after startup, or retried this
+# long after finding the repo busy with another operation.
+MAINTENANCE_CHECK_SECONDS = 10 * 60
+
+# Mutating operations that may run at once across all repos.
+# Operations on the same repo are still serialized by its lock.
+MAX_PARALLEL_OPERATIONS = 4
+
 
+# Created on first use; see get_thread_pool()
+my_thread_pool = None
+thread_pool_lock = threading.Lock()
+
+# Fetches wait for their repo's lock while holding a pool thread,
+# so pool threads alone do not bound the operations actually running.
+operation_slots = threading.BoundedSemaphore(MAX_PARALLEL_OPERATIONS)
+
+
+def get_thread_pool():
+    """
+    Processes that only answer queries never start the pool's threads,
+    nor pay for importing multiprocessing.
+    """
 
-my_thread_pool = ThreadPool(1)
+    global my_thread_pool
 
-last_fetch_time = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    with thread_pool_lock:
+        if my_thread_pool is None:
+            from multiprocessing.pool import ThreadPool
+            my_thread_pool = ThreadPool(MAX_PARALLEL_OPERATIONS)
+
+    return my_thread_pool
 
 
 class OperationInfo:
@@ -30,95 +77,510 @@ class OperationInfo:
         self.mutating_operation_lock = threading.Lock()
 
 
-# A singleton
-current_operation_info = OperationInfo()
+class MirrorState:
+    """
+    Fetch bookkeeping of a single mirrored repo
+    """
+
+    def __init__(self, repo):
+        self.operation_info = OperationInfo()
+
+        self.last_fetch_time = datetime.datetime.now() - datetime.timedelta(minutes=5)
+
+        # Forces a reconciliation on the first fetch after startup
+        self.last_full_fetch_time = datetime.datetime.now() - datetime.timedelta(seconds=FULL_FETCH_INTERVAL_SECONDS)
+
+        # When the schedule last asked for a full fetch, which
+        # may still be waiting for the scheduler or running
+        self.last_full_fetch_request_time = None
+
+        # Ref name -> (old sha1, new sha1) for refs moved by the last fetch
+        self.last_ref_changes = {}
+
+        self.last_maintenance_start_time = None
+
+        self.fetch_scheduler = fetch_scheduler.FetchScheduler(
+            functools.partial(run_scheduled_fetch, repo),
+            full_fetch_min_interval_seconds=RATE_LIMIT_SECONDS)
+
+
+# One per mirrored repo
+mirror_states = repos.PerRepo(lambda: MirrorState(repos.current()))
 
 
 def render_status():
-    if current_operation_info.is_ongoing:
-        return "<p>Operation <code>{}</code> has been running since {}</p>".format(current_operation_info.operation, current_operation_info.started_at)
+    operation_info = mirror_states.current().operation_info
+    if operation_info.is_ongoing:
+        status_html = "<p>Operation <code>{}</code> has been running since {}</p>".format(operation_info.operation, operation_info.started_at)
     else:
-        return "<p>No operations ongoing.</p>"
+        status_html = "<p>No operations ongoing.</p>"
+
+    return status_html + render_maintenance_status()
+
+
+def render_maintenance_status():
+    import db
+
+    maintenance_logs = db.get_operation_logs(repos.get_log_operation_name("maintenance"))
+    if not maintenance_logs:
+        return "<p>No maintenance has run.</p>"
+
+    duration, created_at, return_code = maintenance_logs[0][:3]
+    return "<p>Last maintenance finished at {} UTC, took {:.1f} seconds and returned <code>{}</code></p>".format(created_at, duration, return_code)
+
+
+def run_locked_operation(operation, op_func):
+    """
+    The caller must hold the mutating operation lock of the
+    current repo, which is released once the operation finishes.
+    """
+    import db
+
+    operation_info = mirror_states.current().operation_info
+
+    try:
+        with operation_slots:
+            clone_start_time = datetime.datetime.now()
+            operation_info.operation = operation
+            operation_info.started_at = clone_start_time
+            operation_info.is_ongoing = True
+
+            foo = op_func()
+
+            clone_end_time = datetime.datetime.now()
+            elapsed_seconds = (clone_end_time - clone_start_time).total_seconds()
+
+        db.insert_operation_log(repos.get_log_operation_name(operation), elapsed_seconds, foo)
+
+    except subprocess.CalledProcessError as e:
+        exception_text = "Had a problem: " + str(e)
+        print(exception_text)
+
+    finally:
+        operation_info.is_ongoing = False
+        operation_info.mutating_operation_lock.release()
 
 
 def generic_git_op(operation, op_func, guard_func=None):
     """
     If the guard function exists and returns output, then
     the operation is skipped.
+
+    The operation runs on the pool in the current repo's context.
     """
 
-    acquired = current_operation_info.mutating_operation_lock.acquire(blocking=False)
+    operation_info = mirror_states.current().operation_info
+
+    acquired = operation_info.mutating_operation_lock.acquire(blocking=False)
     if acquired:
 
         if guard_func:
             guard_output = guard_func()
             if guard_output:
-                current_operation_info.mutating_operation_lock.release()
+                operation_info.mutating_operation_lock.release()
                 return {"status": "skipped", "message": guard_output}
 
+        context = contextvars.copy_context()
+
         def wrapped_func():
+            context.run(run_locked_operation, operation, op_func)
 
-            try:
-                clone_start_time = datetime.datetime.now()
-                current_operation_info.operation = operation
-                current_operation_info.started_at = clone_start_time
-                current_operation_info.is_ongoing = True
+        get_thread_pool().apply_async(wrapped_func)
+        return {"status": "started"}
 
-                foo = op_func()
+    else:
+        metrics.MUTATING_LOCK_BUSY.inc(repos.current().full_name, operation)
+        return {"status": "ongoing", "message": "Already working"}
 
-                clone_end_time = datetime.datetime.now()
-                elapsed_seconds = (clone_end_time - clone_start_time).total_seconds()
 
-                db.insert_operation_log(operation, elapsed_seconds, foo)
+def update_indexes(ref_changes=None, warmed_callback=None):
+    """
+    Without ref_changes from a fetch, all refs are rescanned.
 
-            except subprocess.CalledProcessError as e:
-                exception_text = "Had a problem: " + str(e)
-                print(exception_text)
+    Failing to update an index is not fatal, since
+    queries fall back to git for unindexed commits.
 
-            finally:
-                current_operation_info.is_ongoing = False
-                current_operation_info.mutating_operation_lock.release()
+    The persistent metadata and changed-path stores are filled last,
+    after warmed_callback is called, since filling them with the whole
+    history of a new database takes long, and requests fall back to
+    git for commits that are not stored yet.
+    """
+    import changed_paths
+    import commit_graph
+    import master_index
+    import metadata_store
+    import snapshots
+    import warmup
+
+    repo = repos.current()
+    graph = commit_graph.indexes.current()
+
+    try:
+        # The snapshot was published along with the ref changes
+        if ref_changes is None:
+            pr_refs.tables.current().load(snapshots.get_read_path())
+        else:
+            pr_refs.tables.current().apply_ref_changes(ref_changes, snapshots.get_read_path())
+
+        new_sha1s = graph.update(repo.clone_path, ref_changes)
+        print("Indexed %d new commits of %s" % (len(new_sha1s), repo.full_name))
+    except subprocess.CalledProcessError as e:
+        print("Could not update indexes of %s: %s" % (repo.full_name, e))
+        query_cache.invalidate_ref_dependent()
+        return
+
+    master = master_index.indexes.current()
+    master_sha1 = graph.indexed_refs.get("refs/heads/master")
+    if master_sha1 and master_sha1 != master.tip_sha1:
+        master.update(master_sha1)
+
+    query_cache.invalidate_ref_dependent()
+
+    warmup.warm_caches(ref_changes)
+    if warmed_callback:
+        warmed_callback()
+
+    metadata_store.fill_after_indexing(repo.clone_path, new_sha1s)
+    changed_paths.fill_after_indexing(repo.clone_path, new_sha1s)
+
+
+def publish_snapshot():
+    """
+    Failing to publish is not fatal, since queries
+    keep reading from the previous snapshot.
+    """
+    import snapshots
 
-        my_thread_pool.apply_async(wrapped_func)
-        return {"status": "started"}
-
-    else:
-        return {"status": "ongoing", "message": "Already working"}
+    try:
+        snapshots.publish()
+    except (subprocess.CalledProcessError, OSError) as e:
+        print("Could not publish snapshot of %s: %s" % (repos.current().full_name, e))
 
 
 def do_git_clone():
 
+    repo = repos.current()
+
     def guard_func():
-        if os.path.exists(git.CLONE_PATH):
+        if os.path.exists(repo.clone_path):
             return "Clone already exists."
 
     def op_function():
-        return git.bare_clone(REPO_CLONE_URL)
+        if os.path.exists(repo.bundle_path):
+            result = git.init_from_bundle(repo.clone_path, repo.bundle_path, repo.clone_url, repo.clone_filter)
+            # Only what changed since the bundle was made is fetched
+            if not result.return_code:
+                result = git.fetch_pr_refs(repo.clone_path)
+        else:
+            result = git.bare_clone(repo.clone_path, repo.clone_url, repo.clone_filter)
+
+        git.reset_object_readers(repo.clone_path)
+        publish_snapshot()
+        update_indexes()
+        return result
 
     return generic_git_op("clone", op_function, guard_func)
 
 
-def do_pr_fetch():
+def run_maintenance_steps(git_objdir):
+    """
+    Every step runs even if an earlier one fails.  Returns a
+    single result with the output of all steps, and the return
+    code of the first step that failed.
+    """
+
+    # Geometric repacking does not support the promisor packs of a partial
+    # clone, which hold no blobs and so are cheap to repack in full.
+    repack_func = git.repack_all if git.get_clone_filter(git_objdir) else git.repack_geometric
+
+    steps = [
+        git.pack_refs,
+        repack_func,
+        git.write_commit_graph,
+        git.prune_loose_objects,
+    ]
+
+    return_code = 0
+    stdout_parts = []
+    stderr_parts = []
+    for step_func in steps:
+        cmd_result = step_func(git_objdir)
+        if cmd_result.return_code and not return_code:
+            return_code = cmd_result.return_code
+
+        stdout_parts.append("{}: returned {}\n{}".format(step_func.__name__, cmd_result.return_code, cmd_result.stdout).strip())
+        if cmd_result.stderr:
+            stderr_parts.append("{}: {}".format(step_func.__name__, cmd_result.stderr))
+
+    return git.CommandResult(return_code, "\n".join(stdout_parts), "\n".join(stderr_parts))
+
+
+def do_maintenance():
+    """
+    Compacts refs and packs, and extends the commit-graph.
+    Runs under the mutating operation lock, so never during a fetch.
+    """
+
+    repo = repos.current()
+    state = mirror_states.current()
 
     def guard_func():
-        global last_fetch_time
+        if not os.path.exists(repo.clone_path):
+            return "No clone to maintain."
+
+    def op_function():
+        import snapshots
+
+        state.last_maintenance_start_time = datetime.datetime.now()
+        result = run_maintenance_steps(repo.clone_path)
+
+        # Workers pick up the new packs, bitmap and commit-graph on restart
+        git.reset_object_readers(repo.clone_path)
+        git.reset_object_readers(snapshots.get_read_path())
+        return result
+
+    return generic_git_op("maintenance", op_function, guard_func)
+
+
+def is_maintenance_due(state):
+
+    if state.last_maintenance_start_time is None:
+        return True
+
+    elapsed_seconds = (datetime.datetime.now() - state.last_maintenance_start_time).total_seconds()
+    return elapsed_seconds > MAINTENANCE_INTERVAL_SECONDS
+
+
+def run_maintenance_schedule():
+    """
+    Runs for the life of the process, starting maintenance
+    of each repo that has not been maintained recently.
+    """
 
-        current_time = datetime.datetime.now()
-        if (current_time - last_fetch_time).total_seconds() < RATE_LIMIT_SECONDS:
-            return "Will not fetch more than once per minute. Last fetch completed at {}".format(last_fetch_time)
+    while True:
+        time.sleep(MAINTENANCE_CHECK_SECONDS)
+
+        for repo in repos.all_repos():
+            with repos.use(repo):
+                if is_maintenance_due(mirror_states.current()):
+                    print("Maintenance of %s:" % repo.full_name, do_maintenance())
+
+
+def start_maintenance_schedule():
+    threading.Thread(target=run_maintenance_schedule, name="maintenance-scheduler", daemon=True).start()
+
+
+def is_full_fetch_due(state):
+
+    last_time = state.last_full_fetch_time
+    if state.last_full_fetch_request_time is not None:
+        last_time = max(last_time, state.last_full_fetch_request_time)
+
+    return (datetime.datetime.now() - last_time).total_seconds() > FULL_FETCH_INTERVAL_SECONDS
+
+
+def request_due_full_fetches():
+    """
+    Queues a full fetch of each cloned repo that has not had one for
+    FULL_FETCH_INTERVAL_SECONDS.
+    """
+
+    for repo in repos.all_repos():
+        with repos.use(repo):
+            state = mirror_states.current()
+            if os.path.exists(repo.clone_path) and is_full_fetch_due(state):
+                state.last_full_fetch_request_time = datetime.datetime.now()
+                print("Full fetch of %s:" % repo.full_name, do_pr_fetch())
+
+
+def run_full_fetch_schedule():
+    """
+    Runs for the life of the process, so that refs that incremental
+    fetches missed are fetched even while no webhook events arrive.
+    """
+
+    while True:
+        time.sleep(FULL_FETCH_CHECK_SECONDS)
+        request_due_full_fetches()
+
+
+def start_full_fetch_schedule():
+    threading.Thread(target=run_full_fetch_schedule, name="full-fetch-scheduler", daemon=True).start()
+
+
+def warm_up():
+    """
+    Publishes a snapshot of, indexes and warms up a repo that was
+    cloned before the process started.  Until the snapshot is
+    published, queries read from the mirror itself.
+
+    Like a fetch, waits for the repo's lock on the calling thread
+    rather than using the operation thread pool, which is only
+    created once an action is requested.
+
+    The repo is reported ready once its indexes and caches are warm,
+    before the persistent stores are filled, or once this has failed,
+    since queries fall back to git.
+    """
+    import warmup
+
+    repo = repos.current()
+    state = warmup.states.current()
+
+    def mark_ready():
+        state.ready = True
+
+    def operation_function():
+        publish_snapshot()
+        update_indexes(warmed_callback=mark_ready)
+        return git.CommandResult(0, "Warmed up %d commits" % state.last_commit_count, state.last_error or "")
+
+    try:
+        if os.path.exists(repo.clone_path):
+            mirror_states.current().operation_info.mutating_operation_lock.acquire()
+            run_locked_operation("warmup", operation_function)
+    finally:
+        state.ready = True
+
+
+def warm_up_all_repos():
+    """
+    Warms up every repo in turn.  A repo whose warm-up fails is reported
+    ready with the error, since queries fall back to git, and the
+    remaining repos are still warmed up.
+    """
+    import warmup
+
+    for repo in repos.all_repos():
+        with repos.use(repo):
+            try:
+                warm_up()
+            except Exception as e:
+                state = warmup.states.current()
+                state.last_error = "%s: %s" % (type(e).__name__, e)
+                state.ready = True
+                print("Could not warm up %s: %s" % (repo.full_name, state.last_error))
+
+
+def start_warm_up():
+    threading.Thread(target=warm_up_all_repos, name="warm-up", daemon=True).start()
+
+
+background_work_started = False
+background_work_lock = threading.Lock()
+
+
+def start_background_work():
+    """
+    Starts the warm-up of every repo, and the full fetch and
+    maintenance schedules, once per process.  Called when the first request arrives rather
+    than on import, so that importing the application starts no threads.
+
+    Raises UnsupportedGitVersionError, failing every request, if git
+    is too old to run them.
+    """
+
+    global background_work_started
+
+    with background_work_lock:
+        if background_work_started:
+            return
+
+        git.check_version()
+        background_work_started = True
+
+    start_warm_up()
+    start_full_fetch_schedule()
+    start_maintenance_schedule()
+
+
+def run_scheduled_fetch(repo, refspecs):
+    """
+    Called by the repo's fetch scheduler with the merged refspecs of
+    all pending requests, or None for a full fetch.  Waits for any
+    other mutating operation on the repo to finish rather than skipping.
+    """
+
+    with repos.use(repo):
+        run_fetch(repo, mirror_states.current(), refspecs)
+
+
+def run_fetch(repo, state, refspecs):
+
+    current_time = datetime.datetime.now()
+    full_fetch = refspecs is None or (current_time - state.last_full_fetch_time).total_seconds() > FULL_FETCH_INTERVAL_SECONDS
+    if full_fetch:
+        refspecs = git.FULL_FETCH_REFSPECS
 
     def operation_function():
-        result = git.fetch_pr_refs()
-        global last_fetch_time
-        last_fetch_time = datetime.datetime.now()
+
+        fetch_kind = "full" if full_fetch else "incremental"
+        size_before = git.get_object_store_size(repo.clone_path)
+        fetch_start_time = time.monotonic()
+
+        result, ref_changes = git.fetch_with_ref_changes(repo.clone_path, refspecs)
+
+        metrics.FETCH_SECONDS.observe(time.monotonic() - fetch_start_time, repo.full_name, fetch_kind)
+        metrics.FETCH_BYTES.inc(repo.full_name, fetch_kind, amount=max(0, git.get_object_store_size(repo.clone_path) - size_before))
+
+        git.reset_object_readers(repo.clone_path)
+        publish_snapshot()
+        update_indexes(ref_changes)
+
+        state.last_fetch_time = datetime.datetime.now()
+        if full_fetch:
+            state.last_full_fetch_time = state.last_fetch_time
+
+        state.last_ref_changes = ref_changes
         return result
 
-    return generic_git_op("fetch", operation_function, guard_func)
+    wait_start_time = time.monotonic()
+    state.operation_info.mutating_operation_lock.acquire()
+    metrics.MUTATING_LOCK_WAIT_SECONDS.observe(time.monotonic() - wait_start_time, repo.full_name, "fetch")
+
+    run_locked_operation("fetch", operation_function)
+
+
+def do_pr_fetch(refspecs=None):
+    """
+    Queues a fetch of the given refspecs, to be merged with any other
+    pending requests.  Without refspecs, fetches everything.
+    """
+
+    if refspecs is not None and not refspecs:
+        return {"status": "skipped", "message": "No mirrored refs are affected."}
+
+    return mirror_states.current().fetch_scheduler.request(refspecs)
+
+
+def get_fetch_queue_stats():
+    return {
+        "status": "complete",
+        "success": True,
+        "result": mirror_states.current().fetch_scheduler.get_stats(),
+    }
+
+
+def get_last_fetch_changes():
+
+    ref_changes_list = []
+    for refname, (old_sha1, new_sha1) in sorted(mirror_states.current().last_ref_changes.items()):
+        ref_changes_list.append({
+            "ref": refname,
+            "old_sha1": old_sha1,
+            "new_sha1": new_sha1,
+        })
+
+    return {
+        "status": "complete",
+        "success": True,
+        "result": ref_changes_list,
+    }
 
 
 def get_last_fetch_time():
 
-    global last_fetch_time
+    last_fetch_time = mirror_states.current().last_fetch_time
     return {
         "status": "complete",
         "success": True,
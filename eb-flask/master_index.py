@@ -0,0 +1,169 @@
+"""
+Precomputed index of master's first-parent chain
+
+Each commit on the chain is assigned its position, counting from the
+root commit.  Every other commit reachable from master is assigned the
+position of the first chain commit that it became reachable from, so
+"is this commit in master?" is a single array lookup.
+"""
+
+import array
+import heapq
+import threading
+
+import commit_graph
+import repos
+
+
+NOT_IN_MASTER = -1
+
+
+class MasterIndex:
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.update_lock = threading.Lock()
+        self.tip_sha1 = None
+
+        # Position -> commit graph id, oldest first
+        self.chain_ids = []
+
+        # Number of merge commits on the chain at or before each position
+        self.merge_counts = array.array('L')
+
+        # Commit graph id -> position at which it became reachable from master
+        self.merged_at = array.array('l')
+
+    def position_of(self, commit_id):
+        if commit_id >= len(self.merged_at):
+            return NOT_IN_MASTER
+
+        return self.merged_at[commit_id]
+
+    def chain_position(self, commit_id):
+        """
+        Returns the position of a commit on the first-parent chain, or None.
+        """
+
+        position = self.position_of(commit_id)
+        if NOT_IN_MASTER < position < len(self.chain_ids) and self.chain_ids[position] == commit_id:
+            return position
+
+        return None
+
+    def update(self, master_sha1):
+        """
+        Extends the chain up to the new master tip, or rebuilds it
+        from scratch if master was rewound.
+        """
+
+        with self.update_lock:
+            tip_id = self.graph.lookup(master_sha1)
+            if tip_id is None:
+                return
+
+            new_chain_ids = self._walk_to_chain(tip_id)
+            if new_chain_ids is None:
+                print("Master was rewound; rebuilding master index")
+                self.tip_sha1 = None
+                self.chain_ids = []
+                self.merge_counts = array.array('L')
+                self.merged_at = array.array('l')
+                new_chain_ids = self._walk_to_chain(tip_id)
+
+            self.merged_at.extend([NOT_IN_MASTER] * (len(self.graph) - len(self.merged_at)))
+
+            for chain_commit_id in reversed(new_chain_ids):
+                self._append_to_chain(chain_commit_id)
+
+            self.tip_sha1 = master_sha1
+
+    def _walk_to_chain(self, tip_id):
+        """
+        Returns the first-parent commits from the tip down to the current
+        end of the chain, newest first, or None if the tip does not
+        descend from the end of the chain.
+        """
+
+        new_chain_ids = []
+        commit_id = tip_id
+        while commit_id is not None and self.chain_position(commit_id) is None:
+            new_chain_ids.append(commit_id)
+            parent_ids = self.graph.parents[commit_id]
+            commit_id = parent_ids[0] if parent_ids else None
+
+        if self.chain_ids and (commit_id is None or self.chain_position(commit_id) != len(self.chain_ids) - 1):
+            return None
+
+        return new_chain_ids
+
+    def _append_to_chain(self, chain_commit_id):
+
+        position = len(self.chain_ids)
+        parent_ids = self.graph.parents[chain_commit_id]
+
+        previous_merge_count = self.merge_counts[-1] if self.merge_counts else 0
+        self.merge_counts.append(previous_merge_count + (len(parent_ids) > 1))
+
+        # Mark every newly reachable commit; the stack only
+        # descends into commits that have not been marked yet.
+        self.merged_at[chain_commit_id] = position
+        stack = list(parent_ids[1:])
+        while stack:
+            commit_id = stack.pop()
+            if self.merged_at[commit_id] == NOT_IN_MASTER:
+                self.merged_at[commit_id] = position
+                stack.extend(self.graph.parents[commit_id])
+
+        self.chain_ids.append(chain_commit_id)
+
+    def merge_base(self, commit_id):
+        """
+        Returns the id of a best common ancestor of master and the commit.
+
+        The commit's ancestors are visited in order of decreasing
+        generation number, without descending past commits in master.
+        """
+
+        if self.position_of(commit_id) != NOT_IN_MASTER:
+            return commit_id
+
+        visited = {commit_id}
+        queue = [(-self.graph.generations[commit_id], commit_id)]
+        while queue:
+            _, commit_id = heapq.heappop(queue)
+            if self.position_of(commit_id) != NOT_IN_MASTER:
+                return commit_id
+
+            for parent_id in self.graph.parents[commit_id]:
+                if parent_id not in visited:
+                    visited.add(parent_id)
+                    heapq.heappush(queue, (-self.graph.generations[parent_id], parent_id))
+
+        return None
+
+    def ancestry_path_count(self, base_id, branch_id):
+        """
+        Returns the "rev-list --ancestry-path --count base..branch" result
+        by subtracting chain positions, or None if that is not possible.
+
+        Subtraction is exact only when both commits are on the chain
+        and no merge commit between them brings in side branches.
+        """
+
+        base_position = self.chain_position(base_id)
+        branch_position = self.chain_position(branch_id)
+        if base_position is None or branch_position is None:
+            return None
+
+        if branch_position <= base_position:
+            return 0
+
+        if self.merge_counts[branch_position] != self.merge_counts[base_position]:
+            return None
+
+        return branch_position - base_position
+
+
+# One index per mirrored repo, over that repo's commit graph
+indexes = repos.PerRepo(lambda: MasterIndex(commit_graph.indexes.current()))
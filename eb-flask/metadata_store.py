@@ -0,0 +1,102 @@
+"""
+Persistent commit metadata store
+
+Keeps the KEYS_AND_FORMAT_SPECIFIERS fields of every indexed commit in
+the commit_metadata table of the database, so that metadata requests
+survive restarts without re-reading commit objects, and date range
+reads are answered without starting a git process.
+
+The store is filled with newly indexed commits after each fetch.
+"""
+
+import datetime
+import sqlite3
+import subprocess
+
+import commit_graph
+import db
+import git
+import master_index
+import repos
+
+
+# Commits read from git and committed per transaction
+FILL_CHUNK_SIZE = 5000
+
+COMMITTER_DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+
+def get_committer_timestamp(metadata):
+    """
+    Converts the "%ci" committer date to seconds since the epoch.
+    """
+
+    return int(datetime.datetime.strptime(metadata["committer_date"], COMMITTER_DATE_FORMAT).timestamp())
+
+
+def to_rows(metadata_list):
+    repo_name = repos.current().full_name
+    return [db.commit_metadata_row(repo_name, get_committer_timestamp(m), m) for m in metadata_list]
+
+
+def fill(git_objdir, sha1s):
+    """
+    Stores the metadata of those commits that are not stored yet.
+    Returns the number of commits added.
+    """
+
+    missing_sha1s = sorted(set(sha1s) - db.get_stored_sha1s(repos.current().full_name, sha1s))
+
+    for i in range(0, len(missing_sha1s), FILL_CHUNK_SIZE):
+        chunk = missing_sha1s[i:i + FILL_CHUNK_SIZE]
+        db.insert_commit_metadata(to_rows(git.iter_metadata_batch(git_objdir, chunk)))
+
+    return len(missing_sha1s)
+
+
+def fill_after_indexing(git_objdir, new_sha1s):
+    """
+    Failing to fill the store is not fatal, since
+    metadata requests fall back to git.
+    """
+
+    try:
+        added_count = fill(git_objdir, new_sha1s)
+        print("Stored metadata of %d commits of %s" % (added_count, repos.current().full_name))
+    except (sqlite3.Error, subprocess.CalledProcessError, ValueError) as e:
+        print("Could not store commit metadata of %s: %s" % (repos.current().full_name, e))
+
+
+def lookup(sha1s):
+    """
+    Returns a dict of metadata keyed by sha1, for the commits that are stored.
+    """
+
+    return db.get_commit_metadata(repos.current().full_name, sha1s)
+
+
+def remember(metadata_list):
+    """
+    Stores metadata that was read from git to answer a
+    request, without waiting for it to be committed.
+    """
+
+    db.insert_commit_metadata_buffered(to_rows(metadata_list))
+
+
+def iter_master_commits(since_timestamp, until_timestamp):
+    """
+    Yields the stored metadata of commits reachable from master
+    that were committed within the range, newest first.
+
+    Membership in master is checked against the master index,
+    so neither the range nor the filter touches git.
+    """
+
+    graph = commit_graph.indexes.current()
+    master = master_index.indexes.current()
+
+    for metadata in db.iter_commit_metadata_by_committer_time(repos.current().full_name, since_timestamp, until_timestamp):
+        commit_id = graph.lookup(metadata["sha1"])
+        if commit_id is not None and master.position_of(commit_id) != master_index.NOT_IN_MASTER:
+            yield metadata
@@ -0,0 +1,236 @@
+"""
+Prometheus-style metrics
+
+Each thread records into its own shard of counters, so that recording
+takes no lock.  Shards are only summed when /metrics is scraped, and
+the shards of finished threads are folded into a single retired shard.
+"""
+
+import bisect
+import math
+import threading
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+thread_local = threading.local()
+
+# (thread, shard) pairs; a shard maps (metric, label values) to a value
+shards = []
+retired_shard = {}
+shards_lock = threading.Lock()
+
+# Metrics in the order they are rendered
+defined_metrics = []
+
+# (name, type, help, label names, func) for values read at scrape time
+collectors = []
+
+
+# Finished threads' shards are also folded when this many have accumulated
+MAX_UNFOLDED_SHARDS = 64
+
+
+def fold_finished_shards():
+    """
+    The caller must hold the shards lock.
+    """
+
+    live_shards = []
+    for thread, shard in shards:
+        if thread.is_alive():
+            live_shards.append((thread, shard))
+        else:
+            # A finished thread no longer writes to its shard
+            for key, value in shard.items():
+                retired_shard[key] = key[0].merge(retired_shard.get(key), value)
+
+    shards[:] = live_shards
+
+
+def get_shard():
+
+    shard = getattr(thread_local, "shard", None)
+    if shard is None:
+        shard = thread_local.shard = {}
+        with shards_lock:
+            if len(shards) >= MAX_UNFOLDED_SHARDS:
+                fold_finished_shards()
+
+            shards.append((threading.current_thread(), shard))
+
+    return shard
+
+
+class Counter:
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        defined_metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        shard = get_shard()
+        key = (self, label_values)
+        shard[key] = shard.get(key, 0) + amount
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+    def render(self, label_values, value):
+        yield format_sample(self.name, self.label_names, label_values, value)
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (math.inf,)
+        defined_metrics.append(self)
+
+    def observe(self, value, *label_values):
+        shard = get_shard()
+        key = (self, label_values)
+
+        # Per-bucket counts, followed by the sum of observed values
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * len(self.buckets) + [0.0]
+
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self, label_values, value):
+
+        label_names = self.label_names + ("le",)
+
+        cumulative_count = 0
+        for upper_bound, count in zip(self.buckets, value):
+            cumulative_count += count
+            le = "+Inf" if upper_bound == math.inf else repr(float(upper_bound))
+            yield format_sample(self.name + "_bucket", label_names, label_values + (le,), cumulative_count)
+
+        yield format_sample(self.name + "_sum", self.label_names, label_values, value[-1])
+        yield format_sample(self.name + "_count", self.label_names, label_values, cumulative_count)
+
+
+def register_collector(name, metric_type, help_text, label_names, func):
+    """
+    The function returns a list of (label values, value)
+    pairs, and is called each time metrics are scraped.
+    """
+
+    collectors.append((name, metric_type, help_text, tuple(label_names), func))
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_sample(name, label_names, label_values, value):
+
+    if label_names:
+        labels_text = ",".join('{}="{}"'.format(k, escape_label_value(v)) for k, v in zip(label_names, label_values))
+        name = "{}{{{}}}".format(name, labels_text)
+
+    return "{} {}".format(name, value)
+
+
+def get_totals():
+
+    with shards_lock:
+        fold_finished_shards()
+
+        totals = {key: key[0].merge(None, value) for key, value in retired_shard.items()}
+        for _, shard in shards:
+            for key, value in shard.copy().items():
+                totals[key] = key[0].merge(totals.get(key), value)
+
+    return totals
+
+
+def render():
+    """
+    Returns all metrics in the Prometheus text format.
+    """
+
+    values_by_metric = {}
+    for (metric, label_values), value in get_totals().items():
+        values_by_metric.setdefault(metric, []).append((label_values, value))
+
+    lines = []
+    for metric in defined_metrics:
+        metric_type = "histogram" if isinstance(metric, Histogram) else "counter"
+        lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+        lines.append("# TYPE {} {}".format(metric.name, metric_type))
+
+        for label_values, value in sorted(values_by_metric.get(metric, []), key=lambda x: x[0]):
+            lines.extend(metric.render(label_values, value))
+
+    for name, metric_type, help_text, label_names, func in collectors:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+
+        for label_values, value in func():
+            lines.append(format_sample(name, label_names, label_values, value))
+
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter(
+    "gadgit_http_requests_total",
+    "HTTP requests served, by route pattern",
+    ["route", "method", "status"])
+
+REQUEST_SECONDS = Histogram(
+    "gadgit_http_request_duration_seconds",
+    "Time to produce an HTTP response, by route pattern",
+    ["route", "method"])
+
+GIT_COMMANDS = Counter(
+    "gadgit_git_commands_total",
+    "Git processes started, by subcommand",
+    ["subcommand"])
+
+GIT_COMMAND_SECONDS = Histogram(
+    "gadgit_git_command_duration_seconds",
+    "Run time of short-lived git processes, by subcommand",
+    ["subcommand"])
+
+FETCH_SECONDS = Histogram(
+    "gadgit_fetch_duration_seconds",
+    "Duration of git fetches",
+    ["repo", "kind"])
+
+FETCH_BYTES = Counter(
+    "gadgit_fetch_bytes_total",
+    "Growth of the object store due to fetches",
+    ["repo", "kind"])
+
+MUTATING_LOCK_WAIT_SECONDS = Histogram(
+    "gadgit_mutating_lock_wait_seconds",
+    "Time spent waiting for the mutating operation lock",
+    ["repo", "operation"])
+
+MUTATING_LOCK_BUSY = Counter(
+    "gadgit_mutating_lock_busy_total",
+    "Operations rejected because another mutating operation held the lock",
+    ["repo", "operation"])
+
+INDEX_LOOKUPS = Counter(
+    "gadgit_index_lookups_total",
+    "Revisions looked up in the commit graph index, by whether they were found",
+    ["result"])
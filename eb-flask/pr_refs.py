@@ -0,0 +1,113 @@
+"""
+In-memory table of PR head refs
+
+Answers "which commit is the head of PR N?" and "which PRs have
+commit X as their head?" without listing refs on every query.
+"""
+
+import git
+import repos
+
+
+def pr_number_of_head_ref(refname):
+    """
+    Returns None for refs other than PR head refs.
+    """
+
+    if not refname.startswith(git.PR_REF_PREFIX):
+        return None
+
+    ref_parts = refname.split("/")
+    if ref_parts[-1] == "head" and ref_parts[-2].isdigit():
+        return int(ref_parts[-2])
+
+    return None
+
+
+class PullRequestRefTable:
+    """
+    The mappings are replaced as a whole on every change, so
+    readers always see a consistent pair of mappings.
+    """
+
+    def __init__(self):
+        self.mappings = None
+
+        # The snapshot that the mappings were read from
+        self.source_path = None
+
+    def is_loaded(self):
+        return self.mappings is not None
+
+    def load(self, git_objdir):
+
+        heads_by_pr = {}
+        prs_by_head = {}
+        for refname, sha1 in git.snapshot_refs(git_objdir, [git.PR_REF_PREFIX]).items():
+            pr_number = pr_number_of_head_ref(refname)
+            if pr_number is not None:
+                heads_by_pr[pr_number] = sha1
+                prs_by_head.setdefault(sha1, set()).add(pr_number)
+
+        self.mappings = (heads_by_pr, prs_by_head)
+        self.source_path = git_objdir
+
+    def ensure_loaded(self, git_objdir):
+        """
+        Loads the table on first use, so that queries do not need to
+        wait for a fetch after the application starts.
+
+        Only the process that fetched applies the ref changes to its
+        table, so the table is loaded again whenever the snapshot to
+        read from is one that another process published.
+        """
+
+        if not self.is_loaded() or git_objdir != self.source_path:
+            self.load(git_objdir)
+
+    def apply_ref_changes(self, ref_changes, git_objdir):
+        """
+        Updates only the PRs whose head refs moved, to match the
+        snapshot published with them.  An unloaded table is left
+        to be loaded in full on first use.
+        """
+
+        if not self.is_loaded():
+            return
+
+        old_heads_by_pr, old_prs_by_head = self.mappings
+        heads_by_pr = dict(old_heads_by_pr)
+        prs_by_head = dict(old_prs_by_head)
+
+        for refname, (old_sha1, new_sha1) in ref_changes.items():
+            pr_number = pr_number_of_head_ref(refname)
+            if pr_number is None:
+                continue
+
+            # Sets are copied before modification, since
+            # the old mappings may still be in use.
+            if old_sha1 in prs_by_head:
+                prs_by_head[old_sha1] = prs_by_head[old_sha1] - {pr_number}
+                if not prs_by_head[old_sha1]:
+                    del prs_by_head[old_sha1]
+
+            if new_sha1 is None:
+                heads_by_pr.pop(pr_number, None)
+            else:
+                heads_by_pr[pr_number] = new_sha1
+                prs_by_head[new_sha1] = prs_by_head.get(new_sha1, set()) | {pr_number}
+
+        self.mappings = (heads_by_pr, prs_by_head)
+        self.source_path = git_objdir
+
+    def head_of(self, pr_number):
+        heads_by_pr, _ = self.mappings
+        return heads_by_pr.get(pr_number)
+
+    def pointing_prs(self, commit_sha1):
+        _, prs_by_head = self.mappings
+        return sorted(prs_by_head.get(commit_sha1, []))
+
+
+# One table per mirrored repo
+tables = repos.PerRepo(PullRequestRefTable)
@@ -0,0 +1,192 @@
+"""
+Response cache for query results
+
+Answers whose inputs are all full sha1s, such as whether one commit is
+an ancestor of another, can never change and are kept until evicted.
+Answers that depend on refs, such as the merge base with master, are
+dropped whenever a fetch completes, and whenever queries start reading
+from a snapshot that another process published.
+"""
+
+import collections
+import functools
+import inspect
+import string
+import threading
+
+import repos
+import snapshots
+
+
+IMMUTABLE_MAX_ENTRIES = 100000
+
+REF_DEPENDENT_MAX_ENTRIES = 10000
+
+
+def is_full_sha1(value):
+    return isinstance(value, str) and len(value) == 40 and all(c in string.hexdigits for c in value)
+
+
+class LruCache:
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+        # Incremented on clear(), so that values computed
+        # before a clear are not stored after it.
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns a (found, value) pair.
+        """
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, generation):
+
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class RepoCaches:
+
+    def __init__(self):
+        self.immutable = LruCache(IMMUTABLE_MAX_ENTRIES)
+        self.ref_dependent = LruCache(REF_DEPENDENT_MAX_ENTRIES)
+
+        # The snapshot that the ref-dependent answers were read from
+        self.snapshot_path = None
+
+    def get_ref_dependent(self, read_path):
+        """
+        Returns the ref-dependent cache, emptied first if queries now
+        read from another snapshot than its answers were read from.
+        """
+
+        if read_path != self.snapshot_path:
+            self.ref_dependent.clear()
+            self.snapshot_path = read_path
+
+        return self.ref_dependent
+
+    def clear(self):
+        self.immutable.clear()
+        self.ref_dependent.clear()
+
+
+# Sha1s are only meaningful within a repo, so each repo has its own caches
+caches = repos.PerRepo(RepoCaches)
+
+
+def cached_query(ref_dependent=False):
+    """
+    Caches successful results of a query function returning a result dict.
+    The query function may also be a coroutine function.
+
+    Results are only treated as immutable if every argument is a full
+    sha1 and the query does not otherwise depend on refs.
+
+    Entries are keyed by the function name, so synchronous and
+    asynchronous versions of a query with the same name share them.
+    """
+
+    def decorator(query_func):
+
+        signature = inspect.signature(query_func)
+
+        def lookup(args, kwargs):
+
+            # Flask passes URL parameters as keyword arguments
+            args = signature.bind(*args, **kwargs).args
+
+            immutable = not ref_dependent and all(is_full_sha1(arg) for arg in args)
+            repo_caches = caches.current()
+            cache = repo_caches.immutable if immutable else repo_caches.get_ref_dependent(snapshots.get_read_path())
+
+            key = (query_func.__name__,) + args
+            found, value = cache.get(key)
+            return args, cache, key, found, value
+
+        def store(cache, key, value, generation):
+            if value.get("success"):
+                cache.put(key, value, generation)
+
+        if inspect.iscoroutinefunction(query_func):
+
+            @functools.wraps(query_func)
+            async def wrapper(*args, **kwargs):
+
+                args, cache, key, found, value = lookup(args, kwargs)
+                if found:
+                    return value
+
+                generation = cache.generation
+                value = await query_func(*args)
+                store(cache, key, value, generation)
+                return value
+
+        else:
+
+            @functools.wraps(query_func)
+            def wrapper(*args, **kwargs):
+
+                args, cache, key, found, value = lookup(args, kwargs)
+                if found:
+                    return value
+
+                generation = cache.generation
+                value = query_func(*args)
+                store(cache, key, value, generation)
+                return value
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate_ref_dependent():
+    caches.current().ref_dependent.clear()
+
+
+def get_stats():
+    repo_caches = caches.current()
+    return {
+        "immutable": repo_caches.immutable.get_stats(),
+        "ref_dependent": repo_caches.ref_dependent.get_stats(),
+    }
@@ -0,0 +1,135 @@
+"""
+Mirrored repositories
+
+Each mirrored repo has its own clone, fetch lock and scheduler, and
+its own indexes and caches.  The repo that a request or background job
+acts on is held in a context variable, so that code deep in the call
+stack finds the right clone and indexes without taking a repo argument.
+
+Unscoped routes act on the default repo, which is the first one listed.
+"""
+
+import contextlib
+import contextvars
+import os
+import threading
+
+
+# Comma-separated GitHub "owner/name" repos to mirror
+REPOS_ENV_VAR = "GADGIT_REPOS"
+
+# Object filter for new clones, e.g. "blob:none", or empty for full clones.
+# Queries only read commits and trees, so blobs are never needed.
+CLONE_FILTER_ENV_VAR = "GADGIT_CLONE_FILTER"
+
+DEFAULT_CLONE_FILTER = "blob:none"
+
+DEFAULT_REPO_NAMES = ["pytorch/pytorch"]
+
+# In contrast with the "/opt/python/current/app" directory in which the
+# python application files are stored, the "/var/opt" directory persists
+# across application redeployments.  This persistence is desirable as a
+# fresh fetch of all of the pytorch PR refs can take over 10 minutes.
+CLONE_ROOT = '/var/opt/gadgit/repo'
+
+# Clones made before multiple repos were supported
+LEGACY_CLONE_PATHS = {
+    "pytorch/pytorch": os.path.join(CLONE_ROOT, "pytorch.git"),
+}
+
+
+class Repo:
+
+    def __init__(self, full_name, clone_path=None):
+        self.full_name = full_name
+        self.clone_path = clone_path or LEGACY_CLONE_PATHS.get(full_name) or os.path.join(CLONE_ROOT, full_name + ".git")
+        self.clone_url = "https://github.com/{}.git".format(full_name)
+        self.clone_filter = os.environ.get(CLONE_FILTER_ENV_VAR, DEFAULT_CLONE_FILTER) or None
+
+        # If this file exists, a new clone is seeded from it
+        # and then only fetches what the bundle lacks.
+        self.bundle_path = os.path.splitext(self.clone_path)[0] + ".bundle"
+
+
+def get_configured_names():
+    names = [x.strip() for x in os.environ.get(REPOS_ENV_VAR, "").split(",") if x.strip()]
+    return names or DEFAULT_REPO_NAMES
+
+
+# GitHub repo names are case-insensitive
+repos_by_name = {name.lower(): Repo(name) for name in get_configured_names()}
+
+default_repo = repos_by_name[get_configured_names()[0].lower()]
+
+current_repo = contextvars.ContextVar("current_repo", default=default_repo)
+
+
+def get(full_name):
+    """
+    Returns None if the repo is not mirrored.
+    """
+
+    return repos_by_name.get(full_name.lower())
+
+
+def all_repos():
+    return list(repos_by_name.values())
+
+
+def current():
+    return current_repo.get()
+
+
+@contextlib.contextmanager
+def use(repo):
+
+    token = current_repo.set(repo)
+    try:
+        yield repo
+    finally:
+        current_repo.reset(token)
+
+
+def get_log_operation_name(operation):
+    """
+    Operations on the default repo are logged under their plain
+    names, as they were before multiple repos were supported.
+    """
+
+    repo = current()
+    if repo is default_repo:
+        return operation
+
+    return repo.full_name + ":" + operation
+
+
+class PerRepo:
+    """
+    Holds a separate instance of some state for each repo,
+    created by calling the factory on first use within that repo.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.instances = {}
+
+    def current(self):
+
+        repo = current()
+        instance = self.instances.get(repo.full_name)
+        if instance is None:
+            with self.lock:
+                instance = self.instances.get(repo.full_name)
+                if instance is None:
+                    instance = self.factory()
+                    self.instances[repo.full_name] = instance
+
+        return instance
+
+    def items(self):
+        """
+        Returns (repo name, instance) pairs for the repos used so far.
+        """
+
+        return sorted(self.instances.items())
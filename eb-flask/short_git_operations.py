@@ -6,9 +6,17 @@ Short Git operations
 Defines the structure of JSON responses for the web API
 """
 
+import datetime
 import string
+import subprocess
 
+import commit_graph
 import git
+import master_index
+import metrics
+import pr_refs
+import query_cache
+import snapshots
 
 
 def is_hex_string(s):
@@ -23,6 +31,89 @@ def format_error(error_message):
     }
 
 
+def format_result(value):
+    return {
+        "status": "complete",
+        "success": True,
+        "result": value,
+    }
+
+
+def lookup_indexed_commit_ids(revisions):
+    """
+    Returns the commit graph id of each revision,
+    or None for revisions that are not in the index.
+
+    Full sha1s are looked up directly; other revisions are
+    resolved together by a persistent "cat-file" worker.
+    """
+
+    index = commit_graph.indexes.current()
+    commit_ids = [index.lookup(r) for r in revisions]
+
+    unresolved = list(set(r for r, commit_id in zip(revisions, commit_ids) if commit_id is None and isinstance(r, str)))
+    if unresolved:
+        try:
+            resolved = dict(zip(unresolved, git.resolve_objects(snapshots.get_read_path(), unresolved)))
+        except git.cat_file_pool.CatFileError:
+            return commit_ids
+
+        commit_ids = [index.lookup(resolved[r][0]) if r in resolved else commit_id for r, commit_id in zip(revisions, commit_ids)]
+
+    hit_count = len(commit_ids) - commit_ids.count(None)
+    metrics.INDEX_LOOKUPS.inc("hit", amount=hit_count)
+    metrics.INDEX_LOOKUPS.inc("miss", amount=len(commit_ids) - hit_count)
+
+    return commit_ids
+
+
+def lookup_indexed_commits(revisions):
+    """
+    Returns the commit graph ids of the revisions, or None
+    if any of them is not in the index.
+    """
+
+    commit_ids = lookup_indexed_commit_ids(revisions)
+    if None in commit_ids:
+        return None
+
+    return commit_ids
+
+
+def lookup_or_index_commit_ids(revisions):
+    """
+    Returns the commit graph id of each revision, and a dict of error
+    messages for the revisions that do not name a commit.
+
+    Commits that no indexed ref reaches are added to the index with a
+    single git process, so that bulk queries never need one git
+    process per item.  Tags are peeled, as git's ancestry commands do.
+    """
+
+    commit_ids = lookup_indexed_commit_ids(revisions)
+    unindexed = list(set(r for r, commit_id in zip(revisions, commit_ids) if commit_id is None))
+    if not unindexed:
+        return commit_ids, {}
+
+    errors = {}
+    sha1s_by_revision = {}
+    read_path = snapshots.get_read_path()
+    index = commit_graph.indexes.current()
+    try:
+        for revision, (sha1, reason) in zip(unindexed, git.resolve_objects(read_path, [r + "^{commit}" for r in unindexed])):
+            if sha1 is None:
+                errors[revision] = "commit {} is {}".format(revision, reason)
+            else:
+                sha1s_by_revision[revision] = sha1
+
+        index.extend(read_path, sha1s_by_revision.values())
+    except (git.cat_file_pool.CatFileError, subprocess.CalledProcessError) as e:
+        return commit_ids, {r: str(e) for r in unindexed}
+
+    commit_ids = [index.lookup(sha1s_by_revision.get(r)) if commit_id is None else commit_id for r, commit_id in zip(revisions, commit_ids)]
+    return commit_ids, errors
+
+
 def format_query_result(
         cmd_result,
         value_process_func=lambda x: x.stdout,
@@ -42,51 +133,300 @@ def format_query_result(
     return mydict
 
 
+# Streamed inputs are processed in batches of this many items
+STREAM_CHUNK_SIZE = 500
+
+
+def iter_chunks(items, chunk_size=STREAM_CHUNK_SIZE):
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def resolve_commit_items(items):
+    """
+    Resolves the items of a request body like git.resolve_objects(),
+    mapping items that are not strings to (None, "not a string").
+    """
+
+    string_items = list(set(item for item in items if isinstance(item, str)))
+    resolved = dict(zip(string_items, git.resolve_objects(snapshots.get_read_path(), string_items)))
+
+    return [resolved[item] if isinstance(item, str) else (None, "not a string") for item in items]
+
+
+def iter_metadata(commit_sha1s):
+    """
+    Yields the same entries as fetch_metadata_batch(),
+    reading from git one chunk of the input at a time.
+
+    If git fails, each commit of the chunk gets an error entry,
+    since the response has already been partly written.
+    """
+
+    for chunk in iter_chunks(commit_sha1s):
+        try:
+            yield from fetch_metadata_batch(chunk)
+        except (git.cat_file_pool.CatFileError, subprocess.CalledProcessError) as e:
+            for commit_sha1 in chunk:
+                yield {
+                    "sha1": commit_sha1,
+                    "error": str(e),
+                }
+
+
 def fetch_metadata_batch(commit_sha1_list):
+    """
+    Commits that cannot be resolved get an entry with an "error" key
+    in place of their metadata, so that the output list stays
+    aligned with the input list.
+    """
+    import metadata_store
+
+    resolved = resolve_commit_items(commit_sha1_list)
+
+    valid_sha1s = set(sha1 for sha1, objecttype in resolved if objecttype == "commit")
+
+    # Metadata of a commit never changes, so only uncached commits are read from git
+    metadata_cache = query_cache.caches.current().immutable
+    generation = metadata_cache.generation
+
+    metadata_by_sha1 = {}
+    for sha1 in valid_sha1s:
+        found, metadata = metadata_cache.get(("metadata", sha1))
+        if found:
+            metadata_by_sha1[sha1] = metadata
+
+    # Then from the persistent store
+    stored_metadata_by_sha1 = metadata_store.lookup(valid_sha1s - set(metadata_by_sha1))
+    for sha1, metadata in stored_metadata_by_sha1.items():
+        metadata_cache.put(("metadata", sha1), metadata, generation)
+
+    metadata_by_sha1.update(stored_metadata_by_sha1)
+
+    fetched_metadata_by_sha1 = git.get_metadata_batch(snapshots.get_read_path(), sorted(valid_sha1s - set(metadata_by_sha1)))
+    for sha1, metadata in fetched_metadata_by_sha1.items():
+        metadata_cache.put(("metadata", sha1), metadata, generation)
+
+    metadata_store.remember(fetched_metadata_by_sha1.values())
+    metadata_by_sha1.update(fetched_metadata_by_sha1)
 
     metadata_list = []
+    for commit_sha1, (full_sha1, objecttype) in zip(commit_sha1_list, resolved):
+        if full_sha1 is None:
+            error_message = "commit {} is {}".format(commit_sha1, objecttype)
+        elif objecttype != "commit":
+            error_message = "object {} is a {}, not a commit".format(commit_sha1, objecttype)
+        elif full_sha1 not in metadata_by_sha1:
+            error_message = "metadata for commit {} could not be read".format(commit_sha1)
+        else:
+            metadata_list.append(metadata_by_sha1[full_sha1])
+            continue
 
-    failed_sha1s = []
-    for i, commit_sha1 in enumerate(commit_sha1_list):
-        print("Progress: %d/%d" % (i + 1, len(commit_sha1_list)))
-        try:
-            metadata_list.append(git.get_all_metadata_aspects(git.CLONE_PATH, commit_sha1))
-        except:
-            print("Skipping", commit_sha1)
-            failed_sha1s.append(commit_sha1)
+        metadata_list.append({
+            "sha1": commit_sha1,
+            "error": error_message,
+        })
 
     return metadata_list
 
 
-def git_pointing_prs(commit):
+def parse_timestamp(value):
+    """
+    Accepts seconds since the epoch, or an ISO 8601 date or
+    date and time, which is taken to be UTC without an offset.
+    """
+
+    if value.isdigit():
+        return int(value)
+
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+
+    return int(parsed.timestamp())
+
+
+def prepare_master_commit_metadata(since, until=None):
+    """
+    Returns an error result and None, or None and an iterator of the
+    metadata of master commits committed since and before the given
+    times, newest first.  Read from the metadata store, not from git.
+    """
+    import metadata_store
+
+    try:
+        since_timestamp = parse_timestamp(since)
+        until_timestamp = parse_timestamp(until) if until else 2 ** 62
+    except (AttributeError, ValueError):
+        return format_error("times must be ISO 8601 or seconds since the epoch; got since={} until={}".format(since, until)), None
+
+    if master_index.indexes.current().tip_sha1 is None:
+        return format_error("master has not been indexed yet"), None
+
+    return None, metadata_store.iter_master_commits(since_timestamp, until_timestamp)
+
+
+def get_pr_ref_table():
+    """
+    Returns None if the table cannot be loaded,
+    in which case queries fall back to git.
     """
-    A bit slow; may take around 0.5 seconds
+
+    table = pr_refs.tables.current()
+    try:
+        table.ensure_loaded(snapshots.get_read_path())
+    except subprocess.CalledProcessError as e:
+        print("Could not load PR ref table: " + str(e))
+        return None
+
+    return table
+
+
+def pointing_prs_from_index(commit):
+    """
+    Returns None if the PR ref table is unavailable.
     """
 
     if not is_hex_string(commit):
         return format_error("commit {} is not a hexadecimal string".format(commit))
 
-    cmd_result = git.current_pointing_prs(git.CLONE_PATH, commit)
+    table = get_pr_ref_table()
+    if not table:
+        return None
+
+    commit_sha1 = commit
+    if len(commit) != 40:
+        [(commit_sha1, _)] = git.resolve_objects(snapshots.get_read_path(), [commit])
+        if commit_sha1 is None:
+            return format_error("malformed object name {}".format(commit))
+
+    return format_result(table.pointing_prs(commit_sha1))
+
+
+def format_pointing_prs_result(cmd_result):
     return format_query_result(cmd_result, lambda x: list(map(lambda x: int(x.split("/")[-2]), x.stdout.split())))
 
 
-def parse_refs_with_individual_error_handling(refs):
+@query_cache.cached_query(ref_dependent=True)
+def git_pointing_prs(commit):
+    """
+    Answered from the in-memory PR ref table; falling back to git
+    may take around 0.5 seconds.
+    """
 
-    results = []
+    result = pointing_prs_from_index(commit)
+    if result is None:
+        result = format_pointing_prs_result(git.current_pointing_prs(snapshots.get_read_path(), commit))
+
+    return result
+
+
+def resolve_refs_individually(refs):
+    """
+    Returns a result dict for each ref, resolving all of them
+    in a single pass of a persistent "cat-file" worker.
+    """
+
+    string_refs = [ref for ref in refs if isinstance(ref, str)]
+    try:
+        resolved = dict(zip(string_refs, git.resolve_objects(snapshots.get_read_path(), string_refs)))
+    except git.cat_file_pool.CatFileError as e:
+        return [format_error(str(e)) for _ in refs]
+
+    outputs = []
     for ref in refs:
-        cmd_result = git.parse_bulk_refs(git.CLONE_PATH, [ref])
-        formatted_result = format_query_result(cmd_result)
+        if not isinstance(ref, str):
+            outputs.append(format_error("ref {} is not a string".format(ref)))
+            continue
 
-        entry_dict = {
-            "ref": ref,
-            "output": formatted_result,
-        }
-        results.append(entry_dict)
+        sha1, reason = resolved[ref]
+        if sha1 is None:
+            outputs.append(format_error("fatal: {} revision '{}'".format(reason, ref)))
+        else:
+            outputs.append(format_result(sha1))
 
-    return results
+    return outputs
 
 
-def git_commit_distance(base, branch):
+def resolve_pull_request_heads(pr_numbers):
+    """
+    Returns a result dict for each PR number, from the in-memory
+    PR ref table if possible, and otherwise from a single
+    pass of a persistent "cat-file" worker.
+    """
+
+    table = get_pr_ref_table()
+
+    outputs = [None] * len(pr_numbers)
+    unresolved_indices = []
+    for i, pr_number in enumerate(pr_numbers):
+        if not isinstance(pr_number, int) or isinstance(pr_number, bool):
+            outputs[i] = format_error("PR number {} is not an integer".format(pr_number))
+        elif table is None:
+            unresolved_indices.append(i)
+        else:
+            head_sha1 = table.head_of(pr_number)
+            if head_sha1 is None:
+                outputs[i] = format_error("fatal: missing revision '{}'".format(git.PR_REF_TEMPLATE % pr_number))
+            else:
+                outputs[i] = format_result(head_sha1)
+
+    pr_refs_list = [git.PR_REF_TEMPLATE % pr_numbers[i] for i in unresolved_indices]
+    for i, output in zip(unresolved_indices, resolve_refs_individually(pr_refs_list)):
+        outputs[i] = output
+
+    return outputs
+
+
+def combine_outputs(outputs, value_process_func):
+    """
+    Produces a single result dict that fails if any of the
+    individual outputs failed.
+    """
+
+    errors = [output["error"] for output in outputs if not output["success"]]
+    if errors:
+        return format_error("\n".join(errors))
+
+    return format_result(value_process_func([output["result"] for output in outputs]))
+
+
+def iter_ref_resolutions(refs):
+
+    for chunk in iter_chunks(refs):
+        for ref, formatted_result in zip(chunk, resolve_refs_individually(chunk)):
+            yield {
+                "ref": ref,
+                "output": formatted_result,
+            }
+
+
+def iter_pull_request_heads(pr_numbers):
+
+    for chunk in iter_chunks(pr_numbers):
+        for pr_number, formatted_result in zip(chunk, resolve_pull_request_heads(chunk)):
+            yield {
+                "pr_number": pr_number,
+                "output": formatted_result,
+            }
+
+
+def parse_refs_with_individual_error_handling(refs):
+    return list(iter_ref_resolutions(refs))
+
+
+def commit_distance_from_index(base, branch):
+    """
+    Returns None if either commit is not indexed.
+    """
 
     if not is_hex_string(base):
         return format_error("commit {} is not a hexadecimal string".format(base))
@@ -94,33 +434,137 @@ def git_commit_distance(base, branch):
     if not is_hex_string(branch):
         return format_error("commit {} is not a hexadecimal string".format(branch))
 
-    cmd_result = git.commit_distance(git.CLONE_PATH, base, branch)
+    commit_ids = lookup_indexed_commits([base, branch])
+    if not commit_ids:
+        return None
+
+    distance = master_index.indexes.current().ancestry_path_count(*commit_ids)
+    if distance is None:
+        distance = commit_graph.indexes.current().ancestry_path_count(*commit_ids)
+
+    return format_result(distance)
+
+
+def format_commit_distance_result(cmd_result):
     return format_query_result(cmd_result, lambda x: int(x.stdout))
 
 
+@query_cache.cached_query()
+def git_commit_distance(base, branch):
+
+    result = commit_distance_from_index(base, branch)
+    if result is None:
+        result = format_commit_distance_result(git.commit_distance(snapshots.get_read_path(), base, branch))
+
+    return result
+
+
+@query_cache.cached_query(ref_dependent=True)
 def git_pull_request_head_commit(pr):
-    cmd_result = git.pull_request_head_commit(git.CLONE_PATH, int(pr))
-    return format_query_result(cmd_result)
 
+    [output] = resolve_pull_request_heads([int(pr)])
+    return output
 
-def git_master_merge_base(commit):
+
+def indexed_master_merge_base(master_id, commit_id):
+    """
+    Returns None if the commit has no common ancestor with master.
+    """
+
+    graph = commit_graph.indexes.current()
+    master = master_index.indexes.current()
+
+    # The master index is only usable if it is up to date with the master ref
+    if master.tip_sha1 == graph.sha1s[master_id]:
+        merge_base_id = master.merge_base(commit_id)
+    else:
+        merge_base_id = graph.merge_base(master_id, commit_id)
+
+    if merge_base_id is None:
+        return None
+
+    return graph.sha1s[merge_base_id]
+
+
+def bulk_master_merge_base(commits):
+    """
+    Resolves master and all commits in a single pass, and indexes
+    the unindexed commits with a single git process.
+    """
+
+    valid_commits = [commit for commit in commits if isinstance(commit, str) and is_hex_string(commit)]
+    commit_ids, errors = lookup_or_index_commit_ids(["master"] + valid_commits)
+    master_id = commit_ids.pop(0)
+    commit_ids_by_commit = dict(zip(valid_commits, commit_ids))
+
+    results = []
+    for commit in commits:
+        if not isinstance(commit, str):
+            output = format_error("commit {} is not a string".format(commit))
+        elif not is_hex_string(commit):
+            output = format_error("commit {} is not a hexadecimal string".format(commit))
+        elif master_id is None:
+            output = format_error(errors.get("master", "master could not be resolved"))
+        elif commit in errors:
+            output = format_error(errors[commit])
+        else:
+            merge_base_sha1 = indexed_master_merge_base(master_id, commit_ids_by_commit[commit])
+            if merge_base_sha1 is None:
+                output = format_error("commit {} has no common ancestor with master".format(commit))
+            else:
+                output = format_result(merge_base_sha1)
+
+        results.append({
+            "commit": commit,
+            "output": output,
+        })
+
+    return results
+
+
+def iter_master_merge_bases(commits):
+
+    for chunk in iter_chunks(commits):
+        yield from bulk_master_merge_base(chunk)
+
+
+def master_merge_base_from_index(commit):
+    """
+    Returns None if the merge base has to be found by git.
+    """
 
     if not is_hex_string(commit):
         return format_error("commit {} is not a hexadecimal string".format(commit))
 
-    cmd_result = git.master_merge_base(git.CLONE_PATH, commit)
-    return format_query_result(cmd_result)
+    commit_ids = lookup_indexed_commits(["master", commit])
+    if commit_ids:
+        merge_base_sha1 = indexed_master_merge_base(*commit_ids)
+        if merge_base_sha1 is not None:
+            return format_result(merge_base_sha1)
 
+    return None
 
+
+@query_cache.cached_query(ref_dependent=True)
+def git_master_merge_base(commit):
+
+    result = master_merge_base_from_index(commit)
+    if result is None:
+        result = format_query_result(git.master_merge_base(snapshots.get_read_path(), commit))
+
+    return result
+
+
+@query_cache.cached_query()
 def single_rev_parse(ref):
 
-    cmd_result = git.parse_bulk_refs(git.CLONE_PATH, [ref])
+    cmd_result = git.resolve_refs(snapshots.get_read_path(), [ref])
     return format_query_result(cmd_result)
 
 
 def query_ancestry_html(ancestor, descendant):
 
-    cmd_result = git.is_git_ancestor(git.CLONE_PATH, ancestor, descendant)
+    cmd_result = git.is_git_ancestor(snapshots.get_read_path(), ancestor, descendant)
 
     # 0 or 1 are expected exit codes of --is-ancestor,
     # while other codes indicate a malfunction.
@@ -143,9 +587,86 @@ def query_ancestry_hexadecimal_only(ancestor, descendant):
     return query_ancestry(ancestor, descendant)
 
 
+def bulk_query_ancestry(pairs):
+    """
+    Answers many (ancestor, descendant) pairs, with a single walk
+    of the commit graph per distinct descendant.  Unindexed commits
+    are indexed together with a single git process.
+
+    Each entry echoes its input pair, which may be malformed.
+    """
+
+    results = [None] * len(pairs)
+
+    valid_indices = []
+    for i, pair in enumerate(pairs):
+        if isinstance(pair, list) and len(pair) == 2 and all(isinstance(x, str) for x in pair):
+            valid_indices.append(i)
+        else:
+            results[i] = format_error("{} is not an [ancestor, descendant] pair".format(pair))
+
+    revisions = [x for i in valid_indices for x in pairs[i]]
+    commit_ids, errors = lookup_or_index_commit_ids(revisions)
+
+    candidate_ids_by_descendant = {}
+    indices_by_descendant = {}
+    for i, ancestor_id, descendant_id in zip(valid_indices, commit_ids[0::2], commit_ids[1::2]):
+        error_messages = [errors[x] for x in pairs[i] if x in errors]
+        if error_messages:
+            results[i] = format_error("\n".join(error_messages))
+        else:
+            candidate_ids_by_descendant.setdefault(descendant_id, set()).add(ancestor_id)
+            indices_by_descendant.setdefault(descendant_id, []).append((i, ancestor_id))
+
+    for descendant_id, candidate_ids in candidate_ids_by_descendant.items():
+        ancestor_ids = commit_graph.indexes.current().ancestors_among(descendant_id, candidate_ids)
+        for i, ancestor_id in indices_by_descendant[descendant_id]:
+            results[i] = format_result(ancestor_id in ancestor_ids)
+
+    valid_index_set = set(valid_indices)
+
+    entries = []
+    for i, (pair, output) in enumerate(zip(pairs, results)):
+        ancestor, descendant = pair if i in valid_index_set else (None, None)
+        entries.append({
+            "ancestor": ancestor,
+            "descendant": descendant,
+            "pair": pair,
+            "output": output,
+        })
+
+    return entries
+
+
+def iter_ancestry_results(pairs):
+
+    for chunk in iter_chunks(pairs):
+        yield from bulk_query_ancestry(chunk)
+
+
+def ancestry_from_index(ancestor, descendant):
+    """
+    Returns None if either commit is not indexed.
+    """
+
+    commit_ids = lookup_indexed_commits([ancestor, descendant])
+    if not commit_ids:
+        return None
+
+    return format_result(commit_graph.indexes.current().is_ancestor(*commit_ids))
+
+
+@query_cache.cached_query()
 def query_ancestry(ancestor, descendant):
 
-    cmd_result = git.is_git_ancestor(git.CLONE_PATH, ancestor, descendant)
+    result = ancestry_from_index(ancestor, descendant)
+    if result is None:
+        result = format_ancestry_result(git.is_git_ancestor(snapshots.get_read_path(), ancestor, descendant), ancestor, descendant)
+
+    return result
+
+
+def format_ancestry_result(cmd_result, ancestor, descendant):
 
     def process_result(x):
 
@@ -162,6 +683,319 @@ def query_ancestry(ancestor, descendant):
     return format_query_result(cmd_result, process_result, lambda x: x.return_code in [0, 1])
 
 
+# Commits per page of a range query, unless the request asks for fewer
+RANGE_PAGE_SIZE = 100
+
+MAX_RANGE_PAGE_SIZE = 1000
+
+
+def encode_range_cursor(base_sha1, tip_sha1, last_sha1):
+    """
+    The cursor pins the range to the commits it was first resolved
+    to, so that later pages are unaffected by refs moving, and names
+    the last commit of the page, which the next page follows.
+    """
+
+    return "{}.{}.{}".format(base_sha1, tip_sha1, last_sha1)
+
+
+def decode_range_cursor(cursor):
+
+    parts = cursor.split(".")
+    if len(parts) != 3 or any(len(part) != 40 for part in parts) or not is_hex_string("".join(parts)):
+        raise ValueError("invalid cursor " + cursor)
+
+    return parts[0], parts[1], parts[2]
+
+
+def parse_range_fields(fields):
+    """
+    Fields are a comma-separated list of KEYS_AND_FORMAT_SPECIFIERS keys.
+    """
+
+    field_list = [x for x in (fields or "").split(",") if x]
+    for field in field_list:
+        if field not in git.KEYS_AND_FORMAT_SPECIFIERS:
+            raise ValueError("unknown field {}; fields are {}".format(field, ", ".join(git.KEYS_AND_FORMAT_SPECIFIERS)))
+
+    return field_list
+
+
+def parse_page_size(limit, streamed):
+    """
+    Streamed responses are not paginated unless a limit is given.
+    """
+
+    if not limit:
+        return None if streamed else RANGE_PAGE_SIZE
+
+    page_size = int(limit) if limit.isdigit() else 0
+    if not 0 < page_size <= MAX_RANGE_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and {}".format(MAX_RANGE_PAGE_SIZE))
+
+    return page_size
+
+
+def iter_range_records(base_sha1, tip_sha1, after_sha1, page_size, fields):
+    """
+    Yields a {"sha1", <fields>} record per commit of the page, and then
+    a {"next_cursor"} record if the range continues past the page.
+    A page resumed after a commit that is not in the range is empty.
+
+    Commits are read from "rev-list" and joined with their metadata
+    one chunk at a time, so a range is never held in memory.
+    """
+
+    max_count = None if page_size is None else page_size + 1
+    sha1_iter = git.iter_ancestry_path(snapshots.get_read_path(), base_sha1, tip_sha1, after_sha1=after_sha1, max_count=max_count)
+
+    count = 0
+    last_sha1 = after_sha1
+    next_cursor = None
+    for chunk in iter_chunks(sha1_iter):
+        if page_size is not None and count + len(chunk) > page_size:
+            chunk = chunk[:page_size - count]
+            next_cursor = encode_range_cursor(base_sha1, tip_sha1, chunk[-1] if chunk else last_sha1)
+
+        if chunk:
+            last_sha1 = chunk[-1]
+
+        metadata_list = fetch_metadata_batch(chunk) if fields and chunk else [{}] * len(chunk)
+        for sha1, metadata in zip(chunk, metadata_list):
+            record = {"sha1": sha1}
+            if "error" in metadata:
+                record["error"] = metadata["error"]
+            else:
+                record.update((field, metadata[field]) for field in fields if field in metadata)
+
+            yield record
+
+        count += len(chunk)
+
+    if next_cursor:
+        yield {"next_cursor": next_cursor}
+
+
+def prepare_commit_range(base, tip, cursor=None, limit=None, fields=None, streamed=False):
+    """
+    Returns an error result and None, or None and an iterator of
+    the records of iter_range_records(), for the commits counted by
+    git_commit_distance(base, tip).  A cursor from a previous page
+    takes the place of the base and tip.
+    """
+
+    try:
+        field_list = parse_range_fields(fields)
+        page_size = parse_page_size(limit, streamed)
+        after_sha1 = None
+        if cursor:
+            base, tip, after_sha1 = decode_range_cursor(cursor)
+    except ValueError as e:
+        return format_error(str(e)), None
+
+    try:
+        resolved = git.resolve_objects(snapshots.get_read_path(), [base, tip])
+    except git.cat_file_pool.CatFileError as e:
+        return format_error(str(e)), None
+
+    for revision, (sha1, objecttype) in zip([base, tip], resolved):
+        if sha1 is None:
+            return format_error("fatal: {} revision '{}'".format(objecttype, revision)), None
+        elif objecttype != "commit":
+            return format_error("object {} is a {}, not a commit".format(revision, objecttype)), None
+
+    (base_sha1, _), (tip_sha1, _) = resolved
+    return None, iter_range_records(base_sha1, tip_sha1, after_sha1, page_size, field_list)
+
+
+def resolve_pull_request_range(pr):
+    """
+    Returns an error result, or None along with the merge
+    base of a PR with master and the PR's head commit.
+    """
+
+    if not pr.isdigit():
+        return format_error("PR number {} is not an integer".format(pr)), None, None
+
+    [head_result] = resolve_pull_request_heads([int(pr)])
+    if not head_result["success"]:
+        return head_result, None, None
+
+    merge_base_result = git_master_merge_base(head_result["result"])
+    if not merge_base_result["success"]:
+        return merge_base_result, None, None
+
+    return None, merge_base_result["result"], head_result["result"]
+
+
+def prepare_pull_request_commits(pr, cursor=None, limit=None, fields=None, streamed=False):
+    """
+    Like prepare_commit_range(), for the commits of a PR
+    since its merge base with master.
+    """
+
+    if cursor:
+        return prepare_commit_range(None, None, cursor, limit, fields, streamed)
+
+    error_result, merge_base_sha1, head_sha1 = resolve_pull_request_range(pr)
+    if error_result:
+        return error_result, None
+
+    return prepare_commit_range(merge_base_sha1, head_sha1, None, limit, fields, streamed)
+
+
+def collect_range_page(records):
+    """
+    Returns the result of a non-streamed range query.
+    """
+
+    commits = []
+    next_cursor = None
+    try:
+        for record in records:
+            if "next_cursor" in record:
+                next_cursor = record["next_cursor"]
+            else:
+                commits.append(record)
+    except subprocess.CalledProcessError as e:
+        return format_error(e.stderr)
+
+    return format_result({
+        "commits": commits,
+        "next_cursor": next_cursor,
+    })
+
+
+def fetch_changed_paths_batch(commit_sha1_list):
+    """
+    Returns {"sha1", "paths"} entries aligned with the input list,
+    like fetch_metadata_batch(), with an "error" key in place of
+    the paths for commits that cannot be resolved.
+    """
+    import changed_paths
+
+    resolved = resolve_commit_items(commit_sha1_list)
+
+    valid_sha1s = set(sha1 for sha1, objecttype in resolved if objecttype == "commit")
+
+    paths_cache = query_cache.caches.current().immutable
+    generation = paths_cache.generation
+
+    paths_by_sha1 = {}
+    for sha1 in valid_sha1s:
+        found, paths = paths_cache.get(("changed_paths", sha1))
+        if found:
+            paths_by_sha1[sha1] = paths
+
+    stored_paths_by_sha1 = changed_paths.lookup(valid_sha1s - set(paths_by_sha1))
+    fetched_paths_by_sha1 = dict(git.iter_changed_paths(snapshots.get_read_path(), sorted(valid_sha1s - set(paths_by_sha1) - set(stored_paths_by_sha1))))
+    changed_paths.remember(fetched_paths_by_sha1)
+
+    for sha1, paths in list(stored_paths_by_sha1.items()) + list(fetched_paths_by_sha1.items()):
+        paths_cache.put(("changed_paths", sha1), paths, generation)
+        paths_by_sha1[sha1] = paths
+
+    entries = []
+    for commit_sha1, (full_sha1, objecttype) in zip(commit_sha1_list, resolved):
+        if full_sha1 is None:
+            entries.append({"sha1": commit_sha1, "error": "commit {} is {}".format(commit_sha1, objecttype)})
+        elif objecttype != "commit":
+            entries.append({"sha1": commit_sha1, "error": "object {} is a {}, not a commit".format(commit_sha1, objecttype)})
+        else:
+            entries.append({"sha1": full_sha1, "paths": paths_by_sha1[full_sha1]})
+
+    return entries
+
+
+def iter_changed_paths(commit_sha1s):
+    """
+    Yields the same entries as fetch_changed_paths_batch(),
+    one chunk of the input at a time, and error entries for
+    a chunk that git fails on, as iter_metadata() does.
+    """
+
+    for chunk in iter_chunks(commit_sha1s):
+        try:
+            yield from fetch_changed_paths_batch(chunk)
+        except (git.cat_file_pool.CatFileError, subprocess.CalledProcessError) as e:
+            for commit_sha1 in chunk:
+                yield {
+                    "sha1": commit_sha1,
+                    "error": str(e),
+                }
+
+
+def git_changed_paths(commit):
+
+    try:
+        [entry] = fetch_changed_paths_batch([commit])
+    except (git.cat_file_pool.CatFileError, subprocess.CalledProcessError) as e:
+        return format_error(str(e))
+
+    if "error" in entry:
+        return format_error(entry["error"])
+
+    return format_result(entry["paths"])
+
+
+@query_cache.cached_query()
+def git_diff_paths(base_sha1, tip_sha1):
+
+    cmd_result = git.diff_paths(snapshots.get_read_path(), base_sha1, tip_sha1)
+    return format_query_result(cmd_result, lambda x: [path for path in x.stdout.split("\0") if path])
+
+
+def pull_request_changed_paths(pr):
+    """
+    Compares the head of a PR with its merge base with master.
+    """
+
+    error_result, merge_base_sha1, head_sha1 = resolve_pull_request_range(pr)
+    if error_result:
+        return error_result
+
+    return git_diff_paths(merge_base_sha1, head_sha1)
+
+
+# Commits returned by a path query, unless the request asks for fewer
+PATH_COMMITS_LIMIT = 100
+
+
+def path_commits(path, limit=None, ref=None):
+    """
+    Returns the most recent commits that changed the path or anything
+    below it.  Without a ref, these are taken from all indexed commits
+    in the changed-paths index; with one, from the commits reachable
+    from the ref, by a path-limited "rev-list".
+    """
+    import changed_paths
+
+    if not path:
+        return format_error("a path is required")
+
+    try:
+        max_count = parse_page_size(limit, False) if limit else PATH_COMMITS_LIMIT
+    except ValueError as e:
+        return format_error(str(e))
+
+    if ref is None:
+        return format_result(changed_paths.get_recent_commits(path, max_count))
+
+    if ref.startswith("-"):
+        return format_error("invalid ref {}".format(ref))
+
+    def value_process_func(cmd_result):
+        entries = []
+        for line in cmd_result.stdout.splitlines():
+            sha1, committer_date = line.split(" ", 1)
+            entries.append({"sha1": sha1, "committer_date": committer_date})
+
+        return entries
+
+    cmd_result = git.recent_commits_touching_path(snapshots.get_read_path(), ref, path, max_count)
+    return format_query_result(cmd_result, value_process_func)
+
+
 if __name__ == "__main__":
     x = parse_refs_with_individual_error_handling(["master", "masters"])
     import json
@@ -0,0 +1,254 @@
+"""
+Read snapshots of the mirror
+
+"git fetch --force" rewrites refs one at a time, so queries that read
+refs from the mirror while a fetch runs can see a mixture of old and
+new refs, or none at all.
+
+Queries instead read from a snapshot: a bare repo that borrows the
+mirror's objects through "objects/info/alternates", and holds a copy
+of the mirror's refs in its own packed-refs file.  Objects that a fetch
+adds are invisible to a snapshot until some ref points to them, so a
+snapshot stays consistent while the mirror is being written to.
+
+After each fetch or clone, a new snapshot generation is written beside
+the mirror, and published by atomically replacing the "current" symlink
+in the snapshots directory.  Every worker process reads that link when
+it looks up the path to read from, so a generation published by one
+worker is served by all of them.  Each process names its generations
+after its process id, and only removes its own, or those of processes
+that have exited.
+
+A snapshot has the same config as the mirror, so a snapshot of a
+partial clone is one as well.  Objects that the clone filter left out
+are then fetched from origin on demand, as they would be by the mirror,
+but into the snapshot's own object directory, which is removed along
+with the generation.  Queries only read commits and trees, which the
+filter keeps, so this should not normally happen.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+import git
+import repos
+
+
+SNAPSHOTS_DIR_SUFFIX = ".snapshots"
+
+GENERATION_PREFIX = "generation-"
+
+# Symlink to the published generation, shared by all processes
+CURRENT_LINK_NAME = "current"
+
+# Older generations are kept for queries that started before a swap
+KEPT_GENERATIONS = 3
+
+SNAPSHOT_HEAD_TEXT = "ref: refs/heads/master\n"
+
+
+class SnapshotState:
+
+    def __init__(self):
+        self.publish_lock = threading.Lock()
+
+        # Generations this process has read from, whether published by
+        # it or by another process, oldest first; the last one is current
+        self.generation_paths = []
+
+    def get_current_path(self):
+        generation_paths = self.generation_paths
+        return generation_paths[-1] if generation_paths else None
+
+
+# One per mirrored repo
+states = repos.PerRepo(SnapshotState)
+
+
+def get_snapshots_dir(clone_path):
+    return clone_path.rstrip("/") + SNAPSHOTS_DIR_SUFFIX
+
+
+def read_current_link(snapshots_dir):
+    """
+    Returns the path of the published generation, or None.
+    """
+
+    try:
+        return os.path.join(snapshots_dir, os.readlink(os.path.join(snapshots_dir, CURRENT_LINK_NAME)))
+    except OSError:
+        return None
+
+
+def get_generation():
+    """
+    Returns the name of the published generation, which changes
+    whenever any process publishes one, or None before the first.
+    """
+
+    current_path = read_current_link(get_snapshots_dir(repos.current().clone_path))
+    return os.path.basename(current_path) if current_path else None
+
+
+def get_read_path():
+    """
+    Returns the git directory that queries should read from.
+    Until the first snapshot is published, that is the mirror itself.
+
+    Reading the shared link costs one system call, so
+    a newly published generation is seen at once.
+    """
+
+    clone_path = repos.current().clone_path
+    state = states.current()
+
+    current_path = read_current_link(get_snapshots_dir(clone_path))
+    if current_path is not None and current_path != state.get_current_path():
+        adopt(state, current_path)
+
+    return state.get_current_path() or clone_path
+
+
+def get_generation_pid(name):
+    """
+    Returns the id of the process that wrote a generation, or None.
+    """
+
+    pid_text = name[len(GENERATION_PREFIX):].split("-", 1)[0]
+    return int(pid_text) if pid_text.isdigit() else None
+
+
+def is_process_running(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def is_own_generation(path):
+    return get_generation_pid(os.path.basename(path)) == os.getpid()
+
+
+def find_abandoned_generations(snapshots_dir, kept_paths):
+    """
+    Returns the generations left behind by processes that have exited,
+    or that were written before generations were named after them.
+    Generations of other running processes may still be read by them,
+    as may the kept ones, which include the published one.
+    """
+
+    abandoned_paths = []
+    for name in os.listdir(snapshots_dir):
+        path = os.path.join(snapshots_dir, name)
+        if not name.startswith(GENERATION_PREFIX) or path in kept_paths:
+            continue
+
+        pid = get_generation_pid(name)
+        if pid is None or (pid != os.getpid() and not is_process_running(pid)):
+            abandoned_paths.append(path)
+
+    return abandoned_paths
+
+
+def adopt(state, snapshot_path):
+    """
+    Makes a published generation the one this process reads from.
+    Readers of the generations that fall out of the kept ones are
+    discarded, and those generations removed if this process wrote them.
+    """
+
+    with state.publish_lock:
+        if snapshot_path == state.get_current_path():
+            return
+
+        state.generation_paths = state.generation_paths + [snapshot_path]
+        retired_paths = state.generation_paths[:-KEPT_GENERATIONS]
+        state.generation_paths = state.generation_paths[-KEPT_GENERATIONS:]
+
+    for path in retired_paths:
+        git.discard_object_readers(path)
+        if is_own_generation(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def swap_current_link(snapshots_dir, snapshot_path):
+    """
+    Points the shared link at the generation.  A new link is
+    renamed over the old one, so readers never find it missing.
+    """
+
+    new_link_path = os.path.join(snapshots_dir, ".%s-%d" % (CURRENT_LINK_NAME, os.getpid()))
+    if os.path.lexists(new_link_path):
+        os.remove(new_link_path)
+
+    os.symlink(os.path.basename(snapshot_path), new_link_path)
+    os.replace(new_link_path, os.path.join(snapshots_dir, CURRENT_LINK_NAME))
+
+
+def write_snapshot(clone_path, snapshot_path, refs, config_text):
+
+    objects_path = os.path.join(snapshot_path, "objects")
+    os.makedirs(os.path.join(objects_path, "info"))
+    os.makedirs(os.path.join(snapshot_path, "refs"))
+
+    with open(os.path.join(objects_path, "info", "alternates"), "w") as fh:
+        fh.write(os.path.abspath(os.path.join(clone_path, "objects")) + "\n")
+
+    with open(os.path.join(snapshot_path, "HEAD"), "w") as fh:
+        fh.write(SNAPSHOT_HEAD_TEXT)
+
+    with open(os.path.join(snapshot_path, "config"), "w") as fh:
+        fh.write(config_text)
+
+    # Without a traits header, git peels annotated tags on demand
+    with open(os.path.join(snapshot_path, "packed-refs"), "w") as fh:
+        for refname in sorted(refs):
+            fh.write("{} {}\n".format(refs[refname], refname))
+
+
+def publish():
+    """
+    Copies the current refs of the mirror into a new generation,
+    which subsequent queries read from.  The caller must hold the
+    repo's mutating operation lock, so that no fetch is running.
+    """
+
+    repo = repos.current()
+    clone_path = repo.clone_path
+    state = states.current()
+
+    refs = git.snapshot_refs(clone_path, [])
+    config_text = git.render_config_text(repo.clone_url, git.get_clone_filter(clone_path))
+
+    snapshots_dir = get_snapshots_dir(clone_path)
+    os.makedirs(snapshots_dir, exist_ok=True)
+    snapshot_path = tempfile.mkdtemp(prefix="%s%d-" % (GENERATION_PREFIX, os.getpid()), dir=snapshots_dir)
+
+    try:
+        write_snapshot(clone_path, snapshot_path, refs, config_text)
+    except OSError:
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        raise
+
+    try:
+        swap_current_link(snapshots_dir, snapshot_path)
+    except OSError:
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        raise
+
+    adopt(state, snapshot_path)
+
+    # Also removes generations left behind by exited processes
+    for path in find_abandoned_generations(snapshots_dir, state.generation_paths):
+        git.discard_object_readers(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    print("Published snapshot of %d refs of %s" % (len(refs), repos.current().full_name))
+    return snapshot_path
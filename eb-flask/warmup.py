@@ -0,0 +1,137 @@
+"""
+Warm-up of query indexes and caches
+
+A new process starts with empty indexes and caches, and with the
+repo's pack indexes and the metadata database out of the OS page
+cache, so its first queries are slow.  Each repo is therefore indexed
+and warmed up when the application starts, and only reported ready
+by /health once that has finished.  The persistent metadata and
+changed-path stores are filled after that, since filling an empty
+database takes much longer.  Caches are warmed up again after every
+index update, since a fetch empties the ref-dependent cache.
+
+Clients' recently used commits are not known to a new process, so
+the commits that they are most likely to ask about are warmed up
+instead: the newest commits of master, and the heads of the PRs
+that the last fetch updated.
+"""
+
+import datetime
+import sqlite3
+import subprocess
+import time
+
+import commit_graph
+import git
+import master_index
+import pr_refs
+import repos
+import short_git_operations
+
+
+# Newest commits of master's first-parent chain to warm up
+RECENT_MASTER_COMMIT_COUNT = 1000
+
+# At most this many updated PRs are warmed up after a fetch
+MAX_WARMED_PR_COUNT = 1000
+
+
+class WarmupState:
+
+    def __init__(self):
+        # Set once the warm-up at startup has finished, even if it failed
+        self.ready = False
+
+        self.last_warmed_at = None
+        self.last_duration_seconds = None
+        self.last_error = None
+        self.last_commit_count = 0
+
+
+# One per mirrored repo
+states = repos.PerRepo(WarmupState)
+
+
+def get_recent_master_sha1s():
+
+    graph = commit_graph.indexes.current()
+    master = master_index.indexes.current()
+    return [graph.sha1s[commit_id] for commit_id in master.chain_ids[-RECENT_MASTER_COMMIT_COUNT:]]
+
+
+def get_updated_pull_requests(ref_changes):
+    """
+    Returns (PR number, head sha1) pairs for the PRs whose head moved.
+    """
+
+    updated_prs = []
+    for refname, (_, new_sha1) in (ref_changes or {}).items():
+        pr_number = pr_refs.pr_number_of_head_ref(refname)
+        if pr_number is not None and new_sha1 is not None:
+            updated_prs.append((pr_number, new_sha1))
+
+    return sorted(updated_prs, reverse=True)[:MAX_WARMED_PR_COUNT]
+
+
+def warm_caches(ref_changes=None):
+    """
+    Loads the PR ref table, and reads recent commits through the same
+    paths that queries use, which fills the query caches and pulls
+    the objects they need into the page cache.  Must be called after
+    the indexes are updated.
+
+    Failing to warm up is not fatal, since queries work on cold caches.
+    """
+
+    state = states.current()
+    start_time = time.monotonic()
+
+    try:
+        short_git_operations.get_pr_ref_table()
+
+        updated_prs = get_updated_pull_requests(ref_changes)
+        sha1s = get_recent_master_sha1s() + [head_sha1 for _, head_sha1 in updated_prs]
+
+        short_git_operations.fetch_metadata_batch(sha1s)
+        short_git_operations.fetch_changed_paths_batch(sha1s)
+
+        for pr_number, head_sha1 in updated_prs:
+            short_git_operations.git_pull_request_head_commit(str(pr_number))
+            short_git_operations.git_master_merge_base(head_sha1)
+
+        state.last_error = None
+        state.last_commit_count = len(sha1s)
+    except (subprocess.CalledProcessError, git.cat_file_pool.CatFileError, sqlite3.Error) as e:
+        state.last_error = str(e)
+        print("Could not warm up %s: %s" % (repos.current().full_name, e))
+
+    state.last_duration_seconds = time.monotonic() - start_time
+    state.last_warmed_at = datetime.datetime.now()
+    print("Warmed up %d commits of %s in %.1f seconds" % (state.last_commit_count, repos.current().full_name, state.last_duration_seconds))
+
+
+def get_health():
+    """
+    Responds with 503 until every repo has been warmed up, so that
+    a load balancer only sends queries to a warm instance.
+    """
+
+    repo_statuses = {}
+    for repo in repos.all_repos():
+        with repos.use(repo):
+            state = states.current()
+
+        repo_statuses[repo.full_name] = {
+            "ready": state.ready,
+            "last_warmed_at": state.last_warmed_at,
+            "last_duration_seconds": state.last_duration_seconds,
+            "last_error": state.last_error,
+        }
+
+    ready = all(status["ready"] for status in repo_statuses.values())
+    health = {
+        "status": "ready" if ready else "warming",
+        "repos": repo_statuses,
+    }
+
+    return health, 200 if ready else 503
@@ -0,0 +1,157 @@
+"""
+Fixtures shared by the tests
+
+Tests run against mirrors of synthetic repos built by
+benchmarks/synthetic_repo.py, which are small enough to build in a
+second or so, but have merges, side branches and PR refs.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EB_FLASK_DIR = os.path.join(TESTS_DIR, "..", "eb-flask")
+
+sys.path.insert(0, EB_FLASK_DIR)
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+import synthetic_repo
+
+import db
+import git
+import long_git_operations
+import repos
+
+
+SYNTHETIC_REPO_PARAMETERS = {
+    "commits": 120,
+    "fan_out": 25,
+    "side_length": 3,
+    "prs": 12,
+    "pr_length": 3,
+    "seed": 1,
+}
+
+# Commits written by the tests themselves
+COMMIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME="Test",
+    GIT_AUTHOR_EMAIL="test@example.com",
+    GIT_COMMITTER_NAME="Test",
+    GIT_COMMITTER_EMAIL="test@example.com",
+)
+
+
+def run_git(git_objdir, *args):
+    """
+    Returns the stripped output of a git command, which must succeed.
+    """
+
+    return subprocess.check_output([git.GIT_BINARY_PATH, "--git-dir", git_objdir] + list(args), env=COMMIT_ENV).decode("utf-8").strip()
+
+
+def git_succeeds(git_objdir, *args):
+    return subprocess.call([git.GIT_BINARY_PATH, "--git-dir", git_objdir] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def add_commit(git_objdir, ref, message):
+    """
+    Commits the tree of the ref's commit on top of it, and moves the ref.
+    """
+
+    parent_sha1 = run_git(git_objdir, "rev-parse", ref)
+    commit_sha1 = run_git(git_objdir, "commit-tree", parent_sha1 + "^{tree}", "-p", parent_sha1, "-m", message)
+    run_git(git_objdir, "update-ref", ref, commit_sha1)
+    return commit_sha1
+
+
+def side_branch_commit(git_objdir, ref="master"):
+    """
+    Returns the second parent of the most recent merge on the ref.
+    """
+
+    return run_git(git_objdir, "rev-parse", run_git(git_objdir, "rev-list", "--merges", "--max-count=1", ref) + "^2")
+
+
+PUBLISHING_PROCESS_SCRIPT = """
+import sys
+
+sys.path.insert(0, sys.argv[1])
+
+import long_git_operations
+import repos
+
+repos.default_repo.clone_path = sys.argv[2]
+long_git_operations.publish_snapshot()
+"""
+
+
+def publish_in_other_process(repo):
+    """
+    Publishes a snapshot of the repo from another worker process.
+    """
+
+    subprocess.check_call([sys.executable, "-c", PUBLISHING_PROCESS_SCRIPT, EB_FLASK_DIR, repo.clone_path], stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database(tmp_path_factory):
+
+    db.DEFAULT_PATH = str(tmp_path_factory.mktemp("db") / "database.sqlite3")
+
+    # Warm-up and maintenance would otherwise start on the first
+    # request, and race with the tests over the default repo.
+    long_git_operations.background_work_started = True
+
+
+def make_mirror(work_dir, repo):
+    """
+    Clones the repo's mirror from a new synthetic origin, and
+    publishes a snapshot and updates the indexes.
+    """
+
+    origin_path = os.path.join(work_dir, "origin.git")
+    synthetic_repo.create_origin(origin_path, **SYNTHETIC_REPO_PARAMETERS)
+
+    repo.clone_path = os.path.join(work_dir, "mirror", "repo.git")
+    repo.clone_url = origin_path
+
+    for cmd_result in [git.bare_clone(repo.clone_path, origin_path), git.fetch_pr_refs(repo.clone_path)]:
+        assert not cmd_result.return_code, cmd_result.stderr
+
+    with repos.use(repo):
+        git.reset_object_readers(repo.clone_path)
+        long_git_operations.publish_snapshot()
+        long_git_operations.update_indexes()
+
+
+@pytest.fixture(scope="session")
+def mirror(tmp_path_factory):
+    """
+    The default repo, which unscoped routes act on.  Tests that
+    fetch into a mirror must use their own, from fresh_mirror.
+    """
+
+    make_mirror(str(tmp_path_factory.mktemp("default")), repos.default_repo)
+    return repos.default_repo
+
+
+@pytest.fixture
+def fresh_mirror(tmp_path, request):
+
+    repo = repos.Repo("test/" + request.node.name)
+    make_mirror(str(tmp_path), repo)
+
+    with repos.use(repo):
+        yield repo
+
+
+@pytest.fixture
+def client(mirror):
+
+    import application
+    return application.application.test_client()
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import threading
+
+import pytest
+
+import asgi
+import async_git_operations
+import query_cache
+import short_git_operations
+
+from conftest import run_git, side_branch_commit
+
+
+def get(path):
+    """
+    Sends a GET request straight to the ASGI application and
+    returns the status, headers and body of the response.
+    """
+
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": []}
+    asyncio.run(asgi.application(scope, receive, send))
+
+    start, body = messages
+    assert start["type"] == "http.response.start"
+    assert body["type"] == "http.response.body"
+    return start["status"], dict(start["headers"]), body["body"]
+
+
+def get_json(path):
+
+    status, headers, body = get(path)
+    assert status == 200
+    assert headers[b"content-type"] == b"application/json"
+    assert headers[b"content-length"] == str(len(body)).encode()
+    return json.loads(body)
+
+
+@pytest.fixture
+def uncached():
+    query_cache.caches.current().clear()
+    yield
+    query_cache.caches.current().clear()
+
+
+def test_queries_match_wsgi_application(client, mirror, uncached):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    ancestor_sha1 = run_git(mirror.clone_path, "rev-parse", "master~3")
+
+    for path in [
+        "/is-ancestor/{}/{}".format(ancestor_sha1, master_sha1),
+        "/is-ancestor/{}/{}".format(master_sha1, ancestor_sha1),
+        "/master-merge-base/{}".format(ancestor_sha1),
+        "/commit-distance/{}/{}".format(ancestor_sha1, master_sha1),
+        "/head-of-pull-requests/{}".format(run_git(mirror.clone_path, "rev-parse", "refs/remotes/origin/pr/2/head")),
+        "/pr-head-commit/2",
+        "/rev-parse/master",
+        "/fetch-queue",
+    ]:
+        assert get_json(path) == client.get(path).get_json(), path
+
+
+def test_unindexed_queries_await_git(mirror, monkeypatch, uncached):
+
+    for name in ["ancestry_from_index", "master_merge_base_from_index", "commit_distance_from_index", "pointing_prs_from_index"]:
+        monkeypatch.setattr(short_git_operations, name, lambda *args: None)
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    side_sha1 = side_branch_commit(mirror.clone_path)
+
+    assert get_json("/is-ancestor/{}/{}".format(side_sha1, master_sha1))["result"] is True
+    assert get_json("/master-merge-base/{}".format(side_sha1))["result"] == run_git(mirror.clone_path, "merge-base", "master", side_sha1)
+
+    distance = run_git(mirror.clone_path, "rev-list", "--ancestry-path", "--count", "{}..{}".format(side_sha1, master_sha1))
+    assert get_json("/commit-distance/{}/{}".format(side_sha1, master_sha1))["result"] == int(distance)
+
+
+def test_index_lookups_run_off_the_event_loop(mirror, monkeypatch, uncached):
+
+    lookup_threads = []
+    ancestry_from_index = short_git_operations.ancestry_from_index
+
+    def recording_lookup(*args):
+        lookup_threads.append(threading.current_thread())
+        return ancestry_from_index(*args)
+
+    monkeypatch.setattr(short_git_operations, "ancestry_from_index", recording_lookup)
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    assert get_json("/is-ancestor/{}/{}".format(master_sha1, master_sha1))["result"] is True
+    assert lookup_threads and threading.main_thread() not in lookup_threads
+
+
+def test_concurrent_commands_are_limited(mirror, monkeypatch):
+
+    running = []
+    most_running = []
+
+    async def fake_command(cmd_args, stdin_text=None):
+        running.append(cmd_args)
+        most_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(cmd_args)
+
+    monkeypatch.setattr(async_git_operations.git, "get_command_result_async", fake_command)
+    monkeypatch.setattr(async_git_operations, "command_semaphores_by_repo_name", {})
+
+    async def run_all():
+        run_command = async_git_operations.command_runner()
+        await asyncio.gather(*[run_command(["git", str(i)]) for i in range(20)])
+
+    asyncio.run(run_all())
+    assert max(most_running) == async_git_operations.MAX_CONCURRENT_COMMANDS
+
+
+def test_rendering_and_routing_errors(mirror):
+
+    status, headers, body = get("/")
+    assert status == 200
+    assert headers[b"content-type"] == b"text/html; charset=utf-8"
+    assert b"No operations ongoing." in body
+
+    status, _, _ = get("/no-such-route")
+    assert status == 404
+
+    status, _, _ = get("/last-fetch-time/")
+    assert status == 404
+
+
+def test_scoped_routes(mirror):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    assert get_json("/repos/pytorch/pytorch/rev-parse/master")["result"] == master_sha1
+
+    status, _, body = get("/repos/test/unmirrored/rev-parse/master")
+    assert status == 404
+    assert b"test/unmirrored" in body
@@ -0,0 +1,91 @@
+import itertools
+import json
+
+import pytest
+
+import json_stream
+import short_git_operations
+
+from conftest import git_succeeds, run_git
+
+
+@pytest.fixture(scope="module")
+def sample_sha1s(mirror):
+    return run_git(mirror.clone_path, "rev-list", "--all", "--topo-order").split()[::12]
+
+
+def post(client, url, body, raw=False, **kwargs):
+
+    response = client.post(url, data=body if raw else json.dumps(body), **kwargs)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_bulk_is_ancestor_matches_git(client, mirror, sample_sha1s):
+
+    pairs = [list(pair) for pair in itertools.product(sample_sha1s, repeat=2)] + [["master~3", "master"], ["master", "master~3"]]
+    entries = post(client, "/bulk-is-ancestor", pairs)["result"]
+
+    assert [[entry["ancestor"], entry["descendant"]] for entry in entries] == pairs
+    for pair, entry in zip(pairs, entries):
+        assert entry["output"]["result"] == git_succeeds(mirror.clone_path, "merge-base", "--is-ancestor", *pair), pair
+
+
+def test_bulk_is_ancestor_errors_per_pair(client, mirror):
+
+    pairs = [["master~1", "master"], ["master"], "master", ["master", "no-such-ref"]]
+    entries = post(client, "/bulk-is-ancestor", pairs)["result"]
+
+    assert entries[0]["output"]["result"] is True
+    assert [entry["output"]["success"] for entry in entries[1:]] == [False, False, False]
+    assert [entry["pair"] for entry in entries] == pairs
+    assert entries[3]["output"]["error"] == "commit no-such-ref is missing"
+
+
+def test_bulk_master_merge_base_matches_git(client, mirror, sample_sha1s):
+
+    commits = sample_sha1s + [run_git(mirror.clone_path, "rev-parse", "master~2")[:12]]
+    entries = post(client, "/bulk-master-merge-base", commits)["result"]
+
+    assert [entry["commit"] for entry in entries] == commits
+    for commit, entry in zip(commits, entries):
+        assert entry["output"]["result"] == run_git(mirror.clone_path, "merge-base", "master", commit), commit
+
+
+def test_bulk_master_merge_base_errors_per_commit(client, mirror):
+
+    entries = post(client, "/bulk-master-merge-base", [run_git(mirror.clone_path, "rev-parse", "master"), 7, "master", "0" * 40])["result"]
+
+    assert entries[0]["output"]["success"]
+    assert [entry["output"]["error"] for entry in entries[1:]] == [
+        "commit 7 is not a string",
+        "commit master is not a hexadecimal string",
+        "commit {} is missing".format("0" * 40),
+    ]
+
+
+@pytest.mark.parametrize("url", ["/bulk-is-ancestor", "/bulk-master-merge-base"])
+@pytest.mark.parametrize("data", ["{\"a\": 1}", "[1, 2", ""])
+def test_bulk_queries_reject_non_arrays(client, url, data):
+
+    response = client.post(url, data=data)
+    assert response.status_code == 400
+    assert not response.get_json()["success"]
+
+
+@pytest.mark.parametrize("url", ["/bulk-is-ancestor", "/bulk-master-merge-base"])
+def test_bulk_queries_stream_ndjson(client, mirror, sample_sha1s, monkeypatch, url):
+
+    # Streamed items are answered a few at a time
+    iter_chunks = short_git_operations.iter_chunks
+    monkeypatch.setattr(short_git_operations, "iter_chunks", lambda items: iter_chunks(items, 2))
+    items = [[sha1, "master"] for sha1 in sample_sha1s] if url == "/bulk-is-ancestor" else sample_sha1s
+    expected = post(client, url, items)["result"]
+
+    body = "".join(json.dumps(item) + "\n" for item in items)
+    assert post(client, url, body, content_type=json_stream.NDJSON_MIMETYPE, raw=True)["result"] == expected
+
+    response = client.post(url + "?stream=1", data=body + "not json\n", content_type=json_stream.NDJSON_MIMETYPE)
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert records[:-1] == expected
+    assert "line {}".format(len(items) + 1) in records[-1]["error"]
@@ -0,0 +1,67 @@
+import json
+
+import git
+import short_git_operations
+
+from conftest import run_git
+
+
+def post(client, url, body):
+
+    response = client.post(url, data=json.dumps(body))
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_refs_resolve_individually(mirror):
+
+    refs = ["master", "master~2", "no-such-ref", 5]
+    [master, grandparent, missing, not_string] = short_git_operations.resolve_refs_individually(refs)
+
+    assert master["result"] == run_git(mirror.clone_path, "rev-parse", "master")
+    assert grandparent["result"] == run_git(mirror.clone_path, "rev-parse", "master~2")
+    assert missing == short_git_operations.format_error("fatal: missing revision 'no-such-ref'")
+    assert not_string == short_git_operations.format_error("ref 5 is not a string")
+
+
+def test_pull_request_heads_with_and_without_table(mirror, monkeypatch):
+
+    pr_numbers = [2, 1000, "x", True]
+
+    def check(outputs):
+        [found, missing, not_integer, boolean] = outputs
+
+        assert found["result"] == run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 2)
+        assert missing == short_git_operations.format_error("fatal: missing revision '{}'".format(git.PR_REF_TEMPLATE % 1000))
+        assert not not_integer["success"]
+        assert not boolean["success"]
+
+    check(short_git_operations.resolve_pull_request_heads(pr_numbers))
+
+    monkeypatch.setattr(short_git_operations, "get_pr_ref_table", lambda: None)
+    check(short_git_operations.resolve_pull_request_heads(pr_numbers))
+
+
+def test_bulk_rev_parse(client, mirror):
+
+    result = post(client, "/bulk-rev-parse", ["master", "viable/strict"])["result"]
+    assert result == [
+        {"ref": "master", "commit_sha1": run_git(mirror.clone_path, "rev-parse", "master")},
+        {"ref": "viable/strict", "commit_sha1": run_git(mirror.clone_path, "rev-parse", "viable/strict")},
+    ]
+
+    # The simple variants report every failed item
+    response = post(client, "/bulk-rev-parse", ["nope1", "master", "nope2"])
+    assert not response["success"]
+    assert response["error"] == "fatal: missing revision 'nope1'\nfatal: missing revision 'nope2'"
+
+
+def test_bulk_pull_request_heads_errors_per_pr(client, mirror):
+
+    [found, missing] = post(client, "/bulk-pull-request-heads", [1, 1000])["result"]
+
+    assert found == {"pr_number": 1, "output": short_git_operations.format_result(run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 1))}
+    assert missing["pr_number"] == 1000
+    assert not missing["output"]["success"]
+
+    assert not post(client, "/bulk-pull-request-heads-simple", [1, 1000])["success"]
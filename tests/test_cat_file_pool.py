@@ -0,0 +1,67 @@
+import pytest
+
+import cat_file_pool
+import git
+import short_git_operations
+
+from conftest import add_commit, run_git
+
+
+@pytest.fixture
+def pool(fresh_mirror):
+    return cat_file_pool.CatFilePool(git.GIT_BINARY_PATH, fresh_mirror.clone_path, pool_size=2)
+
+
+def test_resolves_revisions(fresh_mirror, pool):
+
+    master_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+    tree_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master^{tree}")
+
+    assert pool.resolve(["master", master_sha1[:12], "master^{tree}", "0" * 40, "master\nmaster", "no-such-ref"]) == [
+        (master_sha1, "commit"),
+        (master_sha1, "commit"),
+        (tree_sha1, "tree"),
+        (None, "missing"),
+        (None, "missing"),
+        (None, "missing"),
+    ]
+
+
+def test_reuses_workers(pool):
+
+    pool.resolve(["master"])
+    worker = pool.idle_workers.get_nowait()
+    pool.idle_workers.put(worker)
+
+    pool.resolve(["master"])
+    assert pool.idle_workers.get_nowait() is worker
+
+
+def test_replaces_exited_workers(pool):
+
+    pool.resolve(["master"])
+    worker = pool.idle_workers.get_nowait()
+    pool.idle_workers.put(worker)
+    worker.close()
+
+    [(sha1, object_type)] = pool.resolve(["master"])
+    assert object_type == "commit"
+
+
+def test_restart_shows_new_refs(fresh_mirror, pool):
+
+    old_master_sha1, _ = pool.resolve(["master"])[0]
+    new_master_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "New master commit")
+
+    pool.restart()
+    assert pool.resolve(["master"]) == [(new_master_sha1, "commit")]
+    assert pool.resolve([old_master_sha1]) == [(old_master_sha1, "commit")]
+
+
+def test_rev_parse_queries(mirror):
+
+    assert short_git_operations.single_rev_parse("master")["result"] == run_git(mirror.clone_path, "rev-parse", "master")
+    assert not short_git_operations.single_rev_parse("no-such-ref")["success"]
+
+    pr_head_sha1 = run_git(mirror.clone_path, "rev-parse", "refs/remotes/origin/pr/2/head")
+    assert short_git_operations.git_pull_request_head_commit("2")["result"] == pr_head_sha1
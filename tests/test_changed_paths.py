@@ -0,0 +1,129 @@
+import json
+import subprocess
+
+import changed_paths
+import db
+import git
+import long_git_operations
+import short_git_operations
+
+from conftest import COMMIT_ENV, git_succeeds, run_git
+
+
+def get_first_parent_paths(git_objdir, sha1):
+
+    if not git_succeeds(git_objdir, "rev-parse", "--verify", sha1 + "^"):
+        return run_git(git_objdir, "ls-tree", "-r", "--name-only", sha1).splitlines()
+
+    return run_git(git_objdir, "diff", "--name-only", sha1 + "^", sha1).splitlines()
+
+
+def commit_files(git_objdir, ref, paths, message, tmp_path, date="2030-01-01T00:00:00Z"):
+    """
+    Commits new contents of the paths on top of the ref, and moves the ref.
+    """
+
+    parent_sha1 = run_git(git_objdir, "rev-parse", ref)
+    env = dict(COMMIT_ENV, GIT_INDEX_FILE=str(tmp_path / "index"), GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+
+    def git_with_index(*args, **kwargs):
+        return subprocess.check_output([git.GIT_BINARY_PATH, "--git-dir", git_objdir] + list(args), env=env, **kwargs).decode("utf-8").strip()
+
+    git_with_index("read-tree", parent_sha1)
+    for path in paths:
+        blob_sha1 = git_with_index("hash-object", "-w", "--stdin", input=(message + path).encode("utf-8"))
+        git_with_index("update-index", "--add", "--cacheinfo", "100644,{},{}".format(blob_sha1, path))
+
+    tree_sha1 = git_with_index("write-tree")
+    commit_sha1 = git_with_index("commit-tree", tree_sha1, "-p", parent_sha1, "-m", message)
+    run_git(git_objdir, "update-ref", ref, commit_sha1)
+    return commit_sha1
+
+
+def test_indexed_commits_have_their_paths(mirror):
+
+    sha1s = run_git(mirror.clone_path, "rev-list", "--branches", "--remotes").split()
+    stored = changed_paths.lookup(sha1s)
+
+    assert set(stored) == set(sha1s)
+    for sha1 in sha1s[::10] + run_git(mirror.clone_path, "rev-list", "--merges", "--max-count=3", "master").split():
+        assert stored[sha1] == get_first_parent_paths(mirror.clone_path, sha1)
+
+
+def test_fill_skips_stored_commits(fresh_mirror, tmp_path):
+
+    new_sha1 = commit_files(fresh_mirror.clone_path, "refs/heads/master", ["docs/new.txt"], "Not yet stored", tmp_path)
+    sha1s = [new_sha1, run_git(fresh_mirror.clone_path, "rev-parse", "master~")]
+
+    assert changed_paths.fill(fresh_mirror.clone_path, sha1s) == 1
+    assert changed_paths.fill(fresh_mirror.clone_path, sha1s) == 0
+    assert changed_paths.lookup([new_sha1]) == {new_sha1: ["docs/new.txt"]}
+
+
+def test_changed_paths_endpoints(client, mirror):
+
+    [master_sha1, tree_sha1] = [run_git(mirror.clone_path, "rev-parse", rev) for rev in ["master~2", "master^{tree}"]]
+    expected_paths = get_first_parent_paths(mirror.clone_path, master_sha1)
+
+    assert client.get("/changed-paths/master~2").get_json()["result"] == expected_paths
+    assert not client.get("/changed-paths/" + tree_sha1).get_json()["success"]
+
+    body = json.dumps(["master~2", "no-such-commit", tree_sha1, None])
+    [found, missing, not_commit, not_string] = client.post("/changed-paths", data=body).get_json()["result"]
+    assert found == {"sha1": master_sha1, "paths": expected_paths}
+    assert missing == {"sha1": "no-such-commit", "error": "commit no-such-commit is missing"}
+    assert not_commit["error"] == "object {} is a tree, not a commit".format(tree_sha1)
+    assert not_string == {"sha1": None, "error": "commit None is not a string"}
+
+    streamed = client.post("/changed-paths?stream=1", data=body).get_data(as_text=True)
+    assert [json.loads(line) for line in streamed.splitlines()] == [found, missing, not_commit, not_string]
+
+
+def test_unstored_paths_are_read_from_git_and_remembered(fresh_mirror, tmp_path):
+
+    new_sha1 = commit_files(fresh_mirror.clone_path, "refs/heads/master", ["a.txt", "b/c.txt"], "Unindexed", tmp_path)
+    long_git_operations.publish_snapshot()
+
+    [entry] = short_git_operations.fetch_changed_paths_batch([new_sha1])
+    assert entry == {"sha1": new_sha1, "paths": ["a.txt", "b/c.txt"]}
+
+    db.buffered_writer.flush()
+    assert changed_paths.lookup([new_sha1]) == {new_sha1: ["a.txt", "b/c.txt"]}
+
+
+def test_pull_request_changed_paths(client, mirror):
+
+    head_sha1 = run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 3)
+    merge_base_sha1 = run_git(mirror.clone_path, "merge-base", "master", head_sha1)
+
+    expected_paths = run_git(mirror.clone_path, "diff-tree", "-r", "--name-only", merge_base_sha1, head_sha1).splitlines()
+    assert client.get("/pr-changed-paths/3").get_json()["result"] == expected_paths
+    assert not client.get("/pr-changed-paths/x").get_json()["success"]
+
+
+def test_path_commits(fresh_mirror, tmp_path):
+
+    clone_path = fresh_mirror.clone_path
+    older_sha1 = commit_files(clone_path, "refs/heads/master", ["tools/a.py"], "Older", tmp_path)
+    newer_sha1 = commit_files(clone_path, "refs/heads/master", ["tools/sub/b.py", "toolsx.txt"], "Newer", tmp_path, date="2030-01-02T00:00:00Z")
+    long_git_operations.publish_snapshot()
+    long_git_operations.update_indexes()
+
+    def path_commits(path, **kwargs):
+        result = short_git_operations.path_commits(path, **kwargs)
+        assert result["success"], result
+        return [entry["sha1"] for entry in result["result"]]
+
+    # Directories match the paths below them, but not their siblings
+    assert path_commits("tools") == [newer_sha1, older_sha1]
+    assert path_commits("tools/") == [newer_sha1, older_sha1]
+    assert path_commits("tools/a.py") == [older_sha1]
+    assert path_commits("toolsx.txt") == [newer_sha1]
+    assert path_commits("tools", limit="1") == [newer_sha1]
+
+    assert path_commits("tools", ref="master~") == [older_sha1]
+    assert path_commits("file-1.txt", ref="master") == run_git(clone_path, "log", "--max-count=100", "--format=%H", "master", "--", "file-1.txt").split()
+
+    assert not short_git_operations.path_commits(None)["success"]
+    assert not short_git_operations.path_commits("tools", ref="--all")["success"]
+    assert not short_git_operations.path_commits("tools", limit="0")["success"]
@@ -0,0 +1,131 @@
+import itertools
+
+import pytest
+
+import commit_graph
+import short_git_operations
+
+from conftest import add_commit, git_succeeds, run_git
+
+
+@pytest.fixture(scope="module")
+def sample_sha1s(mirror):
+    """
+    Every fifth commit of the mirror, including side branches and PRs.
+    """
+
+    return run_git(mirror.clone_path, "rev-list", "--all", "--topo-order").split()[::5]
+
+
+@pytest.fixture(scope="module")
+def graph(mirror):
+    return commit_graph.indexes.current()
+
+
+def test_indexes_every_reachable_commit(mirror, graph):
+
+    assert set(run_git(mirror.clone_path, "rev-list", "--branches", "--remotes").split()) <= set(graph.ids_by_sha1)
+
+
+def test_parents_match_git(mirror, graph, sample_sha1s):
+
+    for sha1 in sample_sha1s:
+        parent_sha1s = run_git(mirror.clone_path, "rev-parse", sha1 + "^@").split()
+        assert [graph.sha1s[p] for p in graph.parents[graph.lookup(sha1)]] == parent_sha1s
+
+
+def test_is_ancestor_matches_git(mirror, graph, sample_sha1s):
+
+    for ancestor, descendant in itertools.product(sample_sha1s[::3], sample_sha1s[::2]):
+        expected = git_succeeds(mirror.clone_path, "merge-base", "--is-ancestor", ancestor, descendant)
+        assert graph.is_ancestor(graph.lookup(ancestor), graph.lookup(descendant)) == expected, (ancestor, descendant)
+
+
+def test_merge_base_matches_git(mirror, graph, sample_sha1s):
+
+    for first, second in itertools.combinations(sample_sha1s[::3], 2):
+        merge_base_id = graph.merge_base(graph.lookup(first), graph.lookup(second))
+
+        # Criss-cross merges have several best merge bases, of which git picks one
+        expected = set(run_git(mirror.clone_path, "merge-base", "--all", first, second).split())
+        if expected:
+            assert graph.sha1s[merge_base_id] in expected, (first, second)
+        else:
+            assert merge_base_id is None
+
+
+def test_ancestry_path_count_matches_git(mirror, graph, sample_sha1s):
+
+    for base, branch in itertools.product(sample_sha1s[::4], sample_sha1s[::3]):
+        expected = int(run_git(mirror.clone_path, "rev-list", "--ancestry-path", "--count", base + ".." + branch))
+        assert graph.ancestry_path_count(graph.lookup(base), graph.lookup(branch)) == expected, (base, branch)
+
+
+def test_queries_match_git(mirror, sample_sha1s):
+
+    for base, branch in itertools.product(sample_sha1s[::6], sample_sha1s[::4]):
+        assert short_git_operations.git_commit_distance(base, branch)["result"] == int(
+            run_git(mirror.clone_path, "rev-list", "--ancestry-path", "--count", base + ".." + branch))
+        assert short_git_operations.query_ancestry(base, branch)["result"] == git_succeeds(mirror.clone_path, "merge-base", "--is-ancestor", base, branch)
+
+    for sha1 in sample_sha1s:
+        assert short_git_operations.git_master_merge_base(sha1)["result"] == run_git(mirror.clone_path, "merge-base", "master", sha1)
+
+
+def test_update_indexes_new_commits(fresh_mirror):
+
+    graph = commit_graph.CommitGraphIndex()
+    graph.update(fresh_mirror.clone_path)
+    old_master_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+
+    new_sha1s = [add_commit(fresh_mirror.clone_path, "refs/heads/master", "New master commit %d" % i) for i in range(2)]
+    assert graph.update(fresh_mirror.clone_path) == new_sha1s
+    assert graph.is_ancestor(graph.lookup(old_master_sha1), graph.lookup(new_sha1s[-1]))
+    assert graph.update(fresh_mirror.clone_path) == []
+
+
+def test_unindexed_commits_fall_back_to_git(fresh_mirror):
+
+    master_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+    new_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "Unindexed commit")
+    assert commit_graph.indexes.current().lookup(new_sha1) is None
+
+    assert short_git_operations.query_ancestry(master_sha1, new_sha1)["result"] is True
+    assert short_git_operations.git_commit_distance(master_sha1, new_sha1)["result"] == 1
+
+
+def test_ancestors_among_matches_is_ancestor(graph, sample_sha1s):
+
+    candidate_ids = [graph.lookup(sha1) for sha1 in sample_sha1s]
+    for descendant_id in candidate_ids[::4]:
+        expected = set(x for x in candidate_ids if graph.is_ancestor(x, descendant_id))
+        assert graph.ancestors_among(descendant_id, candidate_ids) == expected
+
+
+def test_extend_indexes_unreferenced_commits(fresh_mirror):
+
+    graph = commit_graph.indexes.current()
+    parent_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+    dangling_sha1 = run_git(fresh_mirror.clone_path, "commit-tree", parent_sha1 + "^{tree}", "-p", parent_sha1, "-m", "Dangling")
+    assert graph.lookup(dangling_sha1) is None
+
+    graph.extend(fresh_mirror.clone_path, [dangling_sha1])
+    assert graph.is_ancestor(graph.lookup(parent_sha1), graph.lookup(dangling_sha1))
+
+    # Reported as new once a ref reaches it
+    run_git(fresh_mirror.clone_path, "update-ref", "refs/heads/master", dangling_sha1)
+    assert graph.update(fresh_mirror.clone_path, {"refs/heads/master": (parent_sha1, dangling_sha1)}) == [dangling_sha1]
+
+
+def test_bulk_queries_index_unindexed_commits(client, fresh_mirror, monkeypatch):
+
+    master_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+    new_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "Unindexed commit")
+
+    def fail(*args):
+        raise AssertionError("queried git for a single item")
+
+    monkeypatch.setattr(short_git_operations, "query_ancestry", fail)
+    [entry] = short_git_operations.bulk_query_ancestry([[master_sha1, new_sha1]])
+    assert entry["output"]["result"] is True
+    assert commit_graph.indexes.current().lookup(new_sha1) is not None
@@ -0,0 +1,97 @@
+import json
+import subprocess
+
+import git
+import short_git_operations
+
+from conftest import run_git
+
+
+def test_metadata_matches_single_commit_queries(mirror):
+
+    sha1s = run_git(mirror.clone_path, "rev-list", "--all").split()
+    metadata_list = short_git_operations.fetch_metadata_batch(sha1s)
+
+    assert [metadata["sha1"] for metadata in metadata_list] == sha1s
+    for sha1, metadata in zip(sha1s[::4], metadata_list[::4]):
+        assert metadata == git.get_all_metadata_aspects(mirror.clone_path, sha1)
+
+
+def test_unresolvable_entries_keep_their_place(mirror):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    tree_sha1 = run_git(mirror.clone_path, "rev-parse", "master^{tree}")
+    revisions = ["0" * 40, master_sha1[:10], tree_sha1, "master\nmaster", "master~1"]
+
+    metadata_list = short_git_operations.fetch_metadata_batch(revisions)
+
+    assert metadata_list[0] == {"sha1": "0" * 40, "error": "commit {} is missing".format("0" * 40)}
+    assert metadata_list[1]["sha1"] == master_sha1
+    assert metadata_list[2] == {"sha1": tree_sha1, "error": "object {} is a tree, not a commit".format(tree_sha1)}
+    assert "error" in metadata_list[3]
+    assert metadata_list[4]["sha1"] == run_git(mirror.clone_path, "rev-parse", "master~1")
+
+
+def test_latin1_commit_metadata_is_decoded(mirror):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    tree_sha1 = run_git(mirror.clone_path, "rev-parse", "master^{tree}")
+
+    # Made in latin-1 without an encoding header, so git passes the bytes through
+    commit_bytes = (
+        "tree {tree}\nparent {parent}\n"
+        "author Andr\xe9 <andre@example.com> 1600000000 +0000\n"
+        "committer Andr\xe9 <andre@example.com> 1600000000 +0000\n"
+        "\nCaf\xe9 fix\n"
+    ).format(tree=tree_sha1, parent=master_sha1).encode("latin-1")
+    commit_sha1 = subprocess.run(
+        ["git", "--git-dir", mirror.clone_path, "hash-object", "-t", "commit", "-w", "--stdin"],
+        input=commit_bytes, stdout=subprocess.PIPE, check=True).stdout.decode("utf-8").strip()
+
+    [master_metadata, metadata] = git.iter_metadata_batch(mirror.clone_path, [master_sha1, commit_sha1])
+    assert master_metadata["sha1"] == master_sha1
+    assert metadata["sha1"] == commit_sha1
+    assert metadata["author_name"] == "Andr\ufffd"
+    assert metadata["message"] == "Caf\ufffd fix"
+
+
+def test_resolve_objects(mirror):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    assert git.resolve_objects(mirror.clone_path, ["master", "no such ref", "master\n"]) == [
+        (master_sha1, "commit"),
+        (None, "missing"),
+        (None, "missing"),
+    ]
+
+
+def test_commit_metadata_endpoint(client, mirror):
+
+    sha1s = run_git(mirror.clone_path, "rev-list", "--max-count=3", "master").split()
+    response = client.post("/commit-metadata", data=json.dumps(sha1s + ["0" * 40]))
+
+    result = response.get_json()["result"]
+    assert [metadata["sha1"] for metadata in result] == sha1s + ["0" * 40]
+    assert result[0]["subject"] == run_git(mirror.clone_path, "log", "--max-count=1", "--format=%f", "master")
+
+
+def test_commit_metadata_errors_per_commit(client, mirror):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    [found, not_string, repeated] = client.post("/commit-metadata", data=json.dumps([master_sha1, 5, master_sha1])).get_json()["result"]
+
+    assert found["subject"] == run_git(mirror.clone_path, "log", "--max-count=1", "--format=%f", "master")
+    assert not_string == {"sha1": 5, "error": "commit 5 is not a string"}
+    assert repeated == found
+
+
+def test_streamed_chunk_failure_gives_error_entries(mirror, monkeypatch):
+
+    def fail(commit_sha1_list):
+        raise subprocess.CalledProcessError(128, ["git", "cat-file"], stderr="broken")
+
+    monkeypatch.setattr(short_git_operations, "fetch_metadata_batch", fail)
+    entries = list(short_git_operations.iter_metadata(["master", "master~"]))
+
+    assert [entry["sha1"] for entry in entries] == ["master", "master~"]
+    assert all("cat-file" in entry["error"] for entry in entries)
@@ -0,0 +1,127 @@
+import json
+
+import pytest
+
+import git
+import long_git_operations
+import repos
+
+from conftest import add_commit, run_git
+
+
+def get_result(client, url):
+
+    response = client.get(url).get_json()
+    assert response["success"], response
+    return response["result"]
+
+
+def read_all_pages(client, url, limit):
+
+    commits = []
+    page = get_result(client, "{}?limit={}&fields=subject".format(url, limit))
+    commits.extend(page["commits"])
+    while page["next_cursor"]:
+        assert len(page["commits"]) == limit
+        page = get_result(client, "{}?limit={}&fields=subject&cursor={}".format(url, limit, page["next_cursor"]))
+        commits.extend(page["commits"])
+
+    return commits
+
+
+@pytest.mark.parametrize("limit", [1, 7, 100])
+def test_pages_cover_the_range(client, mirror, limit):
+
+    base_sha1 = run_git(mirror.clone_path, "rev-parse", "master~30")
+    expected_sha1s = run_git(mirror.clone_path, "rev-list", "--ancestry-path", base_sha1 + "..master").split()
+
+    commits = read_all_pages(client, "/commit-range/{}/master".format(base_sha1), limit)
+
+    assert [commit["sha1"] for commit in commits] == expected_sha1s
+    assert len(expected_sha1s) == get_result(client, "/commit-distance/{}/{}".format(base_sha1, run_git(mirror.clone_path, "rev-parse", "master")))
+    for commit in commits[::10]:
+        assert commit["subject"] == run_git(mirror.clone_path, "log", "--max-count=1", "--format=%f", commit["sha1"])
+
+
+def test_cursor_is_pinned_to_the_first_page(client, fresh_mirror, monkeypatch):
+
+    monkeypatch.setitem(repos.repos_by_name, "test/pinned", fresh_mirror)
+    old_sha1s = run_git(fresh_mirror.clone_path, "rev-list", "--ancestry-path", "master~10..master").split()
+    first_page = get_result(client, "/repos/test/pinned/commit-range/master~10/master?limit=4")
+
+    # Later pages keep walking the range that the first page resolved
+    add_commit(fresh_mirror.clone_path, "refs/heads/master", "Moves master")
+    long_git_operations.publish_snapshot()
+
+    commits = first_page["commits"]
+    cursor = first_page["next_cursor"]
+    while cursor:
+        page = get_result(client, "/repos/test/pinned/commit-range/master/master?limit=4&cursor=" + cursor)
+        commits.extend(page["commits"])
+        cursor = page["next_cursor"]
+
+    assert [commit["sha1"] for commit in commits] == old_sha1s
+    assert commits[0] == {"sha1": old_sha1s[0]}
+
+
+def test_cursor_resumes_after_its_commit(client, mirror):
+
+    base_sha1 = run_git(mirror.clone_path, "rev-parse", "master~20")
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    expected_sha1s = run_git(mirror.clone_path, "rev-list", "--ancestry-path", base_sha1 + "..master").split()
+
+    first_page = get_result(client, "/commit-range/{}/master?limit=5".format(base_sha1))
+    assert first_page["next_cursor"] == "{}.{}.{}".format(base_sha1, master_sha1, expected_sha1s[4])
+
+    cursor = "{}.{}.{}".format(base_sha1, master_sha1, expected_sha1s[10])
+    page = get_result(client, "/commit-range/master/master?limit=3&cursor=" + cursor)
+    assert [commit["sha1"] for commit in page["commits"]] == expected_sha1s[11:14]
+
+    # A commit outside of the range has no commits after it
+    cursor = "{}.{}.{}".format(base_sha1, master_sha1, base_sha1)
+    page = get_result(client, "/commit-range/master/master?limit=3&cursor=" + cursor)
+    assert page == {"commits": [], "next_cursor": None}
+
+
+def test_streamed_range_is_not_paginated(client, mirror):
+
+    expected_sha1s = run_git(mirror.clone_path, "rev-list", "--ancestry-path", "master~100..master").split()
+    response = client.get("/commit-range/master~100/master?stream=1&fields=author_name,tree_sha1")
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert len(expected_sha1s) > 100
+    assert [record["sha1"] for record in records] == expected_sha1s
+    assert set(records[0]) == {"sha1", "author_name", "tree_sha1"}
+
+
+def test_pull_request_commits(client, mirror):
+
+    head_sha1 = run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 4)
+    merge_base_sha1 = run_git(mirror.clone_path, "merge-base", "master", head_sha1)
+    expected_sha1s = run_git(mirror.clone_path, "rev-list", "--ancestry-path", merge_base_sha1 + ".." + head_sha1).split()
+
+    page = get_result(client, "/pr-commits/4")
+    assert [commit["sha1"] for commit in page["commits"]] == expected_sha1s
+    assert page["next_cursor"] is None
+
+    assert not client.get("/pr-commits/1000").get_json()["success"]
+    assert not client.get("/pr-commits/abc").get_json()["success"]
+
+
+@pytest.mark.parametrize("query_string, error_start", [
+    ("?fields=subject,nonexistent", "unknown field nonexistent"),
+    ("?limit=0", "limit must be between"),
+    ("?limit=100000", "limit must be between"),
+    ("?cursor=abc", "invalid cursor"),
+])
+def test_invalid_range_requests(client, mirror, query_string, error_start):
+
+    response = client.get("/commit-range/master~3/master" + query_string).get_json()
+    assert not response["success"]
+    assert response["error"].startswith(error_start)
+
+
+def test_unresolvable_range_ends(client, mirror):
+
+    assert client.get("/commit-range/no-such-ref/master").get_json()["error"] == "fatal: missing revision 'no-such-ref'"
+    assert "not a commit" in client.get("/commit-range/master^{tree}/master").get_json()["error"]
@@ -0,0 +1,145 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+import db
+import git
+
+
+def test_connections_are_reused_per_thread():
+
+    conn = db.db_connect()
+    assert db.db_connect() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+    other_thread_conns = []
+    thread = threading.Thread(target=lambda: other_thread_conns.append(db.db_connect()))
+    thread.start()
+    thread.join()
+    assert other_thread_conns[0] is not conn
+
+
+def test_buffered_logs_are_visible_to_readers():
+
+    db.clear_command_logs()
+    db.insert_events(["push", "pull_request"])
+    db.insert_operation_log("fetch", 1.5, git.CommandResult(0, "out", "err"))
+
+    # Reads flush the buffer first
+    assert [event for _, event, _ in db.get_github_event_logs()] == ["pull_request", "push"]
+    [(duration, _, return_code, stdout, stderr)] = db.get_operation_logs("fetch")
+    assert (duration, return_code, stdout, stderr) == (1.5, 0, "out", "err")
+
+    db.clear_command_logs()
+    assert db.get_github_event_logs() == []
+
+
+def test_flush_writes_pending_rows():
+
+    writer = db.BufferedWriter(flush_interval_seconds=3600)
+    for i in range(3):
+        writer.add(db.INSERT_EVENT_SQL, ("event %d" % i,))
+
+    writer.flush()
+    assert writer.pending.empty()
+    assert db.db_connect().execute("SELECT COUNT(*) FROM github_events WHERE event LIKE 'event %'").fetchone() == (3,)
+
+
+def get_test_values():
+    rows = db.db_connect().execute("SELECT value FROM buffered_writer_test ORDER BY value").fetchall()
+    return [value for (value,) in rows]
+
+
+@pytest.fixture
+def test_table():
+    with db.db_connect() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS buffered_writer_test (value INTEGER UNIQUE)")
+        conn.execute("DELETE FROM buffered_writer_test")
+
+
+def lock_database_for(monkeypatch, failed_flushes):
+
+    write = db.BufferedWriter._write
+    failures = []
+
+    def locked_write(self, batch):
+        if len(failures) < failed_flushes:
+            failures.append(batch)
+            raise sqlite3.OperationalError("database is locked")
+        return write(self, batch)
+
+    monkeypatch.setattr(db.BufferedWriter, "_write", locked_write)
+
+
+def test_locked_flush_keeps_rows(test_table, monkeypatch):
+
+    writer = db.BufferedWriter(flush_interval_seconds=3600)
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (1,))
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (2,))
+
+    lock_database_for(monkeypatch, 1)
+    writer.flush()
+    assert get_test_values() == []
+
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (3,))
+    writer.flush()
+    assert get_test_values() == [1, 2, 3]
+    assert writer.dropped_row_count == 0
+
+
+def test_rows_locked_out_repeatedly_are_dropped(test_table, monkeypatch):
+
+    writer = db.BufferedWriter(flush_interval_seconds=3600)
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (1,))
+
+    lock_database_for(monkeypatch, db.MAX_FLUSH_ATTEMPTS)
+    for _ in range(db.MAX_FLUSH_ATTEMPTS):
+        writer.flush()
+
+    assert writer.unwritten == []
+    assert writer.dropped_row_count == 1
+    writer.flush()
+    assert get_test_values() == []
+
+
+def test_failing_rows_are_dropped_and_others_written(test_table):
+
+    writer = db.BufferedWriter(flush_interval_seconds=3600)
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (1,))
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (1,))
+    writer.add("INSERT INTO missing_table (value) VALUES (?)", (2,))
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (3,))
+
+    # Neither a violated constraint nor a missing table is retried
+    writer.flush()
+    assert get_test_values() == [1, 3]
+    assert writer.unwritten == []
+    assert [values for _, values, _ in writer.dead_letters] == [(1,), (2,)]
+
+
+def test_buffer_is_capped(test_table, monkeypatch):
+
+    writer = db.BufferedWriter(flush_interval_seconds=3600, max_pending_rows=2)
+    for value in range(3):
+        writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (value,))
+    assert writer.dropped_row_count == 1
+
+    # Rows kept after a locked flush count towards the cap too, the oldest dropped first
+    lock_database_for(monkeypatch, 2)
+    writer.flush()
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (3,))
+    writer.add("INSERT INTO buffered_writer_test (value) VALUES (?)", (4,))
+    writer.flush()
+    assert writer.dropped_row_count == 3
+
+    writer.flush()
+    assert get_test_values() == [3, 4]
+
+
+def test_database_directory_is_created(tmp_path):
+
+    db_path = str(tmp_path / "new" / "database.sqlite3")
+    db.db_connect(db_path).execute("SELECT COUNT(*) FROM github_events")
+    assert os.path.exists(db_path)
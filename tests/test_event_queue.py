@@ -0,0 +1,124 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+import event_queue
+
+
+def wait_for(condition, timeout_seconds=5):
+
+    deadline = time.monotonic() + timeout_seconds
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_events_are_processed_in_batches():
+
+    release = threading.Event()
+    batches = []
+
+    def process_batch(batch):
+        batches.append(batch)
+        release.wait()
+
+    events = event_queue.EventQueue(process_batch, max_batch_size=3)
+    events.put("push", b"0")
+    wait_for(lambda: batches)
+
+    # These pile up while the first batch is processed
+    for i in range(1, 6):
+        events.put("push", str(i).encode("utf-8"))
+
+    assert events.depth() == 5
+    release.set()
+
+    wait_for(lambda: events.processed_count == 6)
+    assert [[payload for _, payload in batch] for batch in batches] == [[b"0"], [b"1", b"2", b"3"], [b"4", b"5"]]
+
+
+def test_failed_batch_does_not_stop_processing():
+
+    batches = []
+
+    def process_batch(batch):
+        batches.append(batch)
+        if len(batches) == 1:
+            raise KeyError("ref")
+
+    events = event_queue.EventQueue(process_batch)
+    events.put("push", b"{}")
+    wait_for(lambda: events.processed_count == 1)
+    events.put("push", b"{}")
+    wait_for(lambda: events.processed_count == 2)
+
+    assert len(batches) == 2
+
+
+def test_batch_queues_one_fetch(monkeypatch, client):
+
+    import application
+    import db
+    import long_git_operations
+
+    logged_event_types = []
+    fetched_refspecs = []
+    monkeypatch.setattr(db, "insert_events", logged_event_types.extend)
+    monkeypatch.setattr(long_git_operations, "do_pr_fetch", fetched_refspecs.append)
+
+    def event(event_type, payload):
+        payload = dict(payload, repository={"full_name": "pytorch/pytorch"})
+        return (event_type, json.dumps(payload).encode("utf-8"))
+
+    application.process_github_events([
+        event("push", {"ref": "refs/heads/master"}),
+        event("push", {"ref": "refs/heads/feature"}),
+        event("pull_request", {"action": "synchronize", "number": 7}),
+        event("pull_request", {"action": "closed", "number": 8}),
+        ("push", b"not json"),
+        ("push", b"{}"),
+    ])
+
+    assert logged_event_types == ["push", "push", "pull_request", "pull_request", "push", "push"]
+    assert fetched_refspecs == [["master:master", "refs/pull/7/*:refs/remotes/origin/pr/7/*"]]
+
+
+def test_fetch_is_queued_when_logging_fails(monkeypatch, client):
+
+    import application
+    import db
+    import long_git_operations
+
+    def fail(event_types):
+        raise RuntimeError("log unavailable")
+
+    fetched_refspecs = []
+    monkeypatch.setattr(db, "insert_events", fail)
+    monkeypatch.setattr(long_git_operations, "do_pr_fetch", fetched_refspecs.append)
+
+    payload = {"ref": "refs/heads/master", "repository": {"full_name": "pytorch/pytorch"}}
+    application.process_github_events([("push", json.dumps(payload).encode("utf-8"))])
+
+    assert fetched_refspecs == [["master:master"]]
+
+
+def test_webhook_is_acknowledged_before_processing(monkeypatch, client):
+
+    import application
+
+    received_events = []
+    monkeypatch.setattr(application.github_event_queue, "put", lambda *event: received_events.append(event))
+    monkeypatch.setenv("GITHUB_WEBHOOK_SECRET", "secret")
+
+    body = json.dumps({"ref": "refs/heads/master"}).encode("utf-8")
+    signature = "sha1=" + hmac.new(b"secret", body, hashlib.sha1).hexdigest()
+
+    response = client.post("/github-webhook-event", data=body, headers={"X-GitHub-Event": "push", "X-Hub-Signature": signature})
+    assert response.status_code == 202
+    assert received_events == [("push", body)]
+
+    response = client.post("/github-webhook-event", data=body, headers={"X-GitHub-Event": "push", "X-Hub-Signature": "sha1=0"})
+    assert response.status_code == 403
+    assert len(received_events) == 1
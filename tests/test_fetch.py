@@ -0,0 +1,130 @@
+import datetime
+
+import commit_graph
+import git
+import long_git_operations
+import pr_refs
+import repos
+
+from conftest import add_commit, run_git
+
+
+def test_event_refspecs():
+
+    assert git.refspecs_for_pushed_ref("refs/heads/master") == ["master:master"]
+    assert git.refspecs_for_pushed_ref("refs/heads/feature") == []
+    assert git.refspecs_for_pull_request(12) == ["refs/pull/12/*:refs/remotes/origin/pr/12/*"]
+
+    assert git.refspec_destination_patterns(git.FULL_FETCH_REFSPECS) == [
+        "refs/heads/viable/strict",
+        "refs/heads/master",
+        "refs/remotes/origin/pr/",
+    ]
+
+
+def test_diff_ref_snapshots():
+
+    before = {"refs/heads/a": "1", "refs/heads/b": "2", "refs/heads/c": "3"}
+    after = {"refs/heads/a": "1", "refs/heads/b": "4", "refs/heads/d": "5"}
+
+    assert git.diff_ref_snapshots(before, after) == {
+        "refs/heads/b": ("2", "4"),
+        "refs/heads/c": ("3", None),
+        "refs/heads/d": (None, "5"),
+    }
+
+
+def test_pr_number_of_head_ref():
+
+    assert pr_refs.pr_number_of_head_ref("refs/remotes/origin/pr/12/head") == 12
+    assert pr_refs.pr_number_of_head_ref("refs/remotes/origin/pr/12/merge") is None
+    assert pr_refs.pr_number_of_head_ref("refs/remotes/origin/pr/x/head") is None
+    assert pr_refs.pr_number_of_head_ref("refs/heads/pr/12/head") is None
+
+
+def test_incremental_fetch_only_fetches_its_refs(fresh_mirror):
+
+    origin_path = fresh_mirror.clone_url
+    old_master_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+    old_head_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 2)
+
+    add_commit(origin_path, "refs/heads/master", "Unfetched master commit")
+    new_head_sha1 = add_commit(origin_path, "refs/pull/2/head", "Update PR 2")
+
+    cmd_result, ref_changes = git.fetch_with_ref_changes(fresh_mirror.clone_path, git.refspecs_for_pull_request(2))
+
+    assert not cmd_result.return_code
+    assert ref_changes == {git.PR_REF_TEMPLATE % 2: (old_head_sha1, new_head_sha1)}
+    assert run_git(fresh_mirror.clone_path, "rev-parse", "master") == old_master_sha1
+
+
+def test_ref_changes_update_indexes(fresh_mirror):
+
+    graph = commit_graph.CommitGraphIndex()
+    graph.update(fresh_mirror.clone_path)
+    table = pr_refs.PullRequestRefTable()
+    table.load(fresh_mirror.clone_path)
+
+    origin_path = fresh_mirror.clone_url
+    new_head_sha1 = add_commit(origin_path, "refs/pull/2/head", "Update PR 2")
+    _, ref_changes = git.fetch_with_ref_changes(fresh_mirror.clone_path, git.refspecs_for_pull_request(2))
+
+    assert graph.update(fresh_mirror.clone_path, ref_changes) == [new_head_sha1]
+    assert graph.indexed_refs[git.PR_REF_TEMPLATE % 2] == new_head_sha1
+
+    table.apply_ref_changes(ref_changes, fresh_mirror.clone_path)
+    assert table.head_of(2) == new_head_sha1
+    assert table.pointing_prs(new_head_sha1) == [2]
+
+    # Deleted refs are no longer indexed
+    old_head_sha1 = graph.indexed_refs[git.PR_REF_TEMPLATE % 3]
+    assert graph.update(fresh_mirror.clone_path, {git.PR_REF_TEMPLATE % 3: (old_head_sha1, None)}) == []
+    assert git.PR_REF_TEMPLATE % 3 not in graph.indexed_refs
+
+
+def test_apply_ref_changes_leaves_old_mappings():
+
+    table = pr_refs.PullRequestRefTable()
+    table.apply_ref_changes({"refs/remotes/origin/pr/1/head": (None, "a" * 40)}, "snapshot")
+    assert not table.is_loaded()
+
+    table.mappings = ({1: "a" * 40, 2: "a" * 40}, {"a" * 40: {1, 2}})
+    old_mappings = table.mappings
+
+    table.apply_ref_changes({
+        "refs/remotes/origin/pr/1/head": ("a" * 40, "b" * 40),
+        "refs/remotes/origin/pr/2/head": ("a" * 40, None),
+        "refs/remotes/origin/pr/3/head": (None, "b" * 40),
+        "refs/heads/master": ("a" * 40, "c" * 40),
+    }, "snapshot")
+
+    assert table.pointing_prs("a" * 40) == []
+    assert table.pointing_prs("b" * 40) == [1, 3]
+    assert table.head_of(2) is None
+
+    # Readers of the old mappings are unaffected
+    assert old_mappings == ({1: "a" * 40, 2: "a" * 40}, {"a" * 40: {1, 2}})
+
+
+def test_full_fetches_are_requested_when_due(fresh_mirror, tmp_path, monkeypatch):
+
+    uncloned_repo = repos.Repo("test/uncloned", clone_path=str(tmp_path / "missing.git"))
+    monkeypatch.setattr(repos, "all_repos", lambda: [fresh_mirror, uncloned_repo])
+
+    requests = []
+    state = long_git_operations.mirror_states.current()
+    monkeypatch.setattr(state.fetch_scheduler, "request", lambda refspecs=None: requests.append((repos.current(), refspecs)))
+
+    # Due at startup, then not again while the requested fetch is pending
+    long_git_operations.request_due_full_fetches()
+    long_git_operations.request_due_full_fetches()
+    assert requests == [(fresh_mirror, None)]
+
+    long_ago = datetime.datetime.now() - datetime.timedelta(seconds=long_git_operations.FULL_FETCH_INTERVAL_SECONDS + 1)
+    state.last_full_fetch_request_time = long_ago
+    state.last_full_fetch_time = datetime.datetime.now()
+    assert not long_git_operations.is_full_fetch_due(state)
+
+    state.last_full_fetch_time = long_ago
+    long_git_operations.request_due_full_fetches()
+    assert requests == [(fresh_mirror, None)] * 2
@@ -0,0 +1,114 @@
+import threading
+import time
+
+import fetch_scheduler
+
+
+def wait_for_fetches(scheduler, count, timeout_seconds=5):
+
+    deadline = time.monotonic() + timeout_seconds
+    while scheduler.get_stats()["completed_fetches"] < count:
+        assert time.monotonic() < deadline, "timed out waiting for fetches"
+        time.sleep(0.01)
+
+
+def test_burst_is_merged_into_one_fetch():
+
+    fetches = []
+    scheduler = fetch_scheduler.FetchScheduler(fetches.append, debounce_seconds=0.2, max_staleness_seconds=5)
+
+    for refspecs in [["b"], ["a", "b"], ["c"]]:
+        scheduler.request(refspecs)
+
+    wait_for_fetches(scheduler, 1)
+    time.sleep(0.3)
+
+    assert fetches == [["a", "b", "c"]]
+    stats = scheduler.get_stats()
+    assert stats["merged_requests"] == {"total": 3, "last_fetch": 3, "max": 3}
+    assert stats["queue_depth"] == 0
+
+
+def test_full_request_absorbs_refspecs():
+
+    fetches = []
+    scheduler = fetch_scheduler.FetchScheduler(fetches.append, debounce_seconds=0.1, max_staleness_seconds=5)
+
+    scheduler.request(["a"])
+    scheduler.request()
+
+    wait_for_fetches(scheduler, 1)
+    assert fetches == [None]
+
+
+def test_request_during_fetch_is_not_dropped():
+
+    fetch_started = threading.Event()
+    release_fetch = threading.Event()
+    fetches = []
+
+    def fetch(refspecs):
+        fetches.append(refspecs)
+        fetch_started.set()
+        release_fetch.wait()
+
+    scheduler = fetch_scheduler.FetchScheduler(fetch, debounce_seconds=0.01, max_staleness_seconds=5)
+
+    scheduler.request(["a"])
+    assert fetch_started.wait(5)
+
+    scheduler.request(["b"])
+    assert scheduler.get_stats()["queue_depth"] == 1
+    release_fetch.set()
+
+    wait_for_fetches(scheduler, 2)
+    assert fetches == [["a"], ["b"]]
+
+
+def test_steady_requests_are_fetched_within_max_staleness():
+
+    fetches = []
+    scheduler = fetch_scheduler.FetchScheduler(fetches.append, debounce_seconds=0.2, max_staleness_seconds=0.3)
+
+    # Each request would push the debounce deadline back on its own
+    start_time = time.monotonic()
+    while not fetches and time.monotonic() - start_time < 2:
+        scheduler.request(["a"])
+        time.sleep(0.05)
+
+    assert fetches
+    assert time.monotonic() - start_time < 1
+
+
+def test_failed_fetch_does_not_stop_scheduler():
+
+    fetches = []
+
+    def fetch(refspecs):
+        fetches.append(refspecs)
+        if len(fetches) == 1:
+            raise RuntimeError("remote hung up")
+
+    scheduler = fetch_scheduler.FetchScheduler(fetch, debounce_seconds=0.01, max_staleness_seconds=5)
+
+    scheduler.request(["a"])
+    wait_for_fetches(scheduler, 1)
+    scheduler.request(["b"])
+    wait_for_fetches(scheduler, 2)
+
+    assert fetches == [["a"], ["b"]]
+
+
+def test_full_fetches_are_rate_limited():
+
+    start_times = []
+    scheduler = fetch_scheduler.FetchScheduler(
+        lambda refspecs: start_times.append(time.monotonic()),
+        debounce_seconds=0.01, max_staleness_seconds=5, full_fetch_min_interval_seconds=0.3)
+
+    scheduler.request()
+    wait_for_fetches(scheduler, 1)
+    scheduler.request()
+    wait_for_fetches(scheduler, 2)
+
+    assert start_times[1] - start_times[0] >= 0.3
@@ -0,0 +1,128 @@
+import io
+import json
+
+import pytest
+
+import json_stream
+
+from conftest import run_git
+
+
+ITEMS = ["0123456789abcdef", 12345, -1.5e3, "naïve ☃", {"a": [1, 2]}, [], None, True, ""]
+
+
+def read_array(body, chunk_size):
+    return list(json_stream.JsonArrayReader(io.BytesIO(body), chunk_size))
+
+
+def post_streamed(client, url, data, **kwargs):
+
+    response = client.post(url + "?stream=1", data=data, **kwargs)
+    assert response.status_code == 200
+    assert response.mimetype == json_stream.NDJSON_MIMETYPE
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+@pytest.mark.parametrize("chunk_size", range(1, 12))
+def test_reads_array_in_any_chunk_size(chunk_size):
+
+    # Multibyte characters and numbers are split across chunks
+    body = json.dumps(ITEMS, ensure_ascii=False).encode("utf-8")
+    assert read_array(body, chunk_size) == ITEMS
+    assert read_array(b" [ ] ", chunk_size) == []
+    assert read_array(b"[1,\n 23]", chunk_size) == [1, 23]
+
+
+@pytest.mark.parametrize("body", [
+    b"",
+    b"{}",
+    b"[1, 2",
+    b"[1 2]",
+    b"[1,]",
+    b"[\"unterminated]",
+])
+def test_invalid_array_raises(body):
+
+    with pytest.raises(json_stream.InvalidJsonError):
+        list(json_stream.iter_json_array(io.BytesIO(body)))
+
+
+def test_reads_ndjson_skipping_blank_lines():
+
+    body = b"\"a\"\n\n  \n{\"b\": 1}\r\n2"
+    assert list(json_stream.iter_ndjson(io.BytesIO(body))) == ["a", {"b": 1}, 2]
+
+
+def test_invalid_ndjson_line_is_reported():
+
+    records = json_stream.iter_ndjson(io.BytesIO(b"\"a\"\n\n{\"b\": \n\"c\"\n"))
+
+    assert next(records) == "a"
+    with pytest.raises(json_stream.InvalidJsonError, match="line 3"):
+        next(records)
+
+
+def test_checked_items_stop_at_error():
+
+    items = json_stream.CheckedItems(json_stream.iter_ndjson(io.BytesIO(b"1\n2\nnot json\n4\n")))
+
+    assert list(items) == [1, 2]
+    assert "line 3" in str(items.error)
+
+    items = json_stream.CheckedItems(json_stream.iter_json_array(io.BytesIO(b"[1, 2]")))
+    assert list(items) == [1, 2]
+    assert items.error is None
+
+
+def test_writes_ndjson_lines():
+
+    lines = list(json_stream.iter_ndjson_lines([{"a": 1}, "b"]))
+    assert [json.loads(line) for line in lines] == [{"a": 1}, "b"]
+    assert all(line.endswith("\n") and line.count("\n") == 1 for line in lines)
+
+
+def test_streamed_metadata_matches_batch(client, mirror):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    parent_sha1 = run_git(mirror.clone_path, "rev-parse", "master~")
+    batch = client.post("/commit-metadata", data=json.dumps([master_sha1, parent_sha1])).get_json()["result"]
+
+    assert post_streamed(client, "/commit-metadata", json.dumps([master_sha1, parent_sha1])) == batch
+
+    data = "\"{}\"\n\n\"{}\"\n".format(master_sha1, parent_sha1)
+    assert post_streamed(client, "/commit-metadata", data, content_type=json_stream.NDJSON_MIMETYPE) == batch
+
+
+def test_streamed_refs_and_pull_request_heads(client, mirror):
+
+    [master, missing] = post_streamed(client, "/bulk-rev-parse", json.dumps(["master", "nope"]))
+    assert master["ref"] == "master"
+    assert master["output"]["result"] == run_git(mirror.clone_path, "rev-parse", "master")
+    assert not missing["output"]["success"]
+
+    response = client.post("/bulk-pull-request-heads", data=json.dumps([2]), headers={"Accept": json_stream.NDJSON_MIMETYPE})
+    [head] = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert head["pr_number"] == 2
+    assert head["output"]["result"] == run_git(mirror.clone_path, "rev-parse", "refs/remotes/origin/pr/2/head")
+
+
+@pytest.mark.parametrize("url", ["/commit-metadata", "/changed-paths", "/bulk-rev-parse", "/bulk-pull-request-heads"])
+@pytest.mark.parametrize("data", ["\"oops\"", "[\"a\", ", "[1 2]"])
+def test_bulk_requests_reject_invalid_json(client, url, data):
+
+    response = client.post(url, data=data)
+    assert response.status_code == 400
+    assert response.get_json()["error"].startswith("Invalid request body: ")
+
+
+def test_streamed_invalid_json_ends_with_error_record(client, mirror):
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    data = "\"{}\"\n\"master~\"\n{{\n".format(master_sha1)
+    response = client.post("/changed-paths?stream=1", data=data, content_type=json_stream.NDJSON_MIMETYPE)
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert response.status_code == 200
+    assert [record.get("sha1") for record in records[:-1]] == [master_sha1, run_git(mirror.clone_path, "rev-parse", "master~")]
+    assert not records[-1]["success"]
+    assert records[-1]["error"].startswith("Invalid request body: line 3")
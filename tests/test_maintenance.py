@@ -0,0 +1,98 @@
+import datetime
+import os
+import time
+
+import pytest
+
+import db
+import git
+import long_git_operations
+import repos
+import snapshots
+
+from conftest import add_commit, run_git
+
+
+def wait_for_operation(timeout_seconds=30):
+    """
+    Waits until the current repo's mutating operation has finished.
+    """
+
+    lock = long_git_operations.mirror_states.current().operation_info.mutating_operation_lock
+
+    deadline = time.monotonic() + timeout_seconds
+    while lock.locked():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_maintenance_steps_compact_the_mirror(fresh_mirror):
+
+    clone_path = fresh_mirror.clone_path
+    refs_before = run_git(clone_path, "show-ref")
+    add_commit(clone_path, "refs/heads/master", "Loose commit")
+
+    cmd_result = long_git_operations.run_maintenance_steps(clone_path)
+
+    assert cmd_result.return_code == 0, cmd_result.stderr
+    assert [line.split(":")[0] for line in cmd_result.stdout.splitlines() if ": returned " in line] == [
+        "pack_refs", "repack_geometric", "write_commit_graph", "prune_loose_objects"]
+
+    assert os.path.exists(os.path.join(clone_path, "objects", "pack", "multi-pack-index"))
+    assert os.path.exists(os.path.join(clone_path, "objects", "info", "commit-graphs", "commit-graph-chain"))
+    assert run_git(clone_path, "for-each-ref", "--format=%(refname)", "refs/heads/master")
+    assert not os.path.exists(os.path.join(clone_path, "refs", "heads", "master"))
+
+    # The published snapshot still reads every object through its alternates
+    read_path = snapshots.get_read_path()
+    assert run_git(read_path, "show-ref") == refs_before
+    run_git(read_path, "rev-list", "--objects", "--all")
+
+
+def test_maintenance_runs_every_step_despite_failures(fresh_mirror, monkeypatch):
+
+    monkeypatch.setattr(git, "pack_refs", lambda git_objdir: git.CommandResult(3, "", "refs are locked"))
+
+    cmd_result = long_git_operations.run_maintenance_steps(fresh_mirror.clone_path)
+
+    assert cmd_result.return_code == 3
+    assert "<lambda>: refs are locked" in cmd_result.stderr
+    assert "write_commit_graph: returned 0" in cmd_result.stdout
+    assert "prune_loose_objects: returned 0" in cmd_result.stdout
+
+
+def test_maintenance_operation_is_logged(fresh_mirror):
+
+    state = long_git_operations.mirror_states.current()
+    assert long_git_operations.is_maintenance_due(state)
+
+    assert long_git_operations.do_maintenance() == {"status": "started"}
+    wait_for_operation()
+
+    assert not long_git_operations.is_maintenance_due(state)
+    [log_row] = db.get_operation_logs(repos.get_log_operation_name("maintenance"))
+    assert log_row[2] == 0
+    assert "Last maintenance finished at" in long_git_operations.render_status()
+
+    state.last_maintenance_start_time -= datetime.timedelta(seconds=long_git_operations.MAINTENANCE_INTERVAL_SECONDS + 1)
+    assert long_git_operations.is_maintenance_due(state)
+
+
+def test_maintenance_needs_a_clone(tmp_path):
+
+    with repos.use(repos.Repo("test/uncloned", clone_path=str(tmp_path / "missing.git"))):
+        assert long_git_operations.do_maintenance() == {"status": "skipped", "message": "No clone to maintain."}
+        assert long_git_operations.render_maintenance_status() == "<p>No maintenance has run.</p>"
+
+
+def test_git_version_is_checked_before_background_work(monkeypatch):
+
+    assert git.get_version() >= git.MIN_GIT_VERSION
+
+    monkeypatch.setattr(git, "get_version", lambda: (2, 30, 1))
+    monkeypatch.setattr(long_git_operations, "background_work_started", False)
+
+    with pytest.raises(git.UnsupportedGitVersionError, match="git 2.30.1 is installed, but 2.34 or later"):
+        long_git_operations.start_background_work()
+
+    assert not long_git_operations.background_work_started
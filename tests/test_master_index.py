@@ -0,0 +1,65 @@
+import itertools
+
+import commit_graph
+import master_index
+
+from conftest import add_commit, run_git, side_branch_commit
+
+
+def test_merge_base_matches_git(mirror):
+
+    graph = commit_graph.indexes.current()
+    master = master_index.indexes.current()
+    assert master.tip_sha1 == run_git(mirror.clone_path, "rev-parse", "master")
+
+    for sha1 in run_git(mirror.clone_path, "rev-list", "--all").split():
+        expected = set(run_git(mirror.clone_path, "merge-base", "--all", "master", sha1).split())
+        assert graph.sha1s[master.merge_base(graph.lookup(sha1))] in expected, sha1
+
+
+def test_distances_match_git(mirror):
+
+    graph = commit_graph.indexes.current()
+    master = master_index.indexes.current()
+    chain_sha1s = run_git(mirror.clone_path, "rev-list", "--first-parent", "master").split()
+
+    answered_count = 0
+    for base, branch in itertools.permutations(chain_sha1s[::8], 2):
+        count = master.ancestry_path_count(graph.lookup(base), graph.lookup(branch))
+        if count is not None:
+            answered_count += 1
+            assert count == int(run_git(mirror.clone_path, "rev-list", "--ancestry-path", "--count", base + ".." + branch)), (base, branch)
+
+    assert answered_count
+
+
+def test_chain_positions(mirror):
+
+    graph = commit_graph.indexes.current()
+    master = master_index.indexes.current()
+    chain_sha1s = run_git(mirror.clone_path, "rev-list", "--first-parent", "--reverse", "master").split()
+
+    assert [graph.sha1s[commit_id] for commit_id in master.chain_ids] == chain_sha1s
+    side_sha1 = side_branch_commit(mirror.clone_path)
+    assert master.chain_position(graph.lookup(side_sha1)) is None
+
+
+def test_extends_and_rebuilds_on_rewind(fresh_mirror):
+
+    graph = commit_graph.CommitGraphIndex()
+    master = master_index.MasterIndex(graph)
+    graph.update(fresh_mirror.clone_path)
+    master.update(run_git(fresh_mirror.clone_path, "rev-parse", "master"))
+    chain_length = len(master.chain_ids)
+
+    new_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "New master commit")
+    graph.update(fresh_mirror.clone_path)
+    master.update(new_sha1)
+    assert master.chain_position(graph.lookup(new_sha1)) == chain_length
+
+    # Moving master back to a side branch drops the old chain
+    side_sha1 = side_branch_commit(fresh_mirror.clone_path)
+    master.update(side_sha1)
+    assert master.tip_sha1 == side_sha1
+    assert [graph.sha1s[commit_id] for commit_id in master.chain_ids] == run_git(
+        fresh_mirror.clone_path, "rev-list", "--first-parent", "--reverse", side_sha1).split()
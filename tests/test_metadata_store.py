@@ -0,0 +1,110 @@
+import json
+
+import pytest
+
+import db
+import git
+import metadata_store
+import query_cache
+import repos
+import short_git_operations
+
+from conftest import add_commit, run_git
+
+
+def get_committed_sha1s(git_objdir, revision, since_timestamp, until_timestamp):
+    """
+    The commits reachable from the revision and committed in the range, newest first.
+    """
+
+    commits = [line.split() for line in run_git(git_objdir, "log", "--format=%H %ct", revision).splitlines()]
+    in_range = [(int(timestamp), sha1) for sha1, timestamp in commits if since_timestamp <= int(timestamp) < until_timestamp]
+    return [sha1 for _, sha1 in sorted(in_range, reverse=True)]
+
+
+def test_indexed_commits_are_stored(mirror):
+
+    sha1s = run_git(mirror.clone_path, "rev-list", "--branches", "--remotes").split()
+    stored = metadata_store.lookup(sha1s)
+
+    assert set(stored) == set(sha1s)
+    for sha1 in sha1s[::10]:
+        assert stored[sha1] == git.get_all_metadata_aspects(mirror.clone_path, sha1)
+
+
+def test_fill_skips_stored_commits(fresh_mirror):
+
+    new_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "Not yet stored")
+    sha1s = [new_sha1, run_git(fresh_mirror.clone_path, "rev-parse", "master~")]
+
+    assert metadata_store.fill(fresh_mirror.clone_path, sha1s) == 1
+    assert metadata_store.fill(fresh_mirror.clone_path, sha1s) == 0
+    assert metadata_store.lookup([new_sha1])[new_sha1]["subject"] == "Not-yet-stored"
+
+
+def test_stores_are_separate_per_repo(fresh_mirror):
+
+    master_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+    assert master_sha1 in metadata_store.lookup([master_sha1])
+
+    with repos.use(repos.Repo("test/empty", clone_path="/nonexistent")):
+        assert metadata_store.lookup([master_sha1]) == {}
+
+
+def test_metadata_requests_read_the_store(client, mirror, monkeypatch):
+
+    sha1s = run_git(mirror.clone_path, "rev-list", "--max-count=5", "master").split()
+    expected = client.post("/commit-metadata", data=json.dumps(sha1s)).get_json()["result"]
+
+    def fail(*args):
+        raise AssertionError("read metadata from git")
+
+    query_cache.caches.current().clear()
+    monkeypatch.setattr(git, "get_metadata_batch", lambda git_objdir, sha1s: fail() if sha1s else {})
+
+    assert client.post("/commit-metadata", data=json.dumps(sha1s)).get_json()["result"] == expected
+
+
+def test_metadata_read_from_git_is_remembered(fresh_mirror):
+
+    new_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "Unindexed commit")
+    assert metadata_store.lookup([new_sha1]) == {}
+
+    [metadata] = short_git_operations.fetch_metadata_batch([new_sha1])
+    db.buffered_writer.flush()
+    assert metadata_store.lookup([new_sha1]) == {new_sha1: metadata}
+
+
+def test_master_commit_metadata_range(client, mirror):
+
+    timestamps = sorted(int(x) for x in run_git(mirror.clone_path, "log", "--format=%ct", "--all").split())
+    since_timestamp, until_timestamp = timestamps[len(timestamps) // 4], timestamps[len(timestamps) // 2]
+
+    url = "/master-commit-metadata?since={}&until={}".format(since_timestamp, until_timestamp)
+    result = client.get(url).get_json()["result"]
+
+    expected_sha1s = get_committed_sha1s(mirror.clone_path, "master", since_timestamp, until_timestamp)
+    assert expected_sha1s
+    assert [metadata["sha1"] for metadata in result] == expected_sha1s
+
+    streamed = client.get(url + "&stream=1").get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in streamed] == result
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1500000000", 1500000000),
+    ("2017-07-14", 1499990400),
+    ("2017-07-14T02:40:00", 1500000000),
+    ("2017-07-14T02:40:00Z", 1500000000),
+    ("2017-07-14T04:40:00+02:00", 1500000000),
+])
+def test_parse_timestamp(value, expected):
+    assert short_git_operations.parse_timestamp(value) == expected
+
+
+def test_master_commit_metadata_rejects_bad_times(client, mirror):
+
+    for query_string in ["", "?since=yesterday", "?since=0&until=2020-13-01"]:
+        response = client.get("/master-commit-metadata" + query_string).get_json()
+        assert not response["success"]
+        assert response["error"].startswith("times must be ISO 8601")
@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+import metrics
+
+from conftest import run_git
+
+
+@pytest.fixture
+def local_metrics(monkeypatch):
+    """
+    Keeps metrics defined by a test out of the application's /metrics output.
+    """
+
+    monkeypatch.setattr(metrics, "defined_metrics", [])
+    monkeypatch.setattr(metrics, "collectors", [])
+
+
+def sample_value(text, sample):
+
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line[len(sample) + 1:])
+
+
+def run_in_threads(func, thread_count):
+
+    threads = [threading.Thread(target=func) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_counts_from_all_threads_are_summed(local_metrics):
+
+    counter = metrics.Counter("test_events_total", "Events", ["kind"])
+
+    def record():
+        for _ in range(1000):
+            counter.inc("a")
+        counter.inc("b", amount=5)
+
+    run_in_threads(record, 8)
+    counter.inc("a")
+
+    text = metrics.render()
+    assert sample_value(text, 'test_events_total{kind="a"}') == 8001
+    assert sample_value(text, 'test_events_total{kind="b"}') == 40
+    assert "# TYPE test_events_total counter" in text
+
+
+def test_finished_threads_shards_are_folded(local_metrics, monkeypatch):
+
+    counter = metrics.Counter("test_folded_total", "Folded")
+    monkeypatch.setattr(metrics, "MAX_UNFOLDED_SHARDS", 4)
+
+    run_in_threads(counter.inc, 20)
+
+    assert sample_value(metrics.render(), "test_folded_total") == 20
+    with metrics.shards_lock:
+        assert all(thread.is_alive() for thread, _ in metrics.shards)
+
+
+def test_histogram_buckets_are_cumulative(local_metrics):
+
+    histogram = metrics.Histogram("test_seconds", "Durations", ["op"], buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 2]:
+        histogram.observe(value, "x")
+
+    text = metrics.render()
+    assert sample_value(text, 'test_seconds_bucket{op="x",le="0.1"}') == 2
+    assert sample_value(text, 'test_seconds_bucket{op="x",le="1.0"}') == 3
+    assert sample_value(text, 'test_seconds_bucket{op="x",le="+Inf"}') == 4
+    assert sample_value(text, 'test_seconds_count{op="x"}') == 4
+    assert sample_value(text, 'test_seconds_sum{op="x"}') == pytest.approx(2.65)
+
+
+def test_collectors_and_label_escaping(local_metrics):
+
+    metrics.register_collector("test_size", "gauge", "Size", ["name"], lambda: [(("a\"b\\c\n",), 3)])
+
+    text = metrics.render()
+    assert "# TYPE test_size gauge" in text
+    assert sample_value(text, 'test_size{name="a\\"b\\\\c\\n"}') == 3
+
+
+def test_endpoint_reports_requests_by_route(client, mirror):
+
+    route_sample = 'gadgit_http_requests_total{route="/rev-parse/<ref>",method="GET",status="200"}'
+    before = sample_value(client.get("/metrics").get_data(as_text=True), route_sample) or 0
+
+    master_sha1 = run_git(mirror.clone_path, "rev-parse", "master")
+    client.get("/rev-parse/master")
+    client.get("/rev-parse/" + master_sha1)
+
+    response = client.get("/metrics")
+    assert response.content_type == metrics.CONTENT_TYPE
+
+    text = response.get_data(as_text=True)
+    assert sample_value(text, route_sample) == before + 2
+    assert master_sha1 not in text
+    assert "gadgit_git_commands_total" in text
@@ -0,0 +1,152 @@
+import glob
+import os
+import subprocess
+import time
+
+import pytest
+
+import commit_graph
+import git
+import long_git_operations
+import repos
+import short_git_operations
+
+from conftest import add_commit, run_git
+
+
+@pytest.fixture
+def origin_url(fresh_mirror):
+    """
+    Local clones ignore filters unless they go through upload-pack.
+    """
+
+    run_git(fresh_mirror.clone_url, "config", "uploadpack.allowFilter", "true")
+    return "file://" + fresh_mirror.clone_url
+
+
+@pytest.fixture
+def partial_repo(origin_url, tmp_path):
+
+    repo = repos.Repo("test/partial", clone_path=str(tmp_path / "partial" / "repo.git"))
+    repo.clone_url = origin_url
+
+    for cmd_result in [git.bare_clone(repo.clone_path, origin_url, "blob:none"), git.fetch_pr_refs(repo.clone_path)]:
+        assert not cmd_result.return_code, cmd_result.stderr
+
+    with repos.use(repo):
+        long_git_operations.publish_snapshot()
+        long_git_operations.update_indexes()
+        yield repo
+
+
+def get_missing_objects(git_objdir, revision):
+    """
+    Lists without fetching them, unlike "cat-file -e", which
+    would fetch a missing object from the promisor remote.
+    """
+
+    output = run_git(git_objdir, "rev-list", "--objects", "--missing=print", revision)
+    return [line[1:] for line in output.splitlines() if line.startswith("?")]
+
+
+def wait_for_operation(timeout_seconds=30):
+
+    lock = long_git_operations.mirror_states.current().operation_info.mutating_operation_lock
+
+    deadline = time.monotonic() + timeout_seconds
+    while lock.locked():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_partial_clone_has_no_blobs(fresh_mirror, partial_repo):
+
+    def list_objects(*args):
+        return set(line.split()[0] for line in run_git(fresh_mirror.clone_path, "rev-list", "--objects", *args).splitlines())
+
+    blob_sha1s = list_objects("master") - list_objects("--filter=blob:none", "master")
+
+    assert git.get_clone_filter(partial_repo.clone_path) == "blob:none"
+    assert git.get_clone_filter(fresh_mirror.clone_path) is None
+    assert sorted(get_missing_objects(partial_repo.clone_path, "master")) == sorted(blob_sha1s)
+    assert run_git(partial_repo.clone_path, "rev-parse", "refs/remotes/origin/pr/1/head") == run_git(
+        fresh_mirror.clone_path, "rev-parse", "refs/remotes/origin/pr/1/head")
+
+
+def test_queries_work_without_blobs(fresh_mirror, partial_repo):
+
+    master_sha1 = run_git(partial_repo.clone_path, "rev-parse", "master")
+    side_sha1 = run_git(partial_repo.clone_path, "rev-parse", "master~3")
+
+    assert commit_graph.indexes.current().lookup(master_sha1) is not None
+    assert short_git_operations.git_master_merge_base(side_sha1)["result"] == side_sha1
+    assert short_git_operations.query_ancestry(side_sha1, master_sha1)["result"] is True
+    [metadata] = short_git_operations.fetch_metadata_batch([master_sha1])
+    assert metadata["sha1"] == master_sha1
+    assert metadata["subject"] == run_git(fresh_mirror.clone_path, "log", "--max-count=1", "--format=%f", master_sha1)
+
+
+def test_fetches_keep_the_filter(fresh_mirror, partial_repo):
+
+    new_head_sha1 = add_commit(fresh_mirror.clone_url, "refs/pull/1/head", "Update PR 1")
+    long_git_operations.run_scheduled_fetch(partial_repo, git.refspecs_for_pull_request(1))
+
+    assert short_git_operations.git_pull_request_head_commit("1")["result"] == new_head_sha1
+    assert run_git(fresh_mirror.clone_url, "rev-parse", new_head_sha1 + ":file-1.txt") in get_missing_objects(partial_repo.clone_path, new_head_sha1)
+
+
+def test_restore_head_keeps_partial_clone_config(partial_repo):
+
+    assert git.restore_head_ref() == "Done."
+    assert git.get_clone_filter(partial_repo.clone_path) == "blob:none"
+    assert run_git(partial_repo.clone_path, "config", "--get", "extensions.partialClone") == "origin"
+
+
+def test_maintenance_of_partial_clone(partial_repo):
+
+    cmd_result = long_git_operations.run_maintenance_steps(partial_repo.clone_path)
+
+    assert cmd_result.return_code == 0, cmd_result.stderr
+    assert "repack_all: returned 0" in cmd_result.stdout
+    assert git.get_clone_filter(partial_repo.clone_path) == "blob:none"
+
+
+def test_repack_keeps_unreachable_commits(partial_repo):
+
+    clone_path = partial_repo.clone_path
+    master_sha1 = run_git(clone_path, "rev-parse", "master")
+    dangling_sha1 = run_git(clone_path, "commit-tree", master_sha1 + "^{tree}", "-p", master_sha1, "-m", "Dangling")
+    pack_args = [git.GIT_BINARY_PATH, "--git-dir", clone_path, "pack-objects", "-q", os.path.join(clone_path, "objects", "pack", "pack")]
+    subprocess.run(pack_args, input=dangling_sha1.encode("utf-8"), stdout=subprocess.DEVNULL, check=True)
+    run_git(clone_path, "prune-packed")
+
+    cmd_result = git.repack_all(clone_path)
+    assert cmd_result.return_code == 0, cmd_result.stderr
+
+    # Snapshots may still reference it, so it is loosened rather than deleted
+    assert run_git(clone_path, "cat-file", "-t", dangling_sha1) == "commit"
+    assert not glob.glob(os.path.join(clone_path, "objects", "pack", "*.bitmap"))
+
+
+def test_clone_is_seeded_from_bundle(fresh_mirror, origin_url, tmp_path):
+
+    bundle_path = str(tmp_path / "seeded" / "repo.bundle")
+    os.makedirs(os.path.dirname(bundle_path))
+    run_git(fresh_mirror.clone_path, "bundle", "create", bundle_path, "--all")
+
+    # The origin moves on after the bundle was made
+    new_master_sha1 = add_commit(fresh_mirror.clone_url, "refs/heads/master", "Newer than the bundle")
+
+    repo = repos.Repo("test/seeded", clone_path=str(tmp_path / "seeded" / "repo.git"))
+    repo.clone_url = origin_url
+    assert repo.bundle_path == bundle_path
+
+    with repos.use(repo):
+        assert long_git_operations.do_git_clone() == {"status": "started"}
+        wait_for_operation()
+
+        assert run_git(repo.clone_path, "rev-parse", "master") == new_master_sha1
+        assert run_git(repo.clone_path, "rev-parse", "refs/remotes/origin/pr/2/head") == run_git(
+            fresh_mirror.clone_path, "rev-parse", "refs/remotes/origin/pr/2/head")
+        assert git.get_clone_filter(repo.clone_path) == repo.clone_filter
+        assert short_git_operations.single_rev_parse("master")["result"] == new_master_sha1
@@ -0,0 +1,58 @@
+import json
+
+import git
+import pr_refs
+import short_git_operations
+
+from conftest import SYNTHETIC_REPO_PARAMETERS, add_commit, publish_in_other_process, run_git
+
+
+def test_table_matches_refs(mirror):
+
+    table = pr_refs.PullRequestRefTable()
+    table.load(mirror.clone_path)
+
+    for pr_number in range(1, SYNTHETIC_REPO_PARAMETERS["prs"] + 1):
+        head_sha1 = run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % pr_number)
+        assert table.head_of(pr_number) == head_sha1
+        assert table.pointing_prs(head_sha1) == [pr_number]
+
+    assert table.head_of(1000) is None
+    assert table.pointing_prs(run_git(mirror.clone_path, "rev-parse", "master")) == []
+
+
+def test_pointing_prs_matches_git(mirror):
+
+    for pr_number in range(1, SYNTHETIC_REPO_PARAMETERS["prs"] + 1):
+        head_sha1 = run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % pr_number)
+        expected = [int(ref.split("/")[-2]) for ref in git.current_pointing_prs(mirror.clone_path, head_sha1).stdout.split()]
+
+        assert short_git_operations.git_pointing_prs(head_sha1)["result"] == expected
+        assert short_git_operations.git_pointing_prs(head_sha1[:10])["result"] == expected
+
+
+def test_pull_request_head_queries(client, mirror):
+
+    head_sha1 = run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 3)
+    assert short_git_operations.git_pull_request_head_commit("3")["result"] == head_sha1
+    assert not short_git_operations.git_pull_request_head_commit("1000")["success"]
+
+    result = client.post("/bulk-pull-request-heads-simple", data=json.dumps([3, 1])).get_json()["result"]
+    assert result == [
+        {"pr_number": 3, "head_commit": head_sha1},
+        {"pr_number": 1, "head_commit": run_git(mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 1)},
+    ]
+
+
+def test_table_is_reloaded_for_another_process_snapshot(fresh_mirror):
+
+    table = short_git_operations.get_pr_ref_table()
+    old_head_sha1 = table.head_of(2)
+
+    new_head_sha1 = add_commit(fresh_mirror.clone_path, git.PR_REF_TEMPLATE % 2, "Fetched by another worker")
+    assert short_git_operations.get_pr_ref_table().head_of(2) == old_head_sha1
+
+    publish_in_other_process(fresh_mirror)
+    table = short_git_operations.get_pr_ref_table()
+    assert table.head_of(2) == new_head_sha1
+    assert table.pointing_prs(old_head_sha1) == []
@@ -0,0 +1,94 @@
+import git
+import long_git_operations
+import query_cache
+import short_git_operations
+
+from conftest import add_commit, publish_in_other_process
+
+
+MASTER_SHA1 = "0123456789abcdef0123456789abcdef01234567"
+
+
+def test_lru_cache_evicts_least_recently_used():
+
+    cache = query_cache.LruCache(2)
+    cache.put("a", 1, cache.generation)
+    cache.put("b", 2, cache.generation)
+    cache.get("a")
+    cache.put("c", 3, cache.generation)
+
+    assert cache.get("a") == (True, 1)
+    assert cache.get("b") == (False, None)
+    assert cache.get("c") == (True, 3)
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_lru_cache_drops_values_computed_before_clear():
+
+    cache = query_cache.LruCache(2)
+    generation = cache.generation
+    cache.clear()
+    cache.put("a", 1, generation)
+
+    assert cache.get("a") == (False, None)
+
+
+def test_cached_query_keys():
+
+    calls = []
+
+    @query_cache.cached_query()
+    def query(base, branch):
+        calls.append((base, branch))
+        return {"success": True, "result": len(calls)}
+
+    repo_caches = query_cache.caches.current()
+    repo_caches.clear()
+
+    assert query(MASTER_SHA1, branch=MASTER_SHA1) == query(base=MASTER_SHA1, branch=MASTER_SHA1)
+    assert repo_caches.immutable.get_stats()["entries"] == 1
+
+    # Names of refs may move, so their answers are dropped on fetch
+    query("master", MASTER_SHA1)
+    assert repo_caches.ref_dependent.get_stats()["entries"] == 1
+
+    query_cache.invalidate_ref_dependent()
+    query("master", MASTER_SHA1)
+    query(MASTER_SHA1, MASTER_SHA1)
+    assert calls == [(MASTER_SHA1, MASTER_SHA1), ("master", MASTER_SHA1), ("master", MASTER_SHA1)]
+
+
+def test_cached_query_does_not_cache_failures():
+
+    calls = []
+
+    @query_cache.cached_query()
+    def query(sha1):
+        calls.append(sha1)
+        return {"success": False}
+
+    query(MASTER_SHA1)
+    query(MASTER_SHA1)
+    assert len(calls) == 2
+
+
+def test_fetch_invalidates_ref_dependent_answers(fresh_mirror):
+
+    old_head_sha1 = short_git_operations.git_pull_request_head_commit("1")["result"]
+    new_head_sha1 = add_commit(fresh_mirror.clone_url, "refs/pull/1/head", "Update PR 1")
+
+    long_git_operations.run_scheduled_fetch(fresh_mirror, ["refs/pull/1/*:refs/remotes/origin/pr/1/*"])
+
+    assert new_head_sha1 != old_head_sha1
+    assert short_git_operations.git_pull_request_head_commit("1")["result"] == new_head_sha1
+
+
+def test_ref_dependent_answers_follow_another_process_snapshot(fresh_mirror):
+
+    old_head_sha1 = short_git_operations.git_pull_request_head_commit("2")["result"]
+    new_head_sha1 = add_commit(fresh_mirror.clone_path, git.PR_REF_TEMPLATE % 2, "Fetched by another worker")
+
+    publish_in_other_process(fresh_mirror)
+
+    assert new_head_sha1 != old_head_sha1
+    assert short_git_operations.git_pull_request_head_commit("2")["result"] == new_head_sha1
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+import git
+import long_git_operations
+import repos
+
+from conftest import add_commit, make_mirror, run_git
+
+
+@pytest.fixture
+def second_repo(tmp_path, monkeypatch):
+    """
+    A second mirrored repo, whose master has one more commit than its origin.
+    """
+
+    repo = repos.Repo("Test/Second")
+    make_mirror(str(tmp_path), repo)
+    monkeypatch.setitem(repos.repos_by_name, "test/second", repo)
+
+    add_commit(repo.clone_path, "refs/heads/master", "Only in the second repo")
+    with repos.use(repo):
+        long_git_operations.publish_snapshot()
+
+    return repo
+
+
+def test_per_repo_state():
+
+    created = []
+    per_repo = repos.PerRepo(lambda: created.append(repos.current().full_name) or len(created))
+    other_repo = repos.Repo("test/other", clone_path="/nonexistent")
+
+    assert per_repo.current() == 1
+    with repos.use(other_repo):
+        assert repos.current() is other_repo
+        assert per_repo.current() == 2
+        assert per_repo.current() == 2
+
+    assert repos.current() is repos.default_repo
+    assert per_repo.current() == 1
+    assert created == [repos.default_repo.full_name, "test/other"]
+
+
+def test_repo_lookup_and_log_names(second_repo):
+
+    assert repos.get("PyTorch/PyTorch") is repos.default_repo
+    assert repos.get("test/SECOND") is second_repo
+    assert repos.get("test/unmirrored") is None
+
+    assert repos.get_log_operation_name("fetch") == "fetch"
+    with repos.use(second_repo):
+        assert repos.get_log_operation_name("fetch") == "Test/Second:fetch"
+
+
+def test_scoped_routes_act_on_their_repo(client, mirror, second_repo):
+
+    scoped_master = client.get("/repos/test/second/rev-parse/master").get_json()["result"]
+    assert scoped_master == run_git(second_repo.clone_path, "rev-parse", "master")
+
+    unscoped_master = client.get("/rev-parse/master").get_json()["result"]
+    assert unscoped_master == run_git(mirror.clone_path, "rev-parse", "master")
+    assert scoped_master != unscoped_master
+
+    assert client.get("/repos/pytorch/pytorch/rev-parse/master").get_json()["result"] == unscoped_master
+    assert client.get("/repos/test/unmirrored/rev-parse/master").status_code == 404
+
+    listed = client.get("/repos").get_json()["result"]
+    assert {"full_name": "Test/Second", "clone_url": second_repo.clone_url, "cloned": True, "default": False, "clone_filter": None} in listed
+
+
+def test_events_are_grouped_by_repo(monkeypatch, client, second_repo):
+
+    import application
+    import db
+
+    fetched_refspecs = []
+    monkeypatch.setattr(db, "insert_events", lambda event_types: None)
+    monkeypatch.setattr(long_git_operations, "do_pr_fetch", lambda refspecs: fetched_refspecs.append((repos.current(), refspecs)))
+
+    def event(repo_full_name, pr_number):
+        payload = {"action": "opened", "number": pr_number, "repository": {"full_name": repo_full_name}}
+        return ("pull_request", json.dumps(payload).encode("utf-8"))
+
+    application.process_github_events([
+        event("pytorch/pytorch", 1),
+        event("test/second", 2),
+        event("Test/Second", 3),
+        event("test/unmirrored", 4),
+    ])
+
+    assert fetched_refspecs == [
+        (second_repo, git.refspecs_for_pull_request(2) + git.refspecs_for_pull_request(3)),
+        (repos.default_repo, git.refspecs_for_pull_request(1)),
+    ]
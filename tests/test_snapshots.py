@@ -0,0 +1,100 @@
+import os
+import subprocess
+import sys
+
+import git
+import long_git_operations
+import snapshots
+
+from conftest import add_commit, publish_in_other_process, run_git
+
+
+def get_generation_names(repo):
+    return sorted(name for name in os.listdir(snapshots.get_snapshots_dir(repo.clone_path)) if name.startswith(snapshots.GENERATION_PREFIX))
+
+
+def get_exited_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_snapshot_hides_refs_until_published(fresh_mirror):
+
+    old_master_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", "master")
+    new_master_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "New master commit")
+    assert run_git(snapshots.get_read_path(), "rev-parse", "master") == old_master_sha1
+
+    long_git_operations.publish_snapshot()
+    assert run_git(snapshots.get_read_path(), "rev-parse", "master") == new_master_sha1
+
+
+def test_snapshot_has_the_mirrors_refs(mirror):
+
+    read_path = snapshots.get_read_path()
+    assert read_path != mirror.clone_path
+    assert run_git(read_path, "show-ref") == run_git(mirror.clone_path, "show-ref")
+
+
+def test_keeps_recent_generations(fresh_mirror):
+
+    for _ in range(snapshots.KEPT_GENERATIONS + 2):
+        long_git_operations.publish_snapshot()
+
+    generation_paths = snapshots.states.current().generation_paths
+    assert len(generation_paths) == snapshots.KEPT_GENERATIONS
+    assert get_generation_names(fresh_mirror) == sorted(os.path.basename(p) for p in generation_paths)
+
+
+def test_fetch_publishes_a_snapshot(fresh_mirror):
+
+    new_head_sha1 = add_commit(fresh_mirror.clone_url, "refs/pull/1/head", "Update PR 1")
+    long_git_operations.run_scheduled_fetch(fresh_mirror, ["refs/pull/1/*:refs/remotes/origin/pr/1/*"])
+
+    assert run_git(snapshots.get_read_path(), "rev-parse", "refs/remotes/origin/pr/1/head") == new_head_sha1
+
+
+def test_removes_only_generations_of_exited_processes(fresh_mirror):
+
+    snapshots_dir = snapshots.get_snapshots_dir(fresh_mirror.clone_path)
+    abandoned_names = ["generation-%d-abandoned" % get_exited_pid(), "generation-unnamed"]
+    other_process_name = "generation-%d-running" % os.getppid()
+    for name in abandoned_names + [other_process_name]:
+        os.mkdir(os.path.join(snapshots_dir, name))
+
+    long_git_operations.publish_snapshot()
+
+    generation_names = get_generation_names(fresh_mirror)
+    assert other_process_name in generation_names
+    assert not set(abandoned_names) & set(generation_names)
+
+
+def test_snapshot_keeps_partial_clone_config(fresh_mirror):
+
+    run_git(fresh_mirror.clone_path, "config", "remote.origin.promisor", "true")
+    run_git(fresh_mirror.clone_path, "config", "remote.origin.partialclonefilter", "blob:none")
+    long_git_operations.publish_snapshot()
+
+    read_path = snapshots.get_read_path()
+    assert git.get_clone_filter(read_path) == "blob:none"
+    assert run_git(read_path, "config", "--get", "remote.origin.url") == fresh_mirror.clone_url
+    assert run_git(read_path, "config", "--get", "remote.origin.promisor") == "true"
+
+
+def test_generation_published_by_another_process_is_read(fresh_mirror):
+
+    old_generation = snapshots.get_generation()
+    new_master_sha1 = add_commit(fresh_mirror.clone_path, "refs/heads/master", "Published elsewhere")
+    assert run_git(snapshots.get_read_path(), "rev-parse", "master") != new_master_sha1
+
+    publish_in_other_process(fresh_mirror)
+
+    assert snapshots.get_generation() != old_generation
+    assert run_git(snapshots.get_read_path(), "rev-parse", "master") == new_master_sha1
+
+    # The other process has exited, so its generation is removed like this process's own
+    other_path = snapshots.get_read_path()
+    for _ in range(snapshots.KEPT_GENERATIONS):
+        long_git_operations.publish_snapshot()
+
+    assert not os.path.exists(other_path)
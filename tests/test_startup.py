@@ -0,0 +1,26 @@
+import long_git_operations
+import startup_benchmark
+
+
+def test_fresh_process_answers_before_warm_up(fresh_mirror, tmp_path):
+
+    url = startup_benchmark.get_first_request_url(fresh_mirror.clone_path)
+    result = startup_benchmark.run_once(fresh_mirror.clone_path, str(tmp_path / "database.sqlite3"), url)
+
+    assert result["first_request_status"] == 200
+    assert result["ready_seconds"] is not None
+    assert result["lazy_modules_loaded_at_import"] == []
+    assert result["threads_after_import"] == 1
+
+
+def test_background_work_starts_once(monkeypatch):
+
+    started = []
+    monkeypatch.setattr(long_git_operations, "background_work_started", False)
+    monkeypatch.setattr(long_git_operations, "start_warm_up", lambda: started.append("warm-up"))
+    monkeypatch.setattr(long_git_operations, "start_full_fetch_schedule", lambda: started.append("full fetch"))
+    monkeypatch.setattr(long_git_operations, "start_maintenance_schedule", lambda: started.append("maintenance"))
+
+    long_git_operations.start_background_work()
+    long_git_operations.start_background_work()
+    assert started == ["warm-up", "full fetch", "maintenance"]
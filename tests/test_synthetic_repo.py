@@ -0,0 +1,32 @@
+import synthetic_repo
+
+from conftest import SYNTHETIC_REPO_PARAMETERS, run_git
+
+
+def test_history_is_reproducible():
+
+    first = synthetic_repo.build_history(**SYNTHETIC_REPO_PARAMETERS)
+    assert synthetic_repo.build_history(**SYNTHETIC_REPO_PARAMETERS) == first
+    assert synthetic_repo.build_history(**dict(SYNTHETIC_REPO_PARAMETERS, seed=2)) != first
+
+
+def test_origin_has_the_requested_shape(tmp_path):
+
+    origin_path = str(tmp_path / "origin.git")
+    synthetic_repo.create_origin(origin_path, commits=30, fan_out=20, side_length=2, prs=5, pr_length=2, seed=3)
+
+    first_parent_sha1s = run_git(origin_path, "rev-list", "--first-parent", "master").split()
+    assert len(first_parent_sha1s) == 30
+
+    merge_sha1s = run_git(origin_path, "rev-list", "--merges", "master").split()
+    assert merge_sha1s
+    for merge_sha1 in merge_sha1s:
+        assert run_git(origin_path, "log", "--max-count=1", "--format=%s", merge_sha1).startswith("Merge side branch ")
+
+    viable_strict_sha1 = run_git(origin_path, "rev-parse", "viable/strict")
+    assert viable_strict_sha1 == first_parent_sha1s[9]
+
+    pr_refs = run_git(origin_path, "for-each-ref", "--format=%(refname)", "refs/pull").split()
+    assert sorted(pr_refs) == sorted("refs/pull/{}/head".format(n) for n in range(1, 6))
+    for pr_ref in pr_refs:
+        assert int(run_git(origin_path, "rev-list", "--count", "master.." + pr_ref)) == 2
@@ -0,0 +1,116 @@
+import subprocess
+
+import git
+import long_git_operations
+import metadata_store
+import query_cache
+import repos
+import short_git_operations
+import warmup
+
+from conftest import run_git
+
+
+def test_updated_pull_requests():
+
+    ref_changes = {
+        git.PR_REF_TEMPLATE % 3: ("a" * 40, "b" * 40),
+        git.PR_REF_TEMPLATE % 4: ("a" * 40, None),
+        git.PR_REF_TEMPLATE % 12: (None, "c" * 40),
+        "refs/remotes/origin/pr/5/merge": (None, "d" * 40),
+        "refs/heads/master": ("a" * 40, "e" * 40),
+    }
+
+    assert warmup.get_updated_pull_requests(ref_changes) == [(12, "c" * 40), (3, "b" * 40)]
+    assert warmup.get_updated_pull_requests(None) == []
+
+
+def test_warm_up_fills_the_caches(fresh_mirror):
+
+    query_cache.caches.current().clear()
+    head_sha1 = run_git(fresh_mirror.clone_path, "rev-parse", git.PR_REF_TEMPLATE % 2)
+    master_sha1s = run_git(fresh_mirror.clone_path, "rev-list", "--first-parent", "master").split()
+
+    warmup.warm_caches({git.PR_REF_TEMPLATE % 2: (None, head_sha1)})
+
+    state = warmup.states.current()
+    assert state.last_error is None
+    assert state.last_commit_count == len(master_sha1s) + 1
+    assert state.last_warmed_at is not None
+
+    repo_caches = query_cache.caches.current()
+    for sha1 in master_sha1s[::10] + [head_sha1]:
+        assert repo_caches.immutable.get(("changed_paths", sha1))[0]
+
+    assert repo_caches.ref_dependent.get(("git_pull_request_head_commit", "2"))[0]
+    assert repo_caches.ref_dependent.get(("git_master_merge_base", head_sha1))[0]
+
+
+def test_failed_warm_up_is_recorded(fresh_mirror, monkeypatch):
+
+    def fail(sha1s):
+        raise subprocess.CalledProcessError(128, ["git", "cat-file"], stderr="broken")
+
+    monkeypatch.setattr(short_git_operations, "fetch_metadata_batch", fail)
+    warmup.warm_caches()
+
+    assert "cat-file" in warmup.states.current().last_error
+
+
+def test_health_waits_for_every_repo(client, fresh_mirror, monkeypatch):
+
+    monkeypatch.setitem(repos.repos_by_name, fresh_mirror.full_name.lower(), fresh_mirror)
+    with repos.use(repos.default_repo):
+        monkeypatch.setattr(warmup.states.current(), "ready", True)
+
+    response = client.get("/health")
+    assert response.status_code == 503
+    assert response.get_json()["status"] == "warming"
+    assert not response.get_json()["repos"][fresh_mirror.full_name]["ready"]
+
+    long_git_operations.warm_up()
+
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.get_json()["repos"][fresh_mirror.full_name]["last_error"] is None
+
+
+def test_uncloned_repo_is_ready_at_once(tmp_path):
+
+    with repos.use(repos.Repo("test/uncloned", clone_path=str(tmp_path / "missing.git"))):
+        long_git_operations.warm_up()
+        assert warmup.states.current().ready
+
+
+def test_ready_before_the_stores_are_filled(fresh_mirror, monkeypatch):
+
+    ready_when_filled = []
+    monkeypatch.setattr(metadata_store, "fill_after_indexing", lambda *args: ready_when_filled.append(warmup.states.current().ready))
+
+    long_git_operations.warm_up()
+    assert ready_when_filled == [True]
+
+
+def test_failed_repo_does_not_stop_the_warm_up(fresh_mirror, tmp_path, monkeypatch):
+
+    broken_repo = repos.Repo("test/broken", clone_path=str(tmp_path / "broken.git"))
+    monkeypatch.setattr(repos, "all_repos", lambda: [broken_repo, fresh_mirror])
+
+    warm_up = long_git_operations.warm_up
+
+    def fail_for_broken_repo():
+        if repos.current() is broken_repo:
+            raise OSError("disk full")
+        warm_up()
+
+    monkeypatch.setattr(long_git_operations, "warm_up", fail_for_broken_repo)
+    long_git_operations.warm_up_all_repos()
+
+    with repos.use(broken_repo):
+        assert warmup.states.current().ready
+        assert warmup.states.current().last_error == "OSError: disk full"
+
+    state = warmup.states.current()
+    assert state.ready
+    assert state.last_error is None
+    assert state.last_warmed_at is not None